@@ -0,0 +1,56 @@
+"""Search indexes
+
+Revision ID: 653bdb362dbd
+Revises: 809fe88363bd
+Create Date: 2026-10-19 00:20:37.629552
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '653bdb362dbd'
+down_revision: Union[str, None] = '809fe88363bd'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# FTS5 indexes over the searchable columns. They are external-content tables:
+# only the index is stored, the text is read from the indexed table, and the
+# triggers keep both in sync. prefix='2 3' indexes the 2 and 3 character
+# prefixes, so prefix queries don't scan the whole vocabulary.
+SEARCH_INDEXES = {
+    'address_search': ('smoking_place_address', ('city', 'street')),
+    'user_search': ('user', ('username', 'name', 'email')),
+}
+
+
+def upgrade() -> None:
+    for index, (table, columns) in SEARCH_INDEXES.items():
+        column_list = ', '.join(columns)
+        new_values = ', '.join(f'new.{column}' for column in columns)
+        old_values = ', '.join(f'old.{column}' for column in columns)
+
+        op.execute(f"""CREATE VIRTUAL TABLE {index} USING fts5({column_list}, content='{table}', content_rowid='id',
+                       tokenize='unicode61 remove_diacritics 2', prefix='2 3')""")
+        op.execute(f"""CREATE TRIGGER {index}_insert AFTER INSERT ON "{table}" BEGIN
+                           INSERT INTO {index}(rowid, {column_list}) VALUES (new.id, {new_values});
+                       END""")
+        op.execute(f"""CREATE TRIGGER {index}_delete AFTER DELETE ON "{table}" BEGIN
+                           INSERT INTO {index}({index}, rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+                       END""")
+        op.execute(f"""CREATE TRIGGER {index}_update AFTER UPDATE OF {column_list} ON "{table}" BEGIN
+                           INSERT INTO {index}({index}, rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+                           INSERT INTO {index}(rowid, {column_list}) VALUES (new.id, {new_values});
+                       END""")
+        op.execute(f"INSERT INTO {index}({index}) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    for index in SEARCH_INDEXES:
+        for trigger in ('insert', 'delete', 'update'):
+            op.execute(f'DROP TRIGGER {index}_{trigger}')
+        op.execute(f'DROP TABLE {index}')
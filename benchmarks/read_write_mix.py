@@ -0,0 +1,129 @@
+"""Drive the API with a mixed read/write load and report throughput, latency and errors.
+
+Every write books a slot of its own, so failures come from the database layer and
+not from booking conflicts. The server and the clients share one event loop.
+
+Run from the project root: python -m benchmarks.read_write_mix [--clients 50 --seconds 10 --writes 0.1]
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+USERS = 200
+ADDRESSES = 10
+PLACES = 50
+
+
+def create_database(path: str):
+    from sqlalchemy import create_engine, insert
+    from sqlalchemy.orm import Session
+
+    from src.models import Base, User, SmokingPlaceAddress, SmokingPlace
+
+    engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(engine)
+
+    with Session(engine) as session:
+        session.execute(insert(User), [{'id': i, 'username': f'user{i}', 'password': 'x', 'name': f'Name {i}',
+                                        'email': f'user{i}@mail.ru', 'role': 'user'} for i in range(1, USERS + 1)])
+        session.execute(insert(SmokingPlaceAddress), [{'id': i, 'city': 'Moscow', 'street': f'Arbat {i}'}
+                                                      for i in range(1, ADDRESSES + 1)])
+        session.execute(insert(SmokingPlace), [{'id': i, 'number': i, 'sp_address': i % ADDRESSES + 1}
+                                               for i in range(1, PLACES + 1)])
+        session.commit()
+
+    engine.dispose()
+
+
+async def run(clients: int, seconds: float, write_ratio: float):
+    from aiohttp.test_utils import TestServer, TestClient
+
+    from src.main import create_app
+    from src.tokens import issue_token
+
+    tokens = {i: {'Authorization': f'Bearer {issue_token(i, f"user{i}", "user")}'} for i in range(1, USERS + 1)}
+    latencies = defaultdict(list)
+    statuses = Counter()
+    slots = iter(range(10 ** 9))
+    first_slot = datetime.now() + timedelta(days=1)
+
+    async def client_loop(client, deadline):
+        while time.monotonic() < deadline:
+            user = random.randint(1, USERS)
+
+            if random.random() < write_ratio:
+                kind = 'write'
+                start = first_slot + timedelta(minutes=2 * next(slots))
+                request = client.post(f'/smoking-places/{random.randint(1, PLACES)}/reservation',
+                                      headers=tokens[user],
+                                      json={'start': start.isoformat(), 'end': (start + timedelta(minutes=1)).isoformat()})
+            elif random.random() < 0.5:
+                kind = 'read'
+                request = client.get(f'/smoking-places/{random.randint(1, PLACES)}', headers=tokens[user])
+            else:
+                kind = 'read'
+                request = client.get('/reservations/my-reservations', headers=tokens[user])
+
+            started = time.perf_counter()
+            async with request as response:
+                await response.read()
+            latencies[kind].append(time.perf_counter() - started)
+            statuses[f'{kind} {response.status}'] += 1
+
+    client = TestClient(TestServer(create_app()))
+    await client.start_server()
+
+    try:
+        deadline = time.monotonic() + seconds
+        await asyncio.gather(*(client_loop(client, deadline) for _ in range(clients)))
+    finally:
+        await client.close()
+
+    return latencies, statuses
+
+
+def percentile(values, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--writes', type=float, default=0.1, help='share of write requests')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'benchmark.db')
+    # must be set before src.config is imported
+    os.environ['DB_URL'] = f'sqlite+aiosqlite:///{path}'
+
+    create_database(path)
+    latencies, statuses = asyncio.run(run(args.clients, args.seconds, args.writes))
+
+    total = sum(len(values) for values in latencies.values())
+    print(f'{args.clients} clients, {args.seconds:g} s, {args.writes:.0%} writes: {total / args.seconds:.0f} req/s')
+
+    for kind, values in sorted(latencies.items()):
+        print(f'{kind:6} {len(values):7} requests  p50 {percentile(values, 0.5):7.1f} ms  '
+              f'p99 {percentile(values, 0.99):7.1f} ms  max {max(values) * 1000:7.1f} ms')
+
+    print('statuses:', ', '.join(f'{key}: {value}' for key, value in sorted(statuses.items())))
+
+    from src.warmup import warmup
+
+    report = warmup.report()
+    first = report.get('first_responses')
+    if first:
+        print(f'warm-up {report["warmup_ms"]:.1f} ms, first {first["count"]} responses: first byte of the first '
+              f'{first["first_ms"]:.1f} ms, p50 {first["p50_ms"]:.1f} ms, p99 {first["p99_ms"]:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Compare the DTO-based listing path with encode_listing on GET /reservations rows.
+
+Run from the project root: python -m benchmarks.serialization [--rows 100000]
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import Session
+
+from src.database.db_queries import reservations_query, replace_usernames
+from src.models import Base, User, SmokingPlaceAddress, SmokingPlace, Reservation
+from src.schemas import ReservationDTO
+from src.serializers import encode_listing
+
+
+def load_rows(amount: int):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    start = datetime(2030, 1, 1, 10, 0)
+
+    with Session(engine) as session:
+        session.execute(insert(User), [{'id': i, 'username': f'user{i}', 'password': 'x', 'name': f'Name {i}',
+                                        'email': f'user{i}@mail.ru', 'role': 'user'} for i in range(1, 1001)])
+        session.execute(insert(SmokingPlaceAddress), [{'id': i, 'city': 'Moscow', 'street': f'Arbat {i}'}
+                                                      for i in range(1, 51)])
+        session.execute(insert(SmokingPlace), [{'id': i, 'number': i, 'sp_address': i % 50 + 1}
+                                               for i in range(1, 501)])
+        session.execute(insert(Reservation), [{'user': i % 1000 + 1, 'smoking_place': i % 500 + 1,
+                                               'start': start + timedelta(minutes=i),
+                                               'end': start + timedelta(minutes=i + 20)} for i in range(amount)])
+        session.commit()
+
+        # the username column holds user ids until they are looked up, as with_usernames() does in the routes
+        usernames = dict(session.execute(select(User.id, User.username)).tuples().all())
+
+        return replace_usernames(session.execute(reservations_query()).all(), usernames)
+
+
+def dto_path(rows):
+    reservations = [ReservationDTO.model_validate(row, from_attributes=True) for row in rows]
+
+    response = {}
+    for index, reservation in enumerate(reservations):
+        response[index + 1] = dict(reservation)
+
+    return json.dumps(response).encode('utf8')
+
+
+def list_index_rekeying(rows):
+    reservations = [ReservationDTO.model_validate(row, from_attributes=True) for row in rows]
+
+    response = {}
+    for reservation in reservations:
+        response[reservations.index(reservation) + 1] = dict(reservation)
+
+    return response
+
+
+def measure(func, *args, repeat: int = 3):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--index-rows', type=int, default=1_000,
+                        help='rows for the list.index() re-keying the routes used to do (quadratic)')
+    args = parser.parse_args()
+
+    rows = load_rows(args.rows)
+
+    dto_time, dto_body = measure(dto_path, rows)
+    fast_time, fast_body = measure(encode_listing, rows)
+    index_time, _ = measure(list_index_rekeying, rows[:args.index_rows], repeat=1)
+
+    assert json.loads(dto_body) == json.loads(fast_body)
+
+    print(f'rows: {len(rows)}, body: {len(fast_body) / 1024 / 1024:.1f} MiB')
+    print(f'DTO + dict + json.dumps: {dto_time * 1000:9.1f} ms')
+    print(f'encode_listing:          {fast_time * 1000:9.1f} ms  ({dto_time / fast_time:.1f}x faster)')
+    print(f'list.index re-keying of {args.index_rows} rows alone: {index_time * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
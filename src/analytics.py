@@ -0,0 +1,175 @@
+import asyncio
+import json
+import time
+
+import numpy as np
+
+from src import metrics
+from src.config import ANALYTICS_CACHE_TTL, ANALYTICS_CACHE_MAX_ENTRIES
+from src.database.db_conn import bind_request_scope
+from src.database.db_queries import AnalyticsQs
+from src.time_utils import from_epoch
+
+GRANULARITIES = {'hour': 3600, 'day': 86400, 'week': 7 * 86400}
+PEAK_HOURS = 3
+
+_cache = {}
+
+
+def occupied_before(starts: np.ndarray, ends: np.ndarray, points: np.ndarray) -> np.ndarray:
+    """Reserved seconds of all intervals before each of `points`.
+
+    That is the sum of (t - start) over the started intervals minus the sum of
+    (t - end) over the finished ones, taken from prefix sums of the sorted
+    bounds, so it costs O((n + len(points)) log n) whatever the interval lengths.
+    """
+
+    starts = np.sort(starts)
+    ends = np.sort(ends)
+    start_sums = np.concatenate(([0], np.cumsum(starts)))
+    end_sums = np.concatenate(([0], np.cumsum(ends)))
+
+    started = np.searchsorted(starts, points, side='right')
+    finished = np.searchsorted(ends, points, side='right')
+
+    return (started * points - start_sums[started]) - (finished * points - end_sums[finished])
+
+
+def busy_buckets(place_index: np.ndarray, first: np.ndarray, last: np.ndarray, places: int, buckets: int):
+    """Number of distinct buckets in which each place had at least one reservation."""
+
+    spans = last - first + 1
+    rows = np.repeat(np.arange(spans.size), spans)
+    offsets = np.arange(rows.size) - np.repeat(np.cumsum(spans) - spans, spans)
+
+    busy = np.unique(place_index[rows] * buckets + first[rows] + offsets)
+
+    return np.bincount(busy // buckets, minlength=places)
+
+
+def _parse_column(column: str | None) -> np.ndarray:
+    if not column:
+        return np.empty(0, dtype=np.int64)
+    return np.fromstring(column, dtype=np.int64, sep=',')
+
+
+def _ratios(values: np.ndarray) -> list:
+    return np.round(values, 4).tolist()
+
+
+def build_report(places, intervals, range_start: int, range_end: int, granularity: str) -> bytes:
+    step = GRANULARITIES[granularity]
+    seconds = range_end - range_start
+
+    place_ids = np.array([place.id for place in places], dtype=np.int64)
+    address_ids, address_index = np.unique(np.array([place.sp_address for place in places], dtype=np.int64),
+                                           return_inverse=True)
+    places_on_address = np.bincount(address_index, minlength=address_ids.size)
+
+    sp, starts, ends = map(_parse_column, intervals)
+    starts = np.clip(starts, range_start, range_end)
+    ends = np.clip(ends, range_start, range_end)
+
+    keep = (ends > starts) & np.isin(sp, place_ids)
+    sp, starts, ends = sp[keep], starts[keep], ends[keep]
+    place_index = np.searchsorted(place_ids, sp)
+
+    points = np.append(np.arange(range_start, range_end, step), range_end)
+    bucket_count = points.size - 1
+    timeline = np.diff(occupied_before(starts, ends, points)) / (np.diff(points) * max(place_ids.size, 1))
+
+    # the range starts at midnight, so hourly bucket i is hour i % 24 of its day
+    hourly = np.diff(occupied_before(starts, ends, np.arange(range_start, range_end + 1, 3600)))
+    hour_of_day = (np.bincount(np.arange(hourly.size) % 24, weights=hourly, minlength=24)
+                   / (seconds // 86400 * 3600 * max(place_ids.size, 1)))
+    peak_hours = [int(hour) for hour in np.argsort(-hour_of_day, kind='stable')[:PEAK_HOURS] if hour_of_day[hour] > 0]
+
+    reserved = np.bincount(place_index, weights=ends - starts, minlength=place_ids.size)
+    reservations = np.bincount(place_index, minlength=place_ids.size)
+    busy = busy_buckets(place_index, (starts - range_start) // step, (ends - 1 - range_start) // step,
+                        place_ids.size, bucket_count)
+
+    address_reserved = np.bincount(address_index, weights=reserved, minlength=address_ids.size)
+    address_busy = np.bincount(address_index, weights=busy, minlength=address_ids.size)
+
+    place_utilization = _ratios(reserved / seconds)
+    place_idle = _ratios(1 - busy / bucket_count)
+    address_utilization = _ratios(address_reserved / (places_on_address * seconds))
+    address_idle = _ratios(1 - address_busy / (places_on_address * bucket_count))
+
+    streets = {place.sp_address: (place.city, place.street) for place in places}
+
+    report = {
+        'from': str(from_epoch(range_start).date()),
+        'to': str(from_epoch(range_end - 1).date()),
+        'granularity': granularity,
+        'reservations': int(sp.size),
+        'utilization': round(float(reserved.sum() / (max(place_ids.size, 1) * seconds)), 4),
+        'peak_hours': peak_hours,
+        'hour_of_day': _ratios(hour_of_day),
+        'timeline': [{'start': str(from_epoch(point)), 'occupancy': occupancy}
+                     for point, occupancy in zip(points[:-1].tolist(), _ratios(timeline))],
+        'addresses': {
+            str(address_id): {
+                'city': streets[address_id][0],
+                'street': streets[address_id][1],
+                'places': int(places_on_address[index]),
+                'utilization': address_utilization[index],
+                'idle_ratio': address_idle[index],
+            } for index, address_id in enumerate(address_ids.tolist())
+        },
+        'places': {
+            str(place.id): {
+                'number': place.number,
+                'address_id': place.sp_address,
+                'reservations': int(reservations[index]),
+                'utilization': place_utilization[index],
+                'idle_ratio': place_idle[index],
+            } for index, place in enumerate(places)
+        },
+    }
+
+    return json.dumps(report).encode()
+
+
+async def _compute(range_start: int, range_end: int, granularity: str) -> bytes:
+    # shared between requests, so it must not use the session of the one that started it
+    bind_request_scope(None)
+
+    places = await AnalyticsQs.get_places()
+    intervals = await AnalyticsQs.get_intervals(range_start, range_end)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, build_report, places, intervals, range_start, range_end, granularity)
+
+
+def _forget(key, task):
+    if task.cancelled() or task.exception() is not None:
+        if _cache.get(key, (None, None, None))[1] is task:
+            del _cache[key]
+
+
+async def utilization_report(range_start: int, range_end: int, granularity: str) -> tuple[bytes, dict]:
+    """Utilization of places and addresses over [range_start, range_end), cached
+    per (range, granularity) for ANALYTICS_CACHE_TTL seconds, with the cache of
+    its compressed variants."""
+
+    key = (range_start, range_end, granularity)
+    now = time.monotonic()
+    entry = _cache.get(key)
+
+    if entry and now - entry[0] < ANALYTICS_CACHE_TTL:
+        metrics.inc('analytics.cached')
+        return await asyncio.shield(entry[1]), entry[2]
+
+    if len(_cache) >= ANALYTICS_CACHE_MAX_ENTRIES:
+        oldest = min(_cache, key=lambda cached: _cache[cached][0])
+        del _cache[oldest]
+
+    metrics.inc('analytics.computed')
+    task = asyncio.create_task(_compute(range_start, range_end, granularity))
+    task.add_done_callback(lambda done: _forget(key, done))
+    variants = {}
+    _cache[key] = (now, task, variants)
+
+    return await asyncio.shield(task), variants
@@ -0,0 +1,93 @@
+import asyncio
+from collections import deque
+from datetime import datetime
+
+from src import metrics
+from src.config import AUDIT_BUFFER_SIZE, AUDIT_FLUSH_INTERVAL, AUDIT_FLUSH_BATCH
+from src.database.db_conn import after_request_commit
+from src.database.db_queries import AuditQs
+from src.exceptions import DatabaseError
+
+
+class AuditLog:
+    """Trail of the changes made through the API, kept in the audit_log table.
+
+    Requests only append their events to a bounded buffer once their unit of
+    work is committed. A background task writes the buffer in batches of up to
+    `batch` events, every `interval` seconds or as soon as a batch is waiting,
+    so no request waits for the log. When the buffer is full the oldest events
+    are dropped (audit.dropped) rather than holding up requests; events still
+    buffered when a worker is killed are lost.
+    """
+
+    def __init__(self, size: int, interval: float, batch: int):
+        self.buffer = deque(maxlen=size)
+        self.interval = interval
+        self.batch = batch
+        self.wakeup = asyncio.Event()
+        self.closed = False
+
+    def record(self, actor: int | None, action: str, target, details: dict | None = None):
+        if len(self.buffer) == self.buffer.maxlen:
+            metrics.inc('audit.dropped')
+
+        self.buffer.append({'created': datetime.now(), 'actor': actor, 'action': action, 'target': str(target),
+                            'details': details})
+        metrics.inc('audit.recorded')
+
+        if len(self.buffer) >= self.batch:
+            self.wakeup.set()
+
+    async def flush(self):
+        while self.buffer:
+            batch = [self.buffer.popleft() for _ in range(min(self.batch, len(self.buffer)))]
+
+            try:
+                await AuditQs.add_events(batch)
+            except DatabaseError:
+                metrics.inc('audit.errors')
+
+                # retried with the next flush, ahead of the newer events; the oldest ones
+                # are dropped when the buffer filled up meanwhile, as record() would
+                dropped = max(len(self.buffer) + len(batch) - self.buffer.maxlen, 0)
+                if dropped:
+                    metrics.inc('audit.dropped', dropped)
+                self.buffer.extendleft(reversed(batch[dropped:]))
+                return
+
+            metrics.inc('audit.flushed', len(batch))
+            metrics.inc('audit.batches')
+
+    async def _flush_periodically(self):
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except TimeoutError:
+                pass
+
+            self.wakeup.clear()
+            await self.flush()
+
+    async def run(self, app):
+        self.closed = False
+        task = asyncio.create_task(self._flush_periodically())
+
+        yield
+
+        # not cancelled, so that the batch being written and the rest of the buffer make it to the table
+        self.closed = True
+        self.wakeup.set()
+        await task
+
+
+audit_log = AuditLog(AUDIT_BUFFER_SIZE, AUDIT_FLUSH_INTERVAL, AUDIT_FLUSH_BATCH)
+
+metrics.register_gauge('audit.buffer', lambda: len(audit_log.buffer))
+
+
+def audit(request, action: str, target, **details):
+    """Log `action` of the user of `request` on `target` once the changes of the
+    request are committed."""
+
+    actor = request['user'].id
+    after_request_commit(lambda: audit_log.record(actor, action, target, details or None))
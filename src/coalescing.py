@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+from aiohttp import web
+
+from src import metrics
+from src.compression import share_variants
+from src.config import COALESCE_TTL, COALESCE_MAX_ENTRIES
+from src.database.db_conn import bind_request_scope
+
+
+class SharedResponse:
+    def __init__(self, status: int, body: bytes, content_type: str):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.created_at = time.monotonic()
+        self.variants = {}
+
+    def to_response(self):
+        response = web.Response(status=self.status, body=self.body, content_type=self.content_type)
+        return share_variants(response, self.variants)
+
+
+_in_flight = {}
+_recent = {}
+
+
+def _remember(key: str, shared: SharedResponse, ttl: float):
+    if len(_recent) >= COALESCE_MAX_ENTRIES:
+        now = time.monotonic()
+        for stale_key in [k for k, v in _recent.items() if now - v.created_at >= ttl]:
+            del _recent[stale_key]
+
+    if len(_recent) < COALESCE_MAX_ENTRIES:
+        _recent[key] = shared
+
+
+async def _run_shared(func, key: str, ttl: float, request, args, kwargs):
+    # the computation outlives the request that started it, so it must not use
+    # that request's session
+    bind_request_scope(None)
+
+    try:
+        response = await func(request, *args, **kwargs)
+        shared = SharedResponse(response.status, response.body, response.content_type)
+
+        if ttl > 0 and response.status < 500:
+            _remember(key, shared, ttl)
+
+        return shared
+    finally:
+        _in_flight.pop(key, None)
+
+
+def coalesce_reads(ttl: float = COALESCE_TTL):
+    """Single-flight for read endpoints whose response doesn't depend on the user:
+    identical concurrent requests share one computation and its response bytes,
+    and a finished response is served for another `ttl` seconds.
+    """
+
+    def decorator(func):
+        async def wrapper(request, *args, **kwargs):
+            key = request.path_qs
+
+            shared = _recent.get(key)
+            if shared and time.monotonic() - shared.created_at < ttl:
+                metrics.inc('coalesce.cached')
+                return shared.to_response()
+
+            task = _in_flight.get(key)
+
+            if task is None:
+                metrics.inc('coalesce.computed')
+                task = asyncio.create_task(_run_shared(func, key, ttl, request, args, kwargs))
+                _in_flight[key] = task
+            else:
+                metrics.inc('coalesce.joined')
+
+            shared = await asyncio.shield(task)
+
+            return shared.to_response()
+        return wrapper
+    return decorator
@@ -0,0 +1,102 @@
+import asyncio
+import gzip
+import zlib
+
+from aiohttp import hdrs, web
+from aiohttp.web import middleware
+
+from src import metrics
+from src.config import COMPRESS_MIN_SIZE, COMPRESS_EXECUTOR_SIZE, COMPRESS_LEVEL
+from src.tracing import span
+
+# in order of preference when the client weighs them equally
+ENCODINGS = ('gzip', 'deflate')
+COMPRESSIBLE_TYPES = ('application/json', 'text/plain', 'text/html')
+
+_VARIANTS = 'compressed_variants'
+
+
+def negotiate(accept_encoding: str) -> str | None:
+    """The preferred of ENCODINGS the client accepts, or None to send the body as is."""
+
+    weights = {}
+
+    for item in accept_encoding.lower().split(','):
+        coding, *params = item.split(';')
+        weight = 1.0
+
+        for param in params:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+
+        weights[coding.strip()] = weight
+
+    best, best_weight = None, 0.0
+
+    for encoding in ENCODINGS:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'gzip':
+        return gzip.compress(body, COMPRESS_LEVEL, mtime=0)
+    return zlib.compress(body, COMPRESS_LEVEL)
+
+
+def share_variants(response: web.Response, variants: dict) -> web.Response:
+    """Keep the compressed forms of the body of a cached response in `variants`
+    (encoding -> bytes), so every response built from that cache entry reuses them."""
+
+    response[_VARIANTS] = variants
+    return response
+
+
+@middleware
+async def compression_middleware(request, handler):
+    response = await handler(request)
+
+    if (not isinstance(response, web.Response) or not isinstance(response.body, bytes)
+            or len(response.body) < COMPRESS_MIN_SIZE or response.content_type not in COMPRESSIBLE_TYPES
+            or hdrs.CONTENT_ENCODING in response.headers):
+        return response
+
+    response.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+
+    encoding = negotiate(request.headers.get(hdrs.ACCEPT_ENCODING, ''))
+
+    if encoding is None:
+        return response
+
+    body = response.body
+    variants = response.get(_VARIANTS)
+    compressed = variants.get(encoding) if variants is not None else None
+
+    if compressed is not None:
+        metrics.inc('compression.cached')
+    else:
+        with span('compress', encoding=encoding, size=len(body)):
+            # zlib releases the GIL, so big bodies are compressed in a thread
+            if len(body) >= COMPRESS_EXECUTOR_SIZE:
+                compressed = await asyncio.get_running_loop().run_in_executor(None, compress, body, encoding)
+            else:
+                compressed = compress(body, encoding)
+
+        if variants is not None:
+            variants[encoding] = compressed
+
+        metrics.inc('compression.compressed')
+        metrics.inc('compression.bytes_in', len(body))
+        metrics.inc('compression.bytes_out', len(compressed))
+
+    response.body = compressed
+    response.headers[hdrs.CONTENT_ENCODING] = encoding
+
+    return response
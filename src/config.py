@@ -0,0 +1,99 @@
+import os
+import secrets
+
+DB_URL = os.getenv('DB_URL', 'sqlite+aiosqlite:///sqlite3.db')
+# SHARDS="Moscow,Zelenograd=shards/moscow.db;Kazan=shards/kazan.db" moves the addresses, places and reservations of
+# these cities to their own database files; other cities and the users stay in DB_URL. Shards may only be appended:
+# the position of a shard fixes the range of ids it allocates.
+SHARDS = [(tuple(city.strip() for city in cities.split(',')), f'sqlite+aiosqlite:///{path.strip()}')
+          for cities, _, path in (entry.partition('=') for entry in os.getenv('SHARDS', '').split(';'))
+          if path.strip()]
+SHARD_ID_SPAN = int(os.getenv('SHARD_ID_SPAN', 10 ** 9))
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))
+READ_POOL_SIZE = int(os.getenv('READ_POOL_SIZE', 8))
+# responses after startup whose time to first byte is reported on /ready
+WARMUP_REPORT_REQUESTS = int(os.getenv('WARMUP_REPORT_REQUESTS', 100))
+WRITE_QUEUE_SIZE = int(os.getenv('WRITE_QUEUE_SIZE', 256))
+GROUP_COMMIT_WINDOW = float(os.getenv('GROUP_COMMIT_WINDOW', 0))
+GROUP_COMMIT_MAX_BATCH = int(os.getenv('GROUP_COMMIT_MAX_BATCH', 64))
+
+REQUEST_DEADLINE = float(os.getenv('REQUEST_DEADLINE', 10))
+ANALYTICS_DEADLINE = float(os.getenv('ANALYTICS_DEADLINE', 30))
+# longest CPU profile an admin can ask for, in seconds
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', 60))
+DEADLINE_RETRY_AFTER = int(os.getenv('DEADLINE_RETRY_AFTER', 1))
+
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_EXECUTOR_SIZE = int(os.getenv('COMPRESS_EXECUTOR_SIZE', 64 * 1024))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))
+
+# searches matching more rows than this are not ranked, bm25 would read every match
+SEARCH_CANDIDATES = int(os.getenv('SEARCH_CANDIDATES', 1000))
+
+HOST = os.getenv('HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', 8080))
+
+WORKERS = int(os.getenv('WORKERS', 1)) or os.cpu_count()
+WORKER_HEARTBEAT_INTERVAL = float(os.getenv('WORKER_HEARTBEAT_INTERVAL', 1))
+WORKER_TIMEOUT = float(os.getenv('WORKER_TIMEOUT', 30))
+WORKER_SHUTDOWN_TIMEOUT = float(os.getenv('WORKER_SHUTDOWN_TIMEOUT', 30))
+# a crashed worker is restarted after WORKER_RESTART_DELAY seconds, doubled with every crash of the last
+# WORKER_CRASH_WINDOW seconds up to WORKER_MAX_RESTART_DELAY; WORKER_MAX_CRASHES of them stop the pool
+WORKER_RESTART_DELAY = float(os.getenv('WORKER_RESTART_DELAY', 1))
+WORKER_MAX_RESTART_DELAY = float(os.getenv('WORKER_MAX_RESTART_DELAY', 30))
+WORKER_CRASH_WINDOW = float(os.getenv('WORKER_CRASH_WINDOW', 60))
+WORKER_MAX_CRASHES = int(os.getenv('WORKER_MAX_CRASHES', 5))
+
+COALESCE_TTL = float(os.getenv('COALESCE_TTL', 1))
+COALESCE_MAX_ENTRIES = int(os.getenv('COALESCE_MAX_ENTRIES', 1024))
+
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 24 * 3600))
+# every IDEMPOTENCY_EVICT_INTERVAL seconds the expired keys are deleted, and the oldest ones beyond IDEMPOTENCY_MAX_KEYS
+IDEMPOTENCY_MAX_KEYS = int(os.getenv('IDEMPOTENCY_MAX_KEYS', 100000))
+IDEMPOTENCY_EVICT_INTERVAL = float(os.getenv('IDEMPOTENCY_EVICT_INTERVAL', 60))
+
+# bcrypt cost of new hashes, 0 picks the highest one whose check takes at most BCRYPT_TARGET_SECONDS here;
+# hashes of another cost are rehashed on the next successful login
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 0))
+BCRYPT_TARGET_SECONDS = float(os.getenv('BCRYPT_TARGET_SECONDS', 0.25))
+BCRYPT_MIN_ROUNDS = int(os.getenv('BCRYPT_MIN_ROUNDS', 10))
+BCRYPT_MAX_ROUNDS = int(os.getenv('BCRYPT_MAX_ROUNDS', 16))
+
+SECRET_KEY = os.getenv('SECRET_KEY', '').encode() or secrets.token_bytes(32)
+TOKEN_TTL = int(os.getenv('TOKEN_TTL', 3600))
+# every worker polls the revocations made by the others this often
+TOKEN_REVOCATION_POLL_INTERVAL = float(os.getenv('TOKEN_REVOCATION_POLL_INTERVAL', 1))
+
+OCCUPANCY_HORIZON = int(os.getenv('OCCUPANCY_HORIZON', 300))
+OCCUPANCY_REFRESH_INTERVAL = float(os.getenv('OCCUPANCY_REFRESH_INTERVAL', 5))
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'WARNING').upper()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# the same error is logged at most LOG_RATE_LIMIT times per LOG_RATE_WINDOW seconds
+LOG_RATE_LIMIT = int(os.getenv('LOG_RATE_LIMIT', 10))
+LOG_RATE_WINDOW = float(os.getenv('LOG_RATE_WINDOW', 60))
+
+# the event loop sleeps LOOP_LAG_INTERVAL seconds (0 turns the monitor off) and reports how late it wakes up;
+# the stack of a loop blocked for LOOP_BLOCK_THRESHOLD seconds is captured
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.05))
+LOOP_BLOCK_THRESHOLD = float(os.getenv('LOOP_BLOCK_THRESHOLD', 0.1))
+LOOP_STACK_DEPTH = int(os.getenv('LOOP_STACK_DEPTH', 12))
+LOOP_BLOCKING_SITES = int(os.getenv('LOOP_BLOCKING_SITES', 20))
+
+# share of the requests traced, 0 turns tracing off
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))
+# 1 lets the sampled flag of a caller's traceparent header decide instead, so any client can have its requests traced
+TRACE_TRUST_TRACEPARENT = bool(int(os.getenv('TRACE_TRUST_TRACEPARENT', 0)))
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')
+# traces that would grow TRACE_FILE beyond this size are dropped, 0 lets it grow
+TRACE_FILE_MAX_BYTES = int(os.getenv('TRACE_FILE_MAX_BYTES', 100 * 1024 * 1024))
+TRACE_MAX_SPANS = int(os.getenv('TRACE_MAX_SPANS', 1000))
+TRACE_QUEUE_SIZE = int(os.getenv('TRACE_QUEUE_SIZE', 1000))
+
+AUDIT_BUFFER_SIZE = int(os.getenv('AUDIT_BUFFER_SIZE', 10000))
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', 1))
+AUDIT_FLUSH_BATCH = int(os.getenv('AUDIT_FLUSH_BATCH', 500))
+
+ANALYTICS_CACHE_TTL = float(os.getenv('ANALYTICS_CACHE_TTL', 300))
+ANALYTICS_CACHE_MAX_ENTRIES = int(os.getenv('ANALYTICS_CACHE_MAX_ENTRIES', 32))
+ANALYTICS_MAX_DAYS = int(os.getenv('ANALYTICS_MAX_DAYS', 366))
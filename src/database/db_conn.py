@@ -1,8 +1,439 @@
+import asyncio
+import sqlite3
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar, Token
+
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from src import metrics
+from src.config import DB_URL, SQLITE_BUSY_TIMEOUT, READ_POOL_SIZE, WRITE_QUEUE_SIZE, SHARDS, SHARD_ID_SPAN
+from src.exceptions import WriteQueueFull
+
+_request_scope = ContextVar('request_scope', default=None)
+_interruptible = ContextVar('interruptible', default=None)
+
+
+def sqlite3_connection(driver_connection) -> sqlite3.Connection:
+    """The sqlite3 connection an aiosqlite one runs its statements on, which
+    aiosqlite doesn't expose: the one place that reaches into it, checked when
+    the connection is opened rather than when a deadline needs it."""
+
+    connection = getattr(driver_connection, '_connection', None)
+
+    if not isinstance(connection, sqlite3.Connection):
+        raise RuntimeError(f'No sqlite3 connection behind {driver_connection!r}')
+
+    return connection
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record, foreign_keys: bool = True):
+    # WAL lets readers in every worker process run alongside the single writer,
+    # busy_timeout makes a writer wait for the lock instead of failing at once
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}')
+    cursor.execute(f'PRAGMA foreign_keys={"ON" if foreign_keys else "OFF"}')
+    cursor.execute('PRAGMA foreign_keys')
+    connection_record.info['foreign_keys'] = bool(cursor.fetchone()[0])
+    cursor.close()
+
+    # transactions are started by the 'begin' listener below, so that reads
+    # inside one session see a single snapshot
+    dbapi_connection.isolation_level = None
+
+
+def begin_transaction(conn):
+    conn.exec_driver_sql(conn.get_execution_options().get('sqlite_begin', 'BEGIN'))
+
+
+def set_query_only(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA query_only=ON')
+    cursor.close()
+
+
+@event.listens_for(Session, 'after_begin')
+def remember_sqlite3_connection(session, transaction, connection):
+    session.info['sqlite3_connection'] = connection.connection.info['sqlite3_connection']
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def forget_sqlite3_connection(session, transaction):
+    # back in the pool, the connection may be running the statements of another session
+    if transaction.parent is None:
+        session.info.pop('sqlite3_connection', None)
+
+
+def interrupt_statement(session: AsyncSession):
+    # interrupt() is the one method of a sqlite3 connection meant to be called
+    # from another thread than the one running its statement
+    connection = session.info.get('sqlite3_connection')
+
+    if connection is not None:
+        connection.interrupt()
+
+
+@event.listens_for(Session, 'after_commit')
+def run_after_commit(session):
+    for callback in session.info.pop('after_commit', ()):
+        callback()
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_after_commit(session):
+    session.info.pop('after_commit', None)
+
+
+class WriteQueue:
+    """The single writer of this process.
+
+    Write sessions use the one connection of write_engine, and a dedicated task
+    hands it to the waiting units of work one at a time, in arrival order.
+    Writers of one process therefore never contend for the SQLite lock; only
+    other worker processes can make BEGIN IMMEDIATE wait (busy_timeout).
+    When `size` writers are already waiting, new ones are refused at once.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.queue = None
+        self.task = None
+        self.loop = None
+
+    def _start(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.size)
+        self.task = self.loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            grant, released = await self.queue.get()
+
+            # the waiter was cancelled before its turn
+            if grant.done():
+                continue
+
+            grant.set_result(released)
+            await released.wait()
+
+    async def acquire(self) -> asyncio.Event:
+        """Wait for the write connection; set the returned event to hand it over."""
+
+        if self.loop is not asyncio.get_running_loop() or self.task.done():
+            self._start()
+
+        grant = self.loop.create_future()
+        released = asyncio.Event()
+
+        try:
+            self.queue.put_nowait((grant, released))
+        except asyncio.QueueFull:
+            metrics.inc('db.write_queue_full')
+            raise WriteQueueFull('Too many pending writes')
+
+        started = time.perf_counter()
+
+        try:
+            released = await grant
+        except asyncio.CancelledError:
+            # cancelled right after being granted the connection: pass it on
+            if grant.done() and not grant.cancelled():
+                grant.result().set()
+            raise
+
+        metrics.inc('db.write_wait_seconds', time.perf_counter() - started)
+
+        return released
+
+    def pending(self) -> int:
+        return self.queue.qsize() if self.queue else 0
+
+
+class Shard:
+    """A database file with its own engines and writer.
+
+    Shard 0 is DB_URL: it holds the global tables (users) and the addresses,
+    places and reservations of every city no other shard is configured for.
+    Rows of shard i get ids in [i * SHARD_ID_SPAN, (i + 1) * SHARD_ID_SPAN), so
+    an id alone tells where its row is. Shards don't share locks or writers, so
+    bookings in different shards never wait for each other.
+
+    Reservations reference users of shard 0, which SQLite can't enforce across
+    files, so foreign keys are off in the other shards and the queries cascade
+    deletes themselves.
+    """
+
+    def __init__(self, index: int, url: str, cities: tuple = ()):
+        self.index = index
+        self.url = url
+        self.cities = cities
+        self.first_id = index * SHARD_ID_SPAN
+        self.last_id = self.first_id + SHARD_ID_SPAN - 1
+
+        # aiosqlite defaults to NullPool, which opens a new connection for every session
+        self.read_engine = create_async_engine(url, poolclass=AsyncAdaptedQueuePool, pool_size=READ_POOL_SIZE,
+                                               max_overflow=0)
+        self.write_engine = create_async_engine(url, poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0,
+                                                execution_options={'sqlite_begin': 'BEGIN IMMEDIATE'})
+        self.write_queue = WriteQueue(WRITE_QUEUE_SIZE)
+
+        for engine in (self.read_engine, self.write_engine):
+            event.listen(engine.sync_engine, 'connect', self.set_pragmas)
+            event.listen(engine.sync_engine, 'begin', begin_transaction)
+        event.listen(self.read_engine.sync_engine, 'connect', set_query_only)
+
+    def set_pragmas(self, dbapi_connection, connection_record):
+        set_sqlite_pragmas(dbapi_connection, connection_record, foreign_keys=self.index == 0)
+        connection_record.info['sqlite3_connection'] = sqlite3_connection(dbapi_connection.driver_connection)
+
+    def owns(self, row_id: int) -> bool:
+        return self.first_id <= int(row_id) <= self.last_id
+
+    def session(self, write: bool = False, **kwargs) -> AsyncSession:
+        return async_session_factory(bind=self.write_engine if write else self.read_engine, **kwargs)
+
+
+shards = [Shard(0, DB_URL)] + [Shard(index, url, cities) for index, (cities, url) in enumerate(SHARDS, 1)]
+main_shard = shards[0]
+engines = tuple(engine for shard in shards for engine in (shard.read_engine, shard.write_engine))
+
+async_session_factory = async_sessionmaker(main_shard.read_engine, class_=AsyncSession, expire_on_commit=False)
+
+_city_shards = {city: shard for shard in shards[1:] for city in shard.cities}
+
+for _shard in shards:
+    metrics.register_gauge('db.write_queue' if _shard.index == 0 else f'db.write_queue.{_shard.index}',
+                           _shard.write_queue.pending)
+
+
+def shard_for_city(city: str) -> Shard:
+    return _city_shards.get(city, main_shard)
+
+
+def shard_for_id(row_id: int) -> Shard:
+    """The shard of an address, place or reservation id. Ids beyond the last
+    shard are looked up in shard 0, where they are simply not found."""
+
+    index = int(row_id) // SHARD_ID_SPAN
+    return shards[index] if index < len(shards) else main_shard
+
+
+def shards_for(place: int | None = None, address: int | None = None, city: str | None = None) -> list[Shard]:
+    """The shards a listing filtered by place, address or city has to read."""
+
+    if place is not None:
+        return [shard_for_id(place)]
+    if address is not None:
+        return [shard_for_id(address)]
+    if city is not None:
+        return [shard_for_city(city)]
+    return shards
+
+
+def group_by_shard(ids) -> dict[Shard, list]:
+    groups = {}
+
+    for row_id in ids:
+        groups.setdefault(shard_for_id(row_id), []).append(row_id)
+
+    return dict(sorted(groups.items(), key=lambda group: group[0].index))
+
+
+class RequestScope:
+    """Unit of work of one request: the session of a shard is opened on the
+    first query to it, shared by every Qs call of the request and committed
+    once at the end.
+
+    Read-only requests use the pools of query_only connections and see one WAL
+    snapshot per shard. Requests that modify data wait for the write connection
+    of each shard they touch when its session is opened and start with BEGIN
+    IMMEDIATE, so a read-then-write handler can't fail on lock upgrade.
+
+    Shards are committed one after another in index order, so the few requests
+    writing to several of them aren't atomic across them.
+    """
+
+    def __init__(self, write: bool = False):
+        self.write = write
+        self.sessions = {}
+        self.released = []
+        self.rejected = False
+
+    @property
+    def session(self) -> AsyncSession | None:
+        """The session committed last."""
+
+        return self.sessions[max(self.sessions)] if self.sessions else None
+
+    async def get_session(self, shard: Shard) -> AsyncSession:
+        session = self.sessions.get(shard.index)
+
+        if session is None:
+            if self.write:
+                try:
+                    self.released.append(await shard.write_queue.acquire())
+                except WriteQueueFull:
+                    self.rejected = True
+                    raise
+
+            session = self.sessions[shard.index] = shard.session(write=self.write, info={'request_scoped': True})
+
+        return session
+
+    async def close(self, commit: bool = True):
+        sessions, self.sessions = self.sessions, {}
+        released, self.released = self.released, []
+
+        try:
+            for index in sorted(sessions):
+                if commit:
+                    await sessions[index].commit()
+                else:
+                    await sessions[index].rollback()
+        finally:
+            for session in sessions.values():
+                await session.close()
+
+            for event in released:
+                event.set()
+
+
+def bind_request_scope(scope: RequestScope | None):
+    if scope is None:
+        # work shared between requests isn't interrupted with the one that started it
+        _interruptible.set(None)
+    return _request_scope.set(scope)
+
+
+def unbind_request_scope(token):
+    _request_scope.reset(token)
+
+
+def defer_writes() -> bool:
+    """Serve the current request from the reader pool. For handlers whose writes
+    are committed by another unit of work, which needs the write connection.
+
+    False when the request already holds the write connection (it has written,
+    an idempotency key for instance): its writes must then go in its own unit
+    of work, or the other one would wait for it.
+    """
+
+    scope = _request_scope.get()
+
+    if scope is None:
+        return True
+
+    if scope.sessions and scope.write:
+        return False
+
+    scope.write = False
+    return True
+
+
+def track_sessions() -> tuple[set, Token]:
+    """Collect the sessions the current request is running statements on.
+
+    Cancelling a task doesn't stop its statement: the aiosqlite thread keeps
+    running it, and the rollback or close queued behind it waits until it ends.
+    Whoever cancels the request should interrupt these sessions first.
+    """
+
+    sessions = set()
+    return sessions, _interruptible.set(sessions)
+
+
+def untrack_sessions(token: Token):
+    _interruptible.reset(token)
+
+
+@contextmanager
+def _tracked(session: AsyncSession):
+    tracked = _interruptible.get()
+
+    if tracked is None:
+        yield
+        return
+
+    tracked.add(session)
+    try:
+        yield
+    finally:
+        tracked.discard(session)
+
+
+@asynccontextmanager
+async def session_scope(write: bool = False, shard: Shard | None = None, detached: bool = False):
+    """A session of `shard` (shard 0 by default): the one of the current request,
+    or one of its own outside requests.
+
+    A `detached` read in a request that modifies data gets a reader of its own
+    instead of the write connection of the shard, so it can't make the request
+    wait for writers of a shard it doesn't write to.
+    """
+
+    shard = shard or main_shard
+    scope = _request_scope.get()
+
+    if detached and scope is not None and scope.write:
+        scope = None
+
+    if scope is None:
+        if not write:
+            async with shard.session() as session:
+                with _tracked(session):
+                    yield session
+            return
+
+        released = await shard.write_queue.acquire()
+
+        try:
+            async with shard.session(write=True) as session:
+                with _tracked(session):
+                    yield session
+        finally:
+            released.set()
+        return
+
+    session = await scope.get_session(shard)
+
+    try:
+        with _tracked(session):
+            yield session
+    except BaseException:
+        await session.rollback()
+        raise
+
+
+async def commit_or_flush(session: AsyncSession):
+    if session.info.get('request_scoped'):
+        await session.flush()
+    else:
+        await session.commit()
+
+
+async def foreign_keys_enabled(session: AsyncSession) -> bool:
+    connection = await session.connection()
+    return connection.info.get('foreign_keys', False)
+
+
+def after_commit(session: AsyncSession, callback):
+    """Run `callback` once the current transaction of `session` is committed,
+    that is at the end of the request for request-scoped sessions."""
+
+    session.info.setdefault('after_commit', []).append(callback)
 
-DB_URL = f"sqlite+aiosqlite:///sqlite3.db"
 
-engine = create_async_engine(DB_URL)
+def after_request_commit(callback):
+    """Run `callback` once the unit of work of the current request is committed,
+    or at once if it hasn't touched the database."""
 
-async_session_factory = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    scope = _request_scope.get()
 
+    if scope is None or scope.session is None:
+        callback()
+    else:
+        after_commit(scope.session, callback)
@@ -1,109 +1,375 @@
+import asyncio
+import heapq
+import logging
+import re
+from collections import namedtuple
 from datetime import datetime
+from functools import lru_cache, partial
+from itertools import chain, islice
 
-from sqlalchemy import select, between, and_, or_, delete, update, String, Integer, exists
+from sqlalchemy import select, and_, or_, delete, update, String, Integer, exists, literal, true
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.sql.functions import count
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.sql.functions import count, func
 
 
-from src.models import SmokingPlace, SmokingPlaceAddress, User, Reservation
-from src.schemas import UserDTO, SmokingPlaceDTO, ReservationDTO, SmokingPlaceAddressDTO, SmokingPlaceWithoutAddressDTO
-from .db_conn import async_session_factory
-from ..exceptions import UniqueError, DatabaseError
+from src.config import SEARCH_CANDIDATES, TOKEN_TTL
+from src.models import (SmokingPlace, SmokingPlaceAddress, User, Reservation, PlaceOccupancy, AuditEvent,
+                        IdempotencyKey, TokenRevocation, address_search, user_search)
+from src.schemas import (UserDTO, UserCredentialsDTO, SmokingPlaceDTO, ReservationDTO, SmokingPlaceAddressDTO,
+                         SmokingPlaceWithoutAddressDTO)
+from src.time_utils import to_epoch, now_epoch
+from src.tokens import revoke, revocation_time
+from src.tracing import traced_queries
+from .db_conn import (session_scope, commit_or_flush, foreign_keys_enabled, after_commit, shards, shard_for_city,
+                      shard_for_id, shards_for, group_by_shard)
+from ..exceptions import UniqueError, DatabaseError, ShardError
 
+logger = logging.getLogger(__name__)
 
+# ids per IN (...) list, well below the 32766 variables SQLite allows in a statement
+IN_BATCH = 10000
+
+
+USER_COLUMNS = {
+    'id': User.id,
+    'username': User.username,
+    'name': User.name,
+    'email': User.email,
+    'role': User.role,
+}
+
+SMOKING_PLACE_COLUMNS = {
+    'id': SmokingPlace.id,
+    'number': SmokingPlace.number,
+    'city': SmokingPlaceAddress.city,
+    'street': SmokingPlaceAddress.street,
+}
+
+RESERVATION_COLUMNS = {
+    'reservation_id': Reservation.id.label("reservation_id"),
+    # user ids, replaced with the usernames by with_usernames()
+    'username': Reservation.user.label("username"),
+    'sp_number': SmokingPlace.number.label("sp_number"),
+    'city': SmokingPlaceAddress.city.label("city"),
+    'street': SmokingPlaceAddress.street.label("street"),
+    'start': Reservation.start.label("start").cast(String),
+    'end': Reservation.end.label("end").cast(String),
+}
+
+
+def project(columns: dict, fields: list[str] | None = None) -> list:
+    """The columns named in `fields` in their usual order, or all of them."""
+
+    return [column for name, column in columns.items() if not fields or name in fields]
+
+
+def uses(model, *clauses) -> bool:
+    # .expression turns ORM attributes into the columns find_tables can see
+    return any(model.__table__ in find_tables(clause.expression, check_columns=True) for clause in clauses)
+
+
+def smoking_places_query(fields: list[str] | None = None, conditions: tuple = ()):
+    columns = project(SMOKING_PLACE_COLUMNS, fields)
+    query = select(*columns).select_from(SmokingPlace).where(*conditions)
+
+    # the address is joined only when its columns are selected or filtered on
+    if uses(SmokingPlaceAddress, *columns, *conditions):
+        query = query.join(SmokingPlace.address)
+
+    return query
+
+
+def reservations_query(with_username: bool = True, fields: list[str] | None = None, conditions: tuple = ()):
+    columns = project({name: column for name, column in RESERVATION_COLUMNS.items()
+                       if with_username or name != 'username'}, fields)
+    query = select(*columns).select_from(Reservation).where(*conditions)
+
+    if uses(SmokingPlaceAddress, *columns, *conditions):
+        query = query.join(Reservation.sp_ref).join(SmokingPlace.address)
+    elif uses(SmokingPlace, *columns, *conditions):
+        query = query.join(Reservation.sp_ref)
+
+    return query
+
+
+def reservation_filters(place: int | None = None, address: int | None = None, city: str | None = None,
+                        start: datetime | None = None, end: datetime | None = None,
+                        user: int | None = None) -> tuple:
+    """Conditions of the active reservations of a place, address, city or user that
+    overlap [start, end]."""
+
+    conditions = [Reservation.end_ts >= max(now_epoch(), to_epoch(start) if start else 0)]
+
+    if end is not None:
+        conditions.append(Reservation.start_ts <= to_epoch(end))
+    if place is not None:
+        conditions.append(Reservation.smoking_place == place)
+    if address is not None:
+        conditions.append(SmokingPlace.sp_address == address)
+    if city is not None:
+        conditions.append(SmokingPlaceAddress.city == city)
+    if user is not None:
+        conditions.append(Reservation.user == user)
+
+    return tuple(conditions)
+
+
+def prefix_match(terms: str) -> str:
+    """FTS5 query for the rows having, for every word of `terms`, a word that starts with it."""
+
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', terms))
+
+
+async def search_candidates(session, index, terms: str):
+    """The rows of `index` matching `terms`, with their rank: all of them ranked
+    by bm25 when there are at most SEARCH_CANDIDATES, else the first
+    SEARCH_CANDIDATES in index order, unranked.
+
+    bm25 weighs every word by the number of rows it appears in, so ranking
+    reads the whole posting list of a prefix, seconds for a short one among
+    a million users. A capped lookup without rank tells cheaply whether the
+    query is narrow enough for it.
+    """
+
+    match = index.c[index.name].match(prefix_match(terms))
+    result = await session.execute(select(index.c.rowid).where(match).limit(SEARCH_CANDIDATES + 1))
+
+    if len(result.all()) > SEARCH_CANDIDATES:
+        return select(index.c.rowid, literal(0.0).label('rank')).where(match).limit(SEARCH_CANDIDATES).subquery()
+
+    return select(index.c.rowid, index.c.rank).where(match).subquery()
+
+
+async def on_shards(query_shard, targets: list | None = None) -> list:
+    """The results of `query_shard(shard)` on each of `targets` (all shards),
+    queried concurrently."""
+
+    targets = shards if targets is None else targets
+
+    if len(targets) == 1:
+        return [await query_shard(targets[0])]
+
+    # every query is let finish before an error is raised, as they may use the
+    # sessions of the request
+    results = await asyncio.gather(*(query_shard(shard) for shard in targets), return_exceptions=True)
+
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    return results
+
+
+async def revoke_tokens(session, user_id: int):
+    """Revoke the tokens of `user_id` issued so far with the unit of work of
+    `session`: this worker rejects them once it is committed, the others after
+    their next poll of token_revocation."""
+
+    revoked_at = revocation_time()
+    await session.execute(insert(TokenRevocation).values(user=user_id, revoked_at=revoked_at))
+    # every token the older rows revoked has expired by now
+    await session.execute(delete(TokenRevocation).where(TokenRevocation.revoked_at < revoked_at - TOKEN_TTL * 1000))
+    after_commit(session, partial(revoke, user_id, revoked_at))
+
+
+async def next_id(session, model, shard) -> int:
+    """Rows of a shard are numbered from the start of its id range."""
+
+    query = select(func.max(model.id)).where(model.id.between(shard.first_id, shard.last_id))
+    result = await session.execute(query)
+    return (result.scalar() or shard.first_id) + 1
+
+
+@lru_cache
+def row_type(fields: tuple):
+    return namedtuple('Row', fields)
+
+
+async def with_usernames(rows: list) -> list:
+    """`rows` with the user ids of their username column replaced by the
+    usernames. Users are kept in shard 0, so the shards can't join them."""
+
+    if not rows or 'username' not in rows[0]._fields:
+        return rows
+
+    position = rows[0]._fields.index('username')
+
+    return replace_usernames(rows, await UserQs.get_usernames({row[position] for row in rows}))
+
+
+def replace_usernames(rows: list, usernames: dict) -> list:
+    if not rows or 'username' not in rows[0]._fields:
+        return rows
+
+    fields = rows[0]._fields
+    position = fields.index('username')
+    row = row_type(fields)
+
+    return [row._make((*values[:position], usernames.get(values[position]), *values[position + 1:]))
+            for values in rows]
+
+
+def occupancy_query(now: int, sp_ids: list[int] | None = None):
+    current = aliased(Reservation)
+    current_id = (select(current.id)
+                  .where(and_(current.smoking_place == SmokingPlace.id,
+                              current.start_ts <= now,
+                              current.end_ts >= now))
+                  .order_by(current.end_ts.desc())
+                  .limit(1)
+                  .correlate(SmokingPlace)
+                  .scalar_subquery())
+
+    # the WHERE clause is always rendered: SQLite can't parse an upsert whose
+    # SELECT ends with a join constraint
+    return (select(SmokingPlace.id.label("smoking_place"),
+                   Reservation.id.label("reservation"),
+                   Reservation.end.label("end"),
+                   Reservation.end_ts.label("end_ts"))
+            .select_from(SmokingPlace)
+            .outerjoin(Reservation, Reservation.id == current_id)
+            .where(SmokingPlace.id.in_(sp_ids) if sp_ids is not None else true()))
+
+
+@traced_queries
 class UserQs:
     @staticmethod
     async def add_user(username: str, password: str, name: str, email: str):
         try:
-            async with async_session_factory() as session:
+            async with session_scope(write=True) as session:
                 stmt = User(username=username, password=password, name=name, email=email)
                 session.add(stmt)
-                await session.commit()
+                await commit_or_flush(session)
                 user_dto = UserDTO.model_validate(stmt, from_attributes=True)
         except IntegrityError as e:
             raise UniqueError(e.orig.args[0])
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return user_dto
 
     @staticmethod
-    async def get_user_password(username: str):
+    async def get_user_credentials(username: str):
         try:
-            async with async_session_factory() as session:
-                query = select(User.password).where(User.username == username)
+            async with session_scope() as session:
+                query = select(User.id, User.username, User.password, User.role).where(User.username == username)
                 result = await session.execute(query)
-                password = result.scalars().first()
-        except Exception as e:
-            print(e)
+                user = result.first()
+                user_dto = UserCredentialsDTO.model_validate(user, from_attributes=True) if user else None
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
-            return password
+            return user_dto
 
     @staticmethod
-    async def get_user_role(username: str):
+    async def get_user_role_by_id(user_id: int):
         try:
-            async with async_session_factory() as session:
-                query = select(User.role).where(User.username == username)
+            async with session_scope() as session:
+                query = select(User.role).where(User.id == user_id)
                 result = await session.execute(query)
-                role = result.scalars().one()
-        except Exception as e:
-            print(e)
+                role = result.scalars().first()
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return role
 
     @staticmethod
-    async def get_user_role_by_id(user_id: int):
+    async def get_token_revocations(after_id: int, since: int):
+        """The revocations recorded after the one with `after_id`, made at `since` (ms) or later."""
+
         try:
-            async with async_session_factory() as session:
-                query = select(User.role).where(User.id == user_id)
+            async with session_scope() as session:
+                query = (select(TokenRevocation.id, TokenRevocation.user, TokenRevocation.revoked_at)
+                         .where(TokenRevocation.id > after_id, TokenRevocation.revoked_at >= since)
+                         .order_by(TokenRevocation.id))
                 result = await session.execute(query)
-                role = result.scalars().first()
-        except Exception as e:
-            print(e)
+                revocations = result.all()
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
-            return role
+            return revocations
 
     @staticmethod
     async def get_user_id(username: str):
         try:
-            async with async_session_factory() as session:
+            async with session_scope(detached=True) as session:
                 query = select(User.id).where(User.username == username)
                 result = await session.execute(query)
                 user_id = result.scalars().first()
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return user_id
 
     @staticmethod
-    async def get_all_users():
+    async def get_usernames(user_ids) -> dict:
+        user_ids = list(user_ids)
+        usernames = {}
+
         try:
-            async with async_session_factory() as session:
-                query = select(User)
+            async with session_scope(detached=True) as session:
+                for offset in range(0, len(user_ids), IN_BATCH):
+                    query = (select(User.id, User.username)
+                             .where(User.id.in_(user_ids[offset:offset + IN_BATCH])))
+                    result = await session.execute(query)
+                    usernames.update(result.tuples().all())
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
+        else:
+            return usernames
+
+    @staticmethod
+    async def get_all_users(fields: list[str] | None = None, username: str | None = None):
+        try:
+            async with session_scope() as session:
+                query = select(*project(USER_COLUMNS, fields))
+                if username is not None:
+                    query = query.where(User.username == username)
                 result = await session.execute(query)
-                users = result.scalars().all()
-                users_dto = [UserDTO.model_validate(user, from_attributes=True) for user in users]
-        except Exception as e:
-            print(e)
+                users = result.all()
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
-            return users_dto
+            return users
+
+    @staticmethod
+    async def search_users(terms: str, limit: int):
+        try:
+            async with session_scope() as session:
+                matches = await search_candidates(session, user_search, terms)
+                query = (select(*project(USER_COLUMNS))
+                         .select_from(matches)
+                         .join(User, User.id == matches.c.rowid)
+                         .order_by(matches.c.rank)
+                         .limit(limit))
+                result = await session.execute(query)
+                users = result.all()
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
+        else:
+            return users
 
     @staticmethod
     async def get_user(user_id: int):
         try:
-            async with async_session_factory() as session:
+            async with session_scope() as session:
                 query = select(User).where(User.id == user_id)
                 result = await session.execute(query)
                 user = result.scalars().first()
                 user_dto = UserDTO.model_validate(user, from_attributes=True) if user else []
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return user_dto
@@ -111,101 +377,164 @@ class UserQs:
     @staticmethod
     async def update_user_role(user_id: int, user_role: str):
         try:
-            async with async_session_factory() as session:
+            async with session_scope(write=True) as session:
                 query = update(User).where(User.id == user_id).values(role=user_role).returning(User)
                 result = await session.execute(query)
                 user = result.scalars().first()
                 user_dto = UserDTO.model_validate(user, from_attributes=True) if user else []
-                await session.commit()
-        except Exception as e:
-            print(e)
+
+                if user:
+                    await revoke_tokens(session, user_id)
+
+                await commit_or_flush(session)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return user_dto
 
     @staticmethod
-    async def delete_user(user_id: int):
+    async def update_password(user_id: int, old_password: str, new_password: str) -> bool:
+        # only replaces the hash it was computed from, a password changed in between is kept
         try:
-            async with async_session_factory() as session:
-                query = delete(User).where(User.id == user_id)
-                await session.execute(query)
-                await session.flush()
+            async with session_scope(write=True) as session:
+                query = (update(User).where(User.id == user_id, User.password == old_password)
+                         .values(password=new_password))
+                result = await session.execute(query)
+                await commit_or_flush(session)
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
+        else:
+            return result.rowcount > 0
 
-                query = delete(Reservation).where(Reservation.user == user_id)
-                await session.execute(query)
-                await session.commit()
-        except Exception as e:
-            print(e)
+    @staticmethod
+    async def delete_user(user_id: int) -> list[int]:
+        """Delete the user with their reservations, returns the places those were in."""
+
+        sp_ids = set()
+
+        try:
+            # one after another, in the order every writer takes the shards
+            for shard in shards:
+                async with session_scope(write=True, shard=shard) as session:
+                    # not left to the foreign key, the places are needed to resync their occupancy
+                    query = delete(Reservation).where(Reservation.user == user_id).returning(Reservation.smoking_place)
+                    result = await session.execute(query)
+                    sp_ids.update(result.scalars().all())
+
+                    if shard is shards[0]:
+                        query = delete(User).where(User.id == user_id)
+                        result = await session.execute(query)
+
+                        if result.rowcount:
+                            await revoke_tokens(session, user_id)
+
+                    await commit_or_flush(session)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
+        else:
+            return sorted(sp_ids)
 
     @staticmethod
     async def check_id(user_id: int):
         try:
-            async with async_session_factory() as session:
+            async with session_scope() as session:
                 query = select(exists().where(User.id == user_id))
                 result = await session.execute(query)
                 check = result.scalars().first()
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return check
 
 
+@traced_queries
 class SmokingPlaceQs:
     @staticmethod
     async def add_smoking_place(number: int, address_id: int):
+        shard = shard_for_id(address_id)
+
         try:
-            async with async_session_factory() as session:
-                stmt = SmokingPlace(number=number, sp_address=address_id)
+            async with session_scope(write=True, shard=shard) as session:
+                stmt = SmokingPlace(id=await next_id(session, SmokingPlace, shard), number=number,
+                                    sp_address=address_id)
                 session.add(stmt)
-                await session.commit()
+                await commit_or_flush(session)
         except IntegrityError as e:
             raise UniqueError(e.orig.args[0])
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return stmt.id
 
     @staticmethod
-    async def put_smoking_place(sp_id: int, number: int, address_id: int):
+    async def upsert_smoking_place(sp_id: int, number: int, address_id: int):
+        shard = shard_for_id(address_id)
+
+        if not shard.owns(sp_id):
+            raise ShardError(f'Smoking place id {sp_id} is out of the id range of the address')
+
         try:
-            async with async_session_factory() as session:
-                stmt = SmokingPlace(id=sp_id, number=number, sp_address=address_id)
-                session.add(stmt)
-                smoking_place_dto = SmokingPlaceWithoutAddressDTO.model_validate(stmt, from_attributes=True)
-                await session.commit()
-        except Exception as e:
-            print(e)
+            async with session_scope(write=True, shard=shard) as session:
+                query = (update(SmokingPlace)
+                         .where(SmokingPlace.id == sp_id)
+                         .values(number=number)
+                         .returning(SmokingPlace.id, SmokingPlace.number))
+                result = await session.execute(query)
+                smoking_place = result.first()
+                created = smoking_place is None
+
+                if created:
+                    query = (insert(SmokingPlace)
+                             .values(id=sp_id, number=number, sp_address=address_id)
+                             .on_conflict_do_update(index_elements=[SmokingPlace.id], set_={'number': number})
+                             .returning(SmokingPlace.id, SmokingPlace.number))
+                    result = await session.execute(query)
+                    smoking_place = result.first()
+
+                smoking_place_dto = SmokingPlaceWithoutAddressDTO.model_validate(smoking_place, from_attributes=True)
+                await commit_or_flush(session)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
-            return smoking_place_dto
+            return smoking_place_dto, created
 
     @staticmethod
-    async def get_all_smoking_places():
-        try:
-            async with async_session_factory() as session:
-                query = (select(SmokingPlace.id,
-                                SmokingPlace.number,
-                                SmokingPlaceAddress.city,
-                                SmokingPlaceAddress.street)
-                         .select_from(SmokingPlace)
-                         .join(SmokingPlace.address))
+    async def get_all_smoking_places(fields: list[str] | None = None, place: int | None = None,
+                                     address: int | None = None, city: str | None = None):
+        conditions = []
+
+        if place is not None:
+            conditions.append(SmokingPlace.id == place)
+        if address is not None:
+            conditions.append(SmokingPlace.sp_address == address)
+        if city is not None:
+            conditions.append(SmokingPlaceAddress.city == city)
+
+        query = smoking_places_query(fields, tuple(conditions))
+
+        async def from_shard(shard):
+            async with session_scope(shard=shard) as session:
                 result = await session.execute(query)
-                smoking_places = result.all()
-                smoking_places_dto = [SmokingPlaceDTO.model_validate(smoking_place, from_attributes=True)
-                                      for smoking_place in smoking_places]
-        except Exception as e:
-            print(e)
+                return result.all()
+
+        try:
+            smoking_places = list(chain.from_iterable(await on_shards(from_shard, shards_for(place, address, city))))
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
-            return smoking_places_dto
+            return smoking_places
 
     @staticmethod
     async def get_smoking_place(sp_id: int):
         try:
-            async with async_session_factory() as session:
+            async with session_scope(shard=shard_for_id(sp_id)) as session:
                 query = (select(SmokingPlace.id,
                                 SmokingPlace.number,
                                 SmokingPlaceAddress.city,
@@ -217,8 +546,8 @@ class SmokingPlaceQs:
                 smoking_place = result.first()
                 smoking_place_dto = SmokingPlaceDTO.model_validate(smoking_place,
                                                                    from_attributes=True) if smoking_place else []
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return smoking_place_dto
@@ -226,7 +555,7 @@ class SmokingPlaceQs:
     @staticmethod
     async def get_smoking_place_id(number: int, city: str, street: str):
         try:
-            async with async_session_factory() as session:
+            async with session_scope(shard=shard_for_city(city)) as session:
                 query = (select(SmokingPlace.id)
                          .join(SmokingPlace.address)
                          .where(and_(SmokingPlace.number == number,
@@ -234,8 +563,8 @@ class SmokingPlaceQs:
                                      SmokingPlaceAddress.street == street)))
                 result = await session.execute(query)
                 sp_id = result.first()
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return sp_id
@@ -243,28 +572,31 @@ class SmokingPlaceQs:
     @staticmethod
     async def delete_smoking_place(sp_id: int):
         try:
-            async with async_session_factory() as session:
-                query = delete(SmokingPlace).where(SmokingPlace.id == sp_id)
-                await session.execute(query)
-                await session.flush()
+            async with session_scope(write=True, shard=shard_for_id(sp_id)) as session:
+                if not await foreign_keys_enabled(session):
+                    query = delete(Reservation).where(Reservation.smoking_place == sp_id)
+                    await session.execute(query)
 
-                query = delete(Reservation).where(Reservation.smoking_place == sp_id)
+                    query = delete(PlaceOccupancy).where(PlaceOccupancy.smoking_place == sp_id)
+                    await session.execute(query)
+
+                query = delete(SmokingPlace).where(SmokingPlace.id == sp_id)
                 await session.execute(query)
-                await session.commit()
-        except Exception as e:
-            print(e)
+                await commit_or_flush(session)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
 
     @staticmethod
     async def get_sp_amount(address_id: int):
         try:
-            async with async_session_factory() as session:
+            async with session_scope(shard=shard_for_id(address_id)) as session:
                 query = (select(count(SmokingPlace.id).label('amount').cast(Integer))
                          .where(SmokingPlace.sp_address == address_id))
                 result = await session.execute(query)
                 amount = result.scalars().first()
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return amount
@@ -272,24 +604,22 @@ class SmokingPlaceQs:
     @staticmethod
     async def get_smoking_places_on_address(address_id: int):
         try:
-            async with async_session_factory() as session:
+            async with session_scope(shard=shard_for_id(address_id)) as session:
                 query = (select(SmokingPlace.id,
                                 SmokingPlace.number)
                          .where(SmokingPlace.sp_address == address_id))
                 result = await session.execute(query)
                 smoking_places = result.all()
-                smoking_places_dto = [SmokingPlaceWithoutAddressDTO.model_validate(smoking_place, from_attributes=True)
-                                      for smoking_place in smoking_places]
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
-            return smoking_places_dto
+            return smoking_places
 
     @staticmethod
     async def get_smoking_place_on_address(sp_id: int, address_id: int):
         try:
-            async with (async_session_factory() as session):
+            async with session_scope(shard=shard_for_id(address_id)) as session:
                 query = (select(SmokingPlace.id,
                                 SmokingPlace.number)
                          .where(and_(SmokingPlace.id == sp_id, SmokingPlace.sp_address == address_id)))
@@ -300,26 +630,8 @@ class SmokingPlaceQs:
                                                                                      from_attributes=True)
                 else:
                     smoking_place_dto = []
-        except Exception as e:
-            print(e)
-            raise DatabaseError()
-        else:
-            return smoking_place_dto
-
-    @staticmethod
-    async def update_smoking_place(number: int, sp_id: int):
-        try:
-            async with async_session_factory() as session:
-                query = (update(SmokingPlace)
-                         .where(SmokingPlace.id == sp_id)
-                         .values(number=number)
-                         .returning(SmokingPlace))
-                result = await session.execute(query)
-                smoking_place = result.scalars().first()
-                smoking_place_dto = SmokingPlaceWithoutAddressDTO.model_validate(smoking_place, from_attributes=True)
-                await session.commit()
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return smoking_place_dto
@@ -327,161 +639,174 @@ class SmokingPlaceQs:
     @staticmethod
     async def check_id(sp_id: int):
         try:
-            async with async_session_factory() as session:
+            async with session_scope(shard=shard_for_id(sp_id)) as session:
                 query = select(exists().where(SmokingPlace.id == sp_id))
                 result = await session.execute(query)
                 check = result.scalars().first()
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return check
 
 
+@traced_queries
 class ReservationQs:
     @staticmethod
-    async def get_status(sp_id: int):
-        try:
-            async with async_session_factory() as session:
-                query = select(Reservation.end).where(
-                    and_(Reservation.smoking_place == sp_id, between(
-                        datetime.now(), Reservation.start, Reservation.end)))
+    async def get_all_reservations(fields: list[str] | None = None, username: str | None = None, **filters):
+        async def from_shard(shard):
+            async with session_scope(shard=shard) as session:
                 result = await session.execute(query)
-                end_occupied = result.scalars().first()
-        except Exception as e:
-            print(e)
-            raise DatabaseError()
-        else:
-            return f'occupied until {end_occupied}' if end_occupied else 'free'
+                return result.all()
 
-    @staticmethod
-    async def get_all_reservations():
         try:
-            async with async_session_factory() as session:
-                query = (select(Reservation.id.label("reservation_id"),
-                                User.username.label("username"),
-                                SmokingPlace.number.label("sp_number"),
-                                SmokingPlaceAddress.city.label("city"),
-                                SmokingPlaceAddress.street.label("street"),
-                                Reservation.start.label("start").cast(String),
-                                Reservation.end.label("end").cast(String))
-                         .select_from(Reservation)
-                         .where(Reservation.end >= datetime.now())
-                         .join(Reservation.user_ref)
-                         .join(Reservation.sp_ref)
-                         .join(SmokingPlace.address))
-                result = await session.execute(query)
-                reservations = result.all()
-                reservations_dto = [ReservationDTO.model_validate(reservation, from_attributes=True)
-                                    for reservation in reservations]
-        except Exception as e:
-            print(e)
+            if username is not None:
+                filters['user'] = await UserQs.get_user_id(username)
+
+                if filters['user'] is None:
+                    return []
+
+            query = reservations_query(fields=fields, conditions=reservation_filters(**filters))
+            reservations = list(chain.from_iterable(await on_shards(from_shard, shards_for(
+                filters.get('place'), filters.get('address'), filters.get('city')))))
+            reservations = await with_usernames(reservations)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
-            return reservations_dto
+            return reservations
 
     @staticmethod
     async def check_time(user_id: int, sp_id: int, start: datetime, end: datetime):
+        overlaps = and_(Reservation.start_ts <= to_epoch(end), Reservation.end_ts >= to_epoch(start))
+        shard = shard_for_id(sp_id)
+
+        # reservations of the user in other cities are read apart from the write
+        # transaction, so one committed there at the same moment isn't seen
+        async def user_reservation(other):
+            async with session_scope(shard=other, detached=True) as session:
+                result = await session.execute(select(Reservation.start).where(Reservation.user == user_id, overlaps))
+                return result.scalars().first()
+
         try:
-            async with async_session_factory() as session:
+            async with session_scope(shard=shard) as session:
                 query = select(Reservation.start, Reservation.end).where(
                     and_(
                         or_(
                             Reservation.user == user_id,
                             Reservation.smoking_place == sp_id),
-                        or_(
-                            between(
-                                start, Reservation.start, Reservation.end),
-                            between(
-                                end, Reservation.start, Reservation.end)
-                        )
+                        overlaps
                     )
                 )
                 result = await session.execute(query)
                 reservation_time = result.scalars().first()
-        except Exception as e:
-            print(e)
+
+            if reservation_time is None:
+                others = [other for other in shards if other is not shard]
+                reservation_time = next(filter(None, await on_shards(user_reservation, others)), None)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return reservation_time
 
     @staticmethod
     async def add_reservation(user_id: int, sp_id: int, start: datetime, end: datetime):
+        shard = shard_for_id(sp_id)
+
         try:
-            async with async_session_factory() as session:
-                stmt = Reservation(user=user_id, smoking_place=sp_id, start=start, end=end)
+            async with session_scope(write=True, shard=shard) as session:
+                stmt = Reservation(id=await next_id(session, Reservation, shard),
+                                   user=user_id, smoking_place=sp_id, start=start, end=end,
+                                   start_ts=to_epoch(start), end_ts=to_epoch(end))
                 session.add(stmt)
-                await session.commit()
+                await commit_or_flush(session)
         except IntegrityError as e:
             raise UniqueError(e.orig.args[0])
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return stmt.id
 
     @staticmethod
-    async def put_reservation(res_id: int, user_id: int, sp_id: int, start: datetime, end: datetime):
+    async def upsert_reservation(res_id: int, user_id: int, sp_id: int, start: datetime, end: datetime):
+        shard = shard_for_id(sp_id)
+
+        if not shard.owns(res_id):
+            raise ShardError(f'Reservation id {res_id} is out of the id range of the city')
+
         try:
-            async with async_session_factory() as session:
-                stmt = Reservation(id=res_id, user=user_id, smoking_place=sp_id, start=start, end=end)
-                session.add(stmt)
-                await session.commit()
-        except Exception as e:
-            print(e)
-            raise DatabaseError()
-
-    @staticmethod
-    async def get_user_reservations(user_id: int):
-        try:
-            async with async_session_factory() as session:
-                query = (select(Reservation.id.label("reservation_id"),
-                                User.username.label("username"),
-                                SmokingPlace.number.label("sp_number"),
-                                SmokingPlaceAddress.city.label("city"),
-                                SmokingPlaceAddress.street.label("street"),
-                                Reservation.start.label("start").cast(String),
-                                Reservation.end.label("end").cast(String))
-                         .select_from(Reservation)
-                         .where(and_(Reservation.user == user_id,
-                                     Reservation.end >= datetime.now()))
-                         .join(Reservation.user_ref)
-                         .join(Reservation.sp_ref)
-                         .join(SmokingPlace.address))
+            async with session_scope(write=True, shard=shard) as session:
+                # the place the reservation moves from needs its occupancy resynced too
+                query = (select(Reservation.smoking_place)
+                         .where(and_(Reservation.id == res_id, Reservation.user == user_id)))
+                result = await session.execute(query)
+                previous_sp_id = result.scalars().first()
+
+                values = {'smoking_place': sp_id, 'start': start, 'end': end,
+                          'start_ts': to_epoch(start), 'end_ts': to_epoch(end)}
+                returning = (Reservation.id.label("reservation_id"),
+                             Reservation.start.label("start").cast(String),
+                             Reservation.end.label("end").cast(String))
+                query = (update(Reservation)
+                         .where(and_(Reservation.id == res_id, Reservation.user == user_id))
+                         .values(**values)
+                         .returning(*returning))
+                result = await session.execute(query)
+                reservation = result.first()
+                created = reservation is None
+
+                if created:
+                    query = (insert(Reservation)
+                             .values(id=res_id, user=user_id, **values)
+                             .on_conflict_do_update(index_elements=[Reservation.id],
+                                                    set_=values,
+                                                    where=Reservation.user == user_id)
+                             .returning(*returning))
+                    result = await session.execute(query)
+                    reservation = result.first()
+
+                await commit_or_flush(session)
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
+        else:
+            return reservation, created, previous_sp_id
+
+    @staticmethod
+    async def get_user_reservations(user_id: int, fields: list[str] | None = None, **filters):
+        query = reservations_query(with_username=False, fields=fields,
+                                   conditions=reservation_filters(user=user_id, **filters))
+
+        async def from_shard(shard):
+            async with session_scope(shard=shard) as session:
                 result = await session.execute(query)
-                user_reservations = result.all()
-                user_reservations_dto = [ReservationDTO.model_validate(user_reservation, from_attributes=True)
-                                         for user_reservation in user_reservations]
-        except Exception as e:
-            print(e)
+                return result.all()
+
+        try:
+            user_reservations = list(chain.from_iterable(await on_shards(from_shard, shards_for(
+                filters.get('place'), filters.get('address'), filters.get('city')))))
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
-            return user_reservations_dto
+            return user_reservations
 
     @staticmethod
     async def get_user_reservation(user_id: int, res_id: int):
         try:
-            async with async_session_factory() as session:
-                query = (select(Reservation.id.label("reservation_id"),
-                                User.username.label("username"),
-                                SmokingPlace.number.label("sp_number"),
-                                SmokingPlaceAddress.city.label("city"),
-                                SmokingPlaceAddress.street.label("street"),
-                                Reservation.start.label("start").cast(String),
-                                Reservation.end.label("end").cast(String))
-                         .select_from(Reservation)
-                         .where(and_(Reservation.user == user_id, Reservation.id == res_id))
-                         .join(Reservation.user_ref)
-                         .join(Reservation.sp_ref)
-                         .join(SmokingPlace.address))
+            async with session_scope(shard=shard_for_id(res_id)) as session:
+                query = reservations_query().where(and_(Reservation.user == user_id, Reservation.id == res_id))
                 result = await session.execute(query)
                 user_reservation = result.first()
                 if user_reservation:
+                    user_reservation, = await with_usernames([user_reservation])
                     user_reservation_dto = ReservationDTO.model_validate(user_reservation, from_attributes=True)
                 else:
                     user_reservation_dto = []
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return user_reservation_dto
@@ -489,101 +814,239 @@ class ReservationQs:
     @staticmethod
     async def get_reservation_admin(res_id: int):
         try:
-            async with async_session_factory() as session:
-                query = (select(Reservation.id.label("reservation_id"),
-                                User.username.label("username"),
-                                SmokingPlace.number.label("sp_number"),
-                                SmokingPlaceAddress.city.label("city"),
-                                SmokingPlaceAddress.street.label("street"),
-                                Reservation.start.label("start").cast(String),
-                                Reservation.end.label("end").cast(String))
-                         .select_from(Reservation)
-                         .where(Reservation.id == res_id)
-                         .join(Reservation.user_ref)
-                         .join(Reservation.sp_ref)
-                         .join(SmokingPlace.address))
+            async with session_scope(shard=shard_for_id(res_id)) as session:
+                query = reservations_query().where(Reservation.id == res_id)
                 result = await session.execute(query)
                 user_reservation = result.first()
                 if user_reservation:
+                    user_reservation, = await with_usernames([user_reservation])
                     user_reservation_dto = ReservationDTO.model_validate(user_reservation, from_attributes=True)
                 else:
                     user_reservation_dto = []
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return user_reservation_dto
 
-    @staticmethod
-    async def update_user_reservation(res_id: int, sp_id: int, start: datetime, end: datetime):
-        try:
-            async with async_session_factory() as session:
-                query = (update(Reservation).where(Reservation.id == res_id)
-                         .values(smoking_place=sp_id, start=start, end=end))
-                await session.execute(query)
-                await session.commit()
-        except Exception as e:
-            print(e)
-            raise DatabaseError()
-
     @staticmethod
     async def delete_reservation(res_id: int, user_id: int):
         try:
-            async with async_session_factory() as session:
-                query = delete(Reservation).where(and_(Reservation.id == res_id, Reservation.user == user_id))
-                await session.execute(query)
-                await session.commit()
-        except Exception as e:
-            print(e)
+            async with session_scope(write=True, shard=shard_for_id(res_id)) as session:
+                query = delete(Reservation).where(and_(Reservation.id == res_id, Reservation.user == user_id)).returning(Reservation.smoking_place)
+                result = await session.execute(query)
+                sp_id = result.scalars().first()
+                await commit_or_flush(session)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
+        else:
+            return sp_id
 
     @staticmethod
     async def delete_reservation_admin(res_id: int):
         try:
-            async with async_session_factory() as session:
-                query = delete(Reservation).where(Reservation.id == res_id)
-                await session.execute(query)
-                await session.commit()
-        except Exception as e:
-            print(e)
+            async with session_scope(write=True, shard=shard_for_id(res_id)) as session:
+                query = delete(Reservation).where(Reservation.id == res_id).returning(Reservation.smoking_place)
+                result = await session.execute(query)
+                sp_id = result.scalars().first()
+                await commit_or_flush(session)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
+        else:
+            return sp_id
 
     @staticmethod
     async def check_id(res_id: int):
         try:
-            async with async_session_factory() as session:
+            async with session_scope(shard=shard_for_id(res_id)) as session:
                 query = select(exists().where(Reservation.id == res_id))
                 result = await session.execute(query)
                 check = result.scalars().first()
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return check
 
 
+@traced_queries
+class PlaceOccupancyQs:
+    @staticmethod
+    async def sync(sp_ids: list[int] | None = None, on_commit=None, shard=None):
+        """Recompute the occupancy of `sp_ids`, or of every place of `shard` (of
+        all shards). `on_commit(occupancy, sp_ids, shard)` is called as the
+        transaction of each shard commits."""
+
+        if sp_ids is not None:
+            groups = group_by_shard(sp_ids).items()
+        else:
+            groups = [(target, None) for target in ([shard] if shard is not None else shards)]
+
+        occupancy = []
+
+        try:
+            # one after another, in the order every writer takes the shards
+            for target, target_sp_ids in groups:
+                async with session_scope(write=True, shard=target) as session:
+                    query = insert(PlaceOccupancy).from_select(['smoking_place', 'reservation', 'end', 'end_ts'],
+                                                               occupancy_query(now_epoch(), target_sp_ids))
+                    query = (query
+                             .on_conflict_do_update(index_elements=[PlaceOccupancy.smoking_place],
+                                                    set_={'reservation': query.excluded.reservation,
+                                                          'end': query.excluded.end,
+                                                          'end_ts': query.excluded.end_ts})
+                             .returning(PlaceOccupancy.smoking_place, PlaceOccupancy.reservation,
+                                        PlaceOccupancy.end, PlaceOccupancy.end_ts))
+                    result = await session.execute(query)
+                    rows = result.all()
+
+                    if on_commit:
+                        after_commit(session, partial(on_commit, rows, target_sp_ids, target))
+
+                    await commit_or_flush(session)
+                    occupancy += rows
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
+        else:
+            return occupancy
+
+    @staticmethod
+    async def get_occupancy():
+        now = now_epoch()
+
+        async def from_shard(shard):
+            async with session_scope(shard=shard) as session:
+                result = await session.execute(occupancy_query(now))
+                return result.all()
+
+        try:
+            occupancy = list(chain.from_iterable(await on_shards(from_shard)))
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
+        else:
+            return occupancy
+
+    @staticmethod
+    async def get_boundaries(start: int, end: int):
+        query = (select(Reservation.smoking_place, Reservation.start_ts, Reservation.end_ts)
+                 .where(or_(Reservation.start_ts.between(start, end),
+                            Reservation.end_ts.between(start, end))))
+
+        async def from_shard(shard):
+            async with session_scope(shard=shard) as session:
+                result = await session.execute(query)
+                return result.all()
+
+        try:
+            boundaries = list(chain.from_iterable(await on_shards(from_shard)))
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
+        else:
+            return boundaries
+
+
+@traced_queries
+class AnalyticsQs:
+    @staticmethod
+    async def get_places():
+        query = (select(SmokingPlace.id, SmokingPlace.number, SmokingPlace.sp_address,
+                        SmokingPlaceAddress.city, SmokingPlaceAddress.street)
+                 .join(SmokingPlace.address)
+                 .order_by(SmokingPlace.id))
+
+        async def from_shard(shard):
+            async with session_scope(shard=shard) as session:
+                result = await session.execute(query)
+                return result.all()
+
+        # the id ranges of the shards follow their order, so the places stay sorted by id
+        try:
+            places = list(chain.from_iterable(await on_shards(from_shard)))
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
+        else:
+            return places
+
+    @staticmethod
+    async def get_intervals(start: int, end: int):
+        # one comma-separated string per column instead of a row object per
+        # reservation; the aggregates see the rows in the same order
+        query = (select(func.group_concat(Reservation.smoking_place),
+                        func.group_concat(Reservation.start_ts),
+                        func.group_concat(Reservation.end_ts))
+                 .where(and_(Reservation.start_ts < end, Reservation.end_ts > start)))
+
+        async def from_shard(shard):
+            async with session_scope(shard=shard) as session:
+                result = await session.execute(query)
+                return result.one()
+
+        try:
+            intervals = tuple(','.join(filter(None, column)) for column in zip(*await on_shards(from_shard)))
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
+        else:
+            return intervals
+
+
+@traced_queries
 class SmokingPlaceAddressQs:
     @staticmethod
     async def get_all_addresses():
+        query = select(SmokingPlaceAddress.id.label('id'),
+                       SmokingPlaceAddress.city.label('city'),
+                       SmokingPlaceAddress.street.label('street'))
+
+        async def from_shard(shard):
+            async with session_scope(shard=shard) as session:
+                result = await session.execute(query)
+                return result.all()
+
         try:
-            async with async_session_factory() as session:
-                query = select(SmokingPlaceAddress.id.label('id'),
-                               SmokingPlaceAddress.city.label('city'),
-                               SmokingPlaceAddress.street.label('street'))
+            addresses = list(chain.from_iterable(await on_shards(from_shard)))
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
+        else:
+            return addresses
+
+    @staticmethod
+    async def search_addresses(terms: str, limit: int):
+        async def from_shard(shard):
+            async with session_scope(shard=shard) as session:
+                matches = await search_candidates(session, address_search, terms)
+                query = (select(SmokingPlaceAddress.id, SmokingPlaceAddress.city, SmokingPlaceAddress.street,
+                                matches.c.rank)
+                         .select_from(matches)
+                         .join(SmokingPlaceAddress, SmokingPlaceAddress.id == matches.c.rowid)
+                         .order_by(matches.c.rank)
+                         .limit(limit))
                 result = await session.execute(query)
-                addresses = result.all()
-                addresses_dto = [SmokingPlaceAddressDTO.model_validate(address, from_attributes=True)
-                                 for address in addresses]
-        except Exception as e:
-            print(e)
+                return result.all()
+
+        # bm25 ranks of different shards are only roughly comparable, as each
+        # index weighs the words by its own statistics; unranked ones come last
+        try:
+            ranked = heapq.merge(*await on_shards(from_shard), key=lambda address: address.rank)
+            row = row_type(('id', 'city', 'street'))
+            addresses = [row._make(address[:-1]) for address in islice(ranked, limit)]
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
-            return addresses_dto
+            return addresses
 
     @staticmethod
     async def get_address(address_id: int):
         try:
-            async with async_session_factory() as session:
+            async with session_scope(shard=shard_for_id(address_id)) as session:
                 query = (select(SmokingPlaceAddress.id.label('id'),
                                 SmokingPlaceAddress.city.label('city'),
                                 SmokingPlaceAddress.street.label('street'))
@@ -591,90 +1054,240 @@ class SmokingPlaceAddressQs:
                 result = await session.execute(query)
                 address = result.first()
                 address_dto = SmokingPlaceAddressDTO.model_validate(address, from_attributes=True) if address else []
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return address_dto
 
     @staticmethod
     async def add_address(city: str, street: str):
+        shard = shard_for_city(city)
+
         try:
-            async with async_session_factory() as session:
-                stmt = SmokingPlaceAddress(city=city, street=street)
+            async with session_scope(write=True, shard=shard) as session:
+                stmt = SmokingPlaceAddress(id=await next_id(session, SmokingPlaceAddress, shard), city=city,
+                                           street=street)
                 session.add(stmt)
-                await session.commit()
+                await commit_or_flush(session)
                 address_dto = SmokingPlaceAddressDTO.model_validate(stmt, from_attributes=True)
         except IntegrityError as e:
             raise UniqueError(e.orig.args[0])
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return address_dto
 
     @staticmethod
-    async def put_address(address_id: int, city: str, street: str):
-        try:
-            async with async_session_factory() as session:
-                stmt = SmokingPlaceAddress(id=address_id, city=city, street=street)
-                session.add(stmt)
-                await session.commit()
-                address_dto = SmokingPlaceAddressDTO.model_validate(stmt, from_attributes=True)
-        except Exception as e:
-            print(e)
-            raise DatabaseError()
-        else:
-            return address_dto
+    async def upsert_address(address_id: int, city: str, street: str):
+        shard = shard_for_city(city)
+
+        if not shard.owns(address_id):
+            raise ShardError(f'Address id {address_id} is out of the id range of {city}')
 
-    @staticmethod
-    async def update_address(address_id: int, city: str, street: str):
         try:
-            async with async_session_factory() as session:
+            async with session_scope(write=True, shard=shard) as session:
                 query = (update(SmokingPlaceAddress)
                          .where(SmokingPlaceAddress.id == address_id)
                          .values(city=city, street=street)
-                         .returning(SmokingPlaceAddress))
+                         .returning(SmokingPlaceAddress.id, SmokingPlaceAddress.city, SmokingPlaceAddress.street))
                 result = await session.execute(query)
-                address = result.scalars().first()
-                address_dto = SmokingPlaceAddressDTO.model_validate(address, from_attributes=True) if address else []
-                await session.commit()
-        except Exception as e:
-            print(e)
+                address = result.first()
+                created = address is None
+
+                if created:
+                    query = (insert(SmokingPlaceAddress)
+                             .values(id=address_id, city=city, street=street)
+                             .on_conflict_do_update(index_elements=[SmokingPlaceAddress.id],
+                                                    set_={'city': city, 'street': street})
+                             .returning(SmokingPlaceAddress.id, SmokingPlaceAddress.city, SmokingPlaceAddress.street))
+                    result = await session.execute(query)
+                    address = result.first()
+
+                address_dto = SmokingPlaceAddressDTO.model_validate(address, from_attributes=True)
+                await commit_or_flush(session)
+        except IntegrityError as e:
+            raise UniqueError(e.orig.args[0])
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
-            return address_dto
+            return address_dto, created
 
     @staticmethod
-    async def delete_address(address_id: int):
+    async def delete_address(address_id: int) -> list[int]:
+        """Delete the address with its places, returns the ids of the places."""
+
         try:
-            async with async_session_factory() as session:
-                query = delete(SmokingPlaceAddress).where(SmokingPlaceAddress.id == address_id)
-                await session.execute(query)
-                await session.flush()
+            async with session_scope(write=True, shard=shard_for_id(address_id)) as session:
+                sp_ids = select(SmokingPlace.id).where(SmokingPlace.sp_address == address_id)
+                result = await session.execute(sp_ids)
+                deleted_sp_ids = result.scalars().all()
 
-                query = delete(SmokingPlace).where(SmokingPlace.sp_address == address_id).returning(SmokingPlace.id)
-                result = await session.execute(query)
-                sp_ids = result.scalars().all()
-                await session.flush()
+                if not await foreign_keys_enabled(session):
+                    query = delete(Reservation).where(Reservation.smoking_place.in_(sp_ids))
+                    await session.execute(query)
 
-                for sp_id in sp_ids:
-                    query = delete(Reservation).where(Reservation.smoking_place == sp_id)
+                    query = delete(PlaceOccupancy).where(PlaceOccupancy.smoking_place.in_(sp_ids))
                     await session.execute(query)
-                await session.commit()
-        except Exception as e:
-            print(e)
+
+                    query = delete(SmokingPlace).where(SmokingPlace.sp_address == address_id)
+                    await session.execute(query)
+
+                query = delete(SmokingPlaceAddress).where(SmokingPlaceAddress.id == address_id)
+                await session.execute(query)
+                await commit_or_flush(session)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
+        else:
+            return deleted_sp_ids
 
     @staticmethod
     async def check_id(address_id: int):
         try:
-            async with async_session_factory() as session:
+            async with session_scope(shard=shard_for_id(address_id)) as session:
                 query = select(exists().where(SmokingPlaceAddress.id == address_id))
                 result = await session.execute(query)
                 check = result.scalars().first()
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Query failed')
             raise DatabaseError()
         else:
             return check
+
+
+@traced_queries
+class AuditQs:
+    @staticmethod
+    async def add_events(events: list[dict]):
+        try:
+            async with session_scope(write=True) as session:
+                await session.execute(insert(AuditEvent), events)
+                await commit_or_flush(session)
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
+
+    @staticmethod
+    async def get_events(limit: int, before: int | None = None, actor: int | None = None, action: str | None = None,
+                         target: str | None = None, start: datetime | None = None, end: datetime | None = None):
+        conditions = []
+
+        if before is not None:
+            conditions.append(AuditEvent.id < before)
+        if actor is not None:
+            conditions.append(AuditEvent.actor == actor)
+        if action is not None:
+            conditions.append(AuditEvent.action == action)
+        if target is not None:
+            conditions.append(AuditEvent.target == target)
+        if start is not None:
+            conditions.append(AuditEvent.created >= start)
+        if end is not None:
+            conditions.append(AuditEvent.created <= end)
+
+        try:
+            async with session_scope() as session:
+                query = (select(AuditEvent.id, AuditEvent.created, AuditEvent.actor, AuditEvent.action,
+                                AuditEvent.target, AuditEvent.details)
+                         .where(*conditions)
+                         .order_by(AuditEvent.id.desc())
+                         .limit(limit))
+                result = await session.execute(query)
+                events = result.all()
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
+        else:
+            return events
+
+
+@traced_queries
+class IdempotencyQs:
+    @staticmethod
+    async def claim(user_id: int, key: str, fingerprint: str, now: int, ttl: float):
+        """The stored response of the key, or None after claiming it for the
+        current request: the key is written with the request's unit of work and
+        committed together with its response, which `complete` stores there."""
+
+        try:
+            # the request holds the write lock of the shard from here on, a request
+            # with the same key in any worker waits for it and then finds the response
+            async with session_scope(write=True) as session:
+                query = (select(IdempotencyKey.fingerprint, IdempotencyKey.status, IdempotencyKey.body,
+                                IdempotencyKey.content_type)
+                         .where(IdempotencyKey.user == user_id, IdempotencyKey.key == key,
+                                IdempotencyKey.created > now - ttl))
+                result = await session.execute(query)
+                existing = result.first()
+
+                if existing is None:
+                    query = insert(IdempotencyKey).values(user=user_id, key=key, fingerprint=fingerprint, created=now)
+                    query = query.on_conflict_do_update(index_elements=[IdempotencyKey.user, IdempotencyKey.key],
+                                                        set_={'fingerprint': fingerprint, 'status': None,
+                                                              'body': None, 'content_type': None, 'created': now})
+                    await session.execute(query)
+
+                await commit_or_flush(session)
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
+        else:
+            return existing
+
+    @staticmethod
+    async def complete(user_id: int, key: str, status: int, body: bytes, content_type: str):
+        try:
+            async with session_scope(write=True) as session:
+                await session.execute(update(IdempotencyKey)
+                                      .where(IdempotencyKey.user == user_id, IdempotencyKey.key == key)
+                                      .values(status=status, body=body, content_type=content_type))
+                await commit_or_flush(session)
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
+
+    @staticmethod
+    async def evict(now: int, ttl: float, max_keys: int) -> int:
+        """Delete the keys older than `ttl` seconds, then the oldest ones beyond `max_keys`."""
+
+        try:
+            async with session_scope(write=True) as session:
+                result = await session.execute(delete(IdempotencyKey).where(IdempotencyKey.created <= now - ttl))
+                evicted = result.rowcount
+
+                query = (select(IdempotencyKey.created)
+                         .order_by(IdempotencyKey.created.desc())
+                         .offset(max_keys)
+                         .limit(1))
+                result = await session.execute(query)
+                newest_evicted = result.scalar()
+
+                if newest_evicted is not None:
+                    result = await session.execute(delete(IdempotencyKey)
+                                                   .where(IdempotencyKey.created <= newest_evicted))
+                    evicted += result.rowcount
+
+                await commit_or_flush(session)
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
+        else:
+            return evicted
+
+
+@traced_queries
+class ServiceQs:
+    @staticmethod
+    async def ping():
+        async def from_shard(shard):
+            async with session_scope(shard=shard) as session:
+                await session.execute(select(literal(1)))
+
+        try:
+            await on_shards(from_shard)
+        except Exception:
+            logger.exception('Query failed')
+            raise DatabaseError()
@@ -1,16 +1,16 @@
 from json import JSONDecodeError
 
-from aiohttp import BasicAuth
 from aiohttp.web_response import json_response
 
-from src.database.db_queries import UserQs
 from src.exceptions import DatabaseError
+from src.tracing import span
 
 
 def validate_user_data(func):
     async def wrapper(request, *args, **kwargs):
         try:
-            return await func(request, *args, **kwargs)
+            with span(func.__name__):
+                return await func(request, *args, **kwargs)
         except DatabaseError as e:
             return json_response(status=500, data={'error': 'Internal server error'})
     return wrapper
@@ -19,14 +19,11 @@ def validate_user_data(func):
 def validate_admin_data(func):
     async def wrapper(request, *args, **kwargs):
         try:
-            auth_header = request.headers.get('Authorization')
-            username, password, encoding = BasicAuth.decode(auth_header)
-            role = await UserQs.get_user_role(username)
-
-            if role != 'admin':
+            if request['user'].role != 'admin':
                 return json_response(status=403, data={'error': 'Access denied'})
 
-            return await func(request, *args, **kwargs)
+            with span(func.__name__):
+                return await func(request, *args, **kwargs)
         except DatabaseError as e:
             return json_response(status=500, data={'error': 'Internal server error'})
     return wrapper
@@ -35,9 +32,18 @@ def validate_admin_data(func):
 def validate_json(func):
     async def wrapper(request, *args, **kwargs):
         try:
-            await request.json()
+            with span('parse_json'):
+                await request.json()
         except JSONDecodeError:
             return json_response(status=400, data={'error': 'Invalid JSON data'})
         else:
             return await func(request, *args, **kwargs)
     return wrapper
+
+
+def deadline(seconds: float):
+    """Override REQUEST_DEADLINE for a route, 0 disables it. Goes right under the route decorator."""
+    def decorator(func):
+        func.deadline = seconds
+        return func
+    return decorator
@@ -12,3 +12,9 @@ class DatabaseError(CustomExceptionBase):
     pass
 
 
+class ShardError(CustomExceptionBase):
+    pass
+
+
+class WriteQueueFull(CustomExceptionBase):
+    pass
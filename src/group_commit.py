@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from contextvars import Context
+from datetime import datetime
+
+from src import metrics
+from src.config import GROUP_COMMIT_WINDOW, GROUP_COMMIT_MAX_BATCH
+from src.database.db_conn import RequestScope, bind_request_scope, unbind_request_scope, shard_for_id
+from src.database.db_queries import ReservationQs
+from src.exceptions import DatabaseError, UniqueError
+from src.occupancy import place_occupancy
+
+logger = logging.getLogger(__name__)
+
+
+class ReservationBatcher:
+    """Group commit for new reservations.
+
+    Reservations of one shard submitted within `window` seconds of each other
+    (at most `max_batch` of them) are checked and inserted one after another in
+    a single write transaction, so each sees the ones accepted before it, and
+    they share one commit. Callers get their results only after that commit.
+
+    If the batch transaction fails, its reservations are retried one per
+    transaction, so one bad reservation doesn't fail the others.
+    """
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = {}
+        self.timers = {}
+        self.tasks = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    async def submit(self, user_id: int, sp_id: int, start: datetime, end: datetime):
+        """The new reservation row, or None if it conflicts with an existing one."""
+
+        future = asyncio.get_running_loop().create_future()
+        shard = shard_for_id(sp_id).index
+        batch = self.pending.setdefault(shard, [])
+        batch.append(((user_id, sp_id, start, end), future))
+
+        if len(batch) >= self.max_batch:
+            self._flush(shard)
+        elif shard not in self.timers:
+            # the batch must not run in the context of the request that opened it
+            self.timers[shard] = asyncio.get_running_loop().call_later(self.window, self._flush, shard,
+                                                                       context=Context())
+
+        return await future
+
+    def _flush(self, shard: int):
+        timer = self.timers.pop(shard, None)
+
+        if timer is not None:
+            timer.cancel()
+
+        batch = self.pending.pop(shard, [])
+
+        task = asyncio.create_task(self._commit(batch), context=Context())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    @staticmethod
+    async def _reserve(user_id: int, sp_id: int, start: datetime, end: datetime):
+        if await ReservationQs.check_time(user_id, sp_id, start, end):
+            return None
+
+        reservation_id = await ReservationQs.add_reservation(user_id, sp_id, start, end)
+
+        return await ReservationQs.get_user_reservation(user_id, reservation_id)
+
+    async def _commit(self, batch: list):
+        scope = RequestScope(write=True)
+        token = bind_request_scope(scope)
+
+        try:
+            results = [await self._reserve(*reservation) for reservation, _ in batch]
+            await place_occupancy.sync(sorted({int(sp_id) for (_, sp_id, _, _), _ in batch}))
+            await scope.close(commit=True)
+        except Exception as e:
+            await scope.close(commit=False)
+
+            if len(batch) > 1:
+                metrics.inc('group_commit.retried', len(batch))
+                for entry in batch:
+                    await self._commit([entry])
+                return
+
+            if not isinstance(e, (DatabaseError, UniqueError)):
+                logger.exception('Group commit failed')
+                e = DatabaseError()
+
+            _, future = batch[0]
+            if not future.done():
+                future.set_exception(e)
+            return
+        finally:
+            unbind_request_scope(token)
+
+        metrics.inc('group_commit.batches')
+        metrics.inc('group_commit.reservations', len(batch))
+
+        for ((_, sp_id, start, end), future), reservation in zip(batch, results):
+            if reservation:
+                place_occupancy.schedule(sp_id, start, end)
+
+            if not future.done():
+                future.set_result(reservation)
+
+
+reservation_batcher = ReservationBatcher(GROUP_COMMIT_WINDOW, GROUP_COMMIT_MAX_BATCH)
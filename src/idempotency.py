@@ -0,0 +1,91 @@
+import asyncio
+import hashlib
+import time
+
+from aiohttp import web
+from aiohttp.web_response import json_response
+
+from src import metrics
+from src.config import IDEMPOTENCY_TTL, IDEMPOTENCY_MAX_KEYS, IDEMPOTENCY_EVICT_INTERVAL
+from src.database.db_queries import IdempotencyQs
+from src.exceptions import DatabaseError
+
+MAX_KEY_LENGTH = 255
+
+
+def idempotent(func):
+    """Replay the stored response of a request repeated with the same
+    Idempotency-Key header by the same user, without running the handler again.
+
+    Keys and responses are kept in the idempotency_key table, so every worker
+    sees them. The key is claimed in the request's unit of work and its response
+    is stored there too, so both are committed with the request's writes or not
+    at all; a repeat waits for the write lock the request holds meanwhile. Only
+    responses below 500 are stored. The same key with another method, path or
+    body is refused.
+    """
+
+    async def wrapper(request, *args, **kwargs):
+        idempotency_key = request.headers.get('Idempotency-Key')
+
+        if idempotency_key is None:
+            return await func(request, *args, **kwargs)
+
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            return json_response(status=400, data={"error": f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} "
+                                                            f"characters long"})
+
+        user_id = request['user'].id
+        digest = hashlib.sha256(await request.read()).hexdigest()
+        fingerprint = f'{request.method} {request.path} {digest}'
+
+        try:
+            stored = await IdempotencyQs.claim(user_id, idempotency_key, fingerprint, int(time.time()),
+                                               IDEMPOTENCY_TTL)
+
+            if stored is not None:
+                # only outside a unit of work can a claim be seen before its response
+                if stored.status is None:
+                    return json_response(status=409, data={"error": "A request with this Idempotency-Key is in "
+                                                                    "progress"})
+
+                if stored.fingerprint != fingerprint:
+                    metrics.inc('idempotency.mismatches')
+                    return json_response(status=422, data={"error": "The Idempotency-Key was used for another "
+                                                                    "request"})
+
+                metrics.inc('idempotency.replays')
+                return web.Response(status=stored.status, body=stored.body, content_type=stored.content_type,
+                                    headers={'Idempotency-Replayed': 'true'})
+
+            response = await func(request, *args, **kwargs)
+
+            # a response of 500 or above rolls the unit of work back, claim included
+            if response.status < 500:
+                await IdempotencyQs.complete(user_id, idempotency_key, response.status, response.body or b'',
+                                             response.content_type)
+                metrics.inc('idempotency.stored')
+        except DatabaseError:
+            return json_response(status=500, data={'error': 'Internal server error'})
+
+        return response
+    return wrapper
+
+
+async def _evict_periodically():
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_EVICT_INTERVAL)
+
+        try:
+            metrics.inc('idempotency.evicted', await IdempotencyQs.evict(int(time.time()), IDEMPOTENCY_TTL,
+                                                                         IDEMPOTENCY_MAX_KEYS))
+        except DatabaseError:
+            metrics.inc('idempotency.errors')
+
+
+async def run_idempotency(app):
+    task = asyncio.create_task(_evict_periodically())
+
+    yield
+
+    task.cancel()
@@ -0,0 +1,153 @@
+import json
+import logging
+import queue
+import sys
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+from src import metrics
+from src.config import LOG_LEVEL, LOG_QUEUE_SIZE, LOG_RATE_LIMIT, LOG_RATE_WINDOW
+
+_request_context = ContextVar('request_context', default=(None, None))
+_query = ContextVar('query', default=None)
+_queue = queue.Queue(LOG_QUEUE_SIZE)
+
+CONTEXT_FIELDS = ('request_id', 'route', 'query', 'suppressed')
+
+
+def bind_request(request_id: str, route: str):
+    return _request_context.set((request_id, route))
+
+
+def unbind_request(token):
+    _request_context.reset(token)
+
+
+def bind_query(name: str):
+    return _query.set(name)
+
+
+def unbind_query(token):
+    _query.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Tags records with the request and the query they were logged in, and lets through at
+    most `limit` records of the same error per `window` seconds. The next one
+    let through tells how many were suppressed."""
+
+    def __init__(self, limit: int, window: float):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.seen = {}
+
+    def filter(self, record):
+        record.request_id, record.route = _request_context.get()
+        record.query = getattr(record, 'query', None) or _query.get()
+
+        error = record.exc_info[1] if record.exc_info else None
+        key = (record.name, record.msg, getattr(record, 'query', None), type(error), str(error))
+        now = time.monotonic()
+
+        if len(self.seen) > 1000:
+            self.seen = {key: seen for key, seen in self.seen.items() if now - seen[0] < self.window}
+
+        started, count, suppressed = self.seen.get(key, (now, 0, 0))
+
+        if now - started >= self.window:
+            started, count = now, 0
+
+        if count >= self.limit:
+            self.seen[key] = (started, count, suppressed + 1)
+            metrics.inc('log.suppressed')
+            return False
+
+        if suppressed:
+            record.suppressed = suppressed
+
+        self.seen[key] = (started, count + 1, 0)
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records over to the logging thread. When it falls behind, records
+    are dropped (log.dropped) instead of making the event loop wait."""
+
+    def prepare(self, record):
+        # the record stays in this process, so the traceback is formatted by the logging thread
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc('log.dropped')
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'worker': metrics.worker_id,
+            'pid': record.process,
+        }
+
+        for name in CONTEXT_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+
+        if record.exc_info:
+            entry['error'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class LogListener(QueueListener):
+    def enqueue_sentinel(self):
+        # on shutdown, waits for room instead of failing on a full queue
+        self.queue.put(self._sentinel)
+
+
+def setup_logging():
+    """Send the records of every logger through the queue."""
+
+    root = logging.getLogger()
+
+    if not any(isinstance(handler, DroppingQueueHandler) for handler in root.handlers):
+        handler = DroppingQueueHandler(_queue)
+        handler.addFilter(ContextFilter(LOG_RATE_LIMIT, LOG_RATE_WINDOW))
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+
+
+async def run_logging(app):
+    """Write the queued records as JSON lines to stdout from a thread of this
+    worker (threads don't survive the fork of the workers)."""
+
+    setup_logging()
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    listener = LogListener(_queue, output)
+    listener.start()
+
+    yield
+
+    listener.stop()
+
+    # nothing reads the queue anymore: what the worker still logs, why it failed to start for one, goes directly
+    root = logging.getLogger()
+    for handler in [handler for handler in root.handlers if isinstance(handler, DroppingQueueHandler)]:
+        root.removeHandler(handler)
+    root.addHandler(output)
+
+
+metrics.register_gauge('log.queue', _queue.qsize)
@@ -0,0 +1,147 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from bisect import bisect_left
+
+from src import metrics
+from src.config import LOOP_LAG_INTERVAL, LOOP_BLOCK_THRESHOLD, LOOP_STACK_DEPTH, LOOP_BLOCKING_SITES
+
+# upper bounds of the lag histogram buckets, in milliseconds
+LAG_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class LoopMonitor:
+    """Measures how late the event loop of this worker wakes up from a sleep of
+    `interval` seconds, the time any callback in between kept it busy.
+
+    A watchdog thread checks that the loop keeps ticking. When it is stuck for
+    more than `threshold` seconds the thread takes the stack of the loop thread
+    (the blocking call itself, unlike asyncio debug mode, which only names the
+    callback afterwards and slows down every one of them) and files it under
+    its innermost frame in our code. The time the loop then turns out to have
+    been blocked is added to that site; `sites` of them are kept, the ones that
+    blocked the loop the least are forgotten first.
+    """
+
+    def __init__(self, interval: float, threshold: float, depth: int, sites: int):
+        self.interval = interval
+        self.threshold = threshold
+        self.depth = depth
+        self.max_sites = sites
+        self.buckets = [0] * (len(LAG_BUCKETS) + 1)
+        self.lag_count = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.last_lag = 0.0
+        self.sites = {}
+        self.beat = time.monotonic()
+        self.episode = None
+        self.loop_thread = None
+        self.stopped = threading.Event()
+
+    def _record_lag(self, lag: float):
+        self.buckets[bisect_left(LAG_BUCKETS, lag * 1000)] += 1
+        self.lag_count += 1
+        self.lag_total += lag
+        self.lag_max = max(self.lag_max, lag)
+        self.last_lag = lag
+
+        if lag >= self.threshold:
+            metrics.inc('loop.blocked')
+            metrics.inc('loop.blocked_seconds', lag)
+
+            site = self.sites.get(self.episode)
+            if site is not None:
+                site['seconds'] += lag
+                site['max_seconds'] = max(site['max_seconds'], lag)
+
+        self.episode = None
+
+    async def _tick(self):
+        while True:
+            started = time.monotonic()
+            self.beat = started
+            await asyncio.sleep(self.interval)
+            self._record_lag(max(time.monotonic() - started - self.interval, 0.0))
+
+    def _capture(self):
+        frame = sys._current_frames().get(self.loop_thread)
+
+        if frame is None:
+            return
+
+        stack = traceback.extract_stack(frame)[-self.depth:]
+        own = [entry for entry in stack if entry.filename.startswith(PROJECT_ROOT)]
+        innermost = (own or stack)[-1]
+        filename = os.path.relpath(innermost.filename, PROJECT_ROOT) if own else innermost.filename
+        key = f'{filename}:{innermost.lineno} {innermost.name}'
+
+        site = self.sites.get(key)
+
+        if site is None:
+            if len(self.sites) >= self.max_sites:
+                del self.sites[min(self.sites, key=lambda name: self.sites[name]['seconds'])]
+
+            site = self.sites[key] = {'site': key, 'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                      'stack': [f'{entry.filename}:{entry.lineno} {entry.name}: {entry.line}'
+                                                for entry in stack]}
+
+        site['count'] += 1
+        self.episode = key
+
+    def _watch(self):
+        captured = None
+
+        while not self.stopped.wait(self.threshold / 2):
+            beat = self.beat
+
+            # one stack per blocking episode, taken while the loop is still stuck
+            if beat != captured and time.monotonic() - beat > self.interval + self.threshold:
+                captured = beat
+                self._capture()
+
+    def report(self) -> dict:
+        lag_count = self.lag_count or 1
+        bounds = [f'<={bound}ms' for bound in LAG_BUCKETS] + [f'>{LAG_BUCKETS[-1]}ms']
+
+        return {
+            'worker': metrics.worker_id,
+            'interval_ms': self.interval * 1000,
+            'threshold_ms': self.threshold * 1000,
+            'lag': {
+                'samples': self.lag_count,
+                'last_ms': round(self.last_lag * 1000, 3),
+                'mean_ms': round(self.lag_total / lag_count * 1000, 3),
+                'max_ms': round(self.lag_max * 1000, 3),
+                'histogram': dict(zip(bounds, self.buckets)),
+            },
+            'blocking': sorted((dict(site, seconds=round(site['seconds'], 3), max_seconds=round(site['max_seconds'], 3))
+                                for site in self.sites.values()), key=lambda site: site['seconds'], reverse=True),
+        }
+
+    async def run(self, app):
+        if not self.interval:
+            yield
+            return
+
+        self.loop_thread = threading.get_ident()
+        self.stopped.clear()
+        task = asyncio.create_task(self._tick())
+        watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        watchdog.start()
+
+        yield
+
+        self.stopped.set()
+        task.cancel()
+        watchdog.join()
+
+
+loop_monitor = LoopMonitor(LOOP_LAG_INTERVAL, LOOP_BLOCK_THRESHOLD, LOOP_STACK_DEPTH, LOOP_BLOCKING_SITES)
+
+metrics.register_gauge('loop.lag_ms', lambda: round(loop_monitor.last_lag * 1000, 3))
@@ -1,14 +1,52 @@
 from aiohttp import web
 
-from routes import auth_routes, public_routes, admin_routes
-from middlewares import basic_auth_middleware
+from src.audit import audit_log
+from src.compression import compression_middleware
+from src.config import HOST, PORT, WORKERS
+from src.idempotency import run_idempotency
+from src.logs import run_logging
+from src.loop_monitor import loop_monitor
+from src.middlewares import (request_id_middleware, tracing_middleware, metrics_middleware, deadline_middleware,
+                             auth_middleware, db_session_middleware)
+from src.occupancy import place_occupancy
+from src.passwords import calibrate, run_rehashing
+from src.revocations import revocation_poller
+from src.routes import auth_routes, public_routes, admin_routes, service_routes
+from src.tracing import exporter
+from src.warmup import warmup
+from src.workers import run_workers
+
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[
+        request_id_middleware,
+        tracing_middleware,
+        metrics_middleware,
+        compression_middleware,
+        deadline_middleware,
+        auth_middleware,
+        db_session_middleware,
+    ])
+    app.add_routes(auth_routes.router)
+    app.add_routes(public_routes.router)
+    app.add_routes(admin_routes.router)
+    app.add_routes(service_routes.router)
+    app.cleanup_ctx.append(run_logging)
+    app.cleanup_ctx.append(warmup.run)
+    app.cleanup_ctx.append(exporter.run)
+    app.cleanup_ctx.append(loop_monitor.run)
+    app.cleanup_ctx.append(place_occupancy.run)
+    app.cleanup_ctx.append(revocation_poller.run)
+    app.cleanup_ctx.append(audit_log.run)
+    app.cleanup_ctx.append(run_rehashing)
+    app.cleanup_ctx.append(run_idempotency)
+    app.on_startup.append(warmup.mark_ready)
+    app.on_shutdown.append(warmup.mark_shutting_down)
+    app.on_response_prepare.append(warmup.record_first_byte)
+
+    return app
 
-app = web.Application(middlewares=[
-    basic_auth_middleware,
-])
-app.add_routes(auth_routes.router)
-app.add_routes(public_routes.router)
-app.add_routes(admin_routes.router)
 
 if __name__ == '__main__':
-    web.run_app(app)
+    calibrate()
+    run_workers(create_app(), HOST, PORT, WORKERS)
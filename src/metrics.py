@@ -0,0 +1,33 @@
+import os
+import time
+from collections import Counter
+
+worker_id = 0
+started_at = time.time()
+counters = Counter()
+gauges = {}
+
+
+def reset(worker: int = 0):
+    global worker_id, started_at
+    worker_id = worker
+    started_at = time.time()
+    counters.clear()
+
+
+def inc(name: str, value: int | float = 1):
+    counters[name] += value
+
+
+def register_gauge(name: str, func):
+    gauges[name] = func
+
+
+def snapshot():
+    return {
+        'worker': worker_id,
+        'pid': os.getpid(),
+        'uptime': round(time.time() - started_at, 3),
+        'counters': dict(counters),
+        'gauges': {name: func() for name, func in gauges.items()},
+    }
@@ -1,26 +1,185 @@
-import bcrypt
+import asyncio
+import logging
+import time
+import uuid
+
 from aiohttp import BasicAuth
-from aiohttp.web import middleware
+from aiohttp.web import middleware, HTTPException
 from aiohttp.web_response import json_response
 
+from src import metrics
+from src.config import REQUEST_DEADLINE, DEADLINE_RETRY_AFTER
+from src.database.db_conn import (RequestScope, bind_request_scope, unbind_request_scope, track_sessions,
+                                  untrack_sessions, interrupt_statement)
 from src.database.db_queries import UserQs
+from src.logs import bind_request, unbind_request
+from src.passwords import check_password, rehash_if_needed
+from src.schemas import AuthUserDTO
+from src.tokens import verify_token, is_revoked
+from src.tracing import span, trace_request
+
+PUBLIC_PATHS = ('/registration', '/health', '/ready')
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+logger = logging.getLogger(__name__)
+
+
+@middleware
+async def request_id_middleware(request, handler):
+    # the id of the client (or proxy) is kept, so its logs and ours can be matched
+    request_id = request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex
+    resource = request.match_info.route.resource
+    request['request_id'] = request_id
+    request['received'] = time.perf_counter()
+    token = bind_request(request_id, resource.canonical if resource else request.path)
+
+    try:
+        response = await handler(request)
+    finally:
+        unbind_request(token)
+
+    response.headers['X-Request-ID'] = request_id
+    return response
+
+
+@middleware
+async def tracing_middleware(request, handler):
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource else request.path
+
+    attributes = {'http.method': request.method, 'http.route': route, 'http.target': request.path_qs,
+                  'request_id': request['request_id']}
+
+    with trace_request(f'{request.method} {route}', request.headers.get('traceparent'), **attributes) as root:
+        response = await handler(request)
+
+        if root is not None:
+            root.set(**{'http.status_code': response.status})
+
+        return response
+
+
+@middleware
+async def metrics_middleware(request, handler):
+    started = time.perf_counter()
+    status = 500
+
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.inc('requests')
+        metrics.inc(f'responses.{status // 100}xx')
+        metrics.inc('request_seconds', time.perf_counter() - started)
+
+
+def _expire(sessions: set, timeout: asyncio.Timeout):
+    for session in sessions:
+        interrupt_statement(session)
+
+    timeout.reschedule(asyncio.get_running_loop().time())
 
 
 @middleware
-async def basic_auth_middleware(request, handler):
-    if request.path_qs == '/registration':
+async def deadline_middleware(request, handler):
+    # set per route with the `deadline` decorator; when it runs out the running
+    # SQLite statements of the request are interrupted and the handler is cancelled
+    deadline = getattr(request.match_info.handler, 'deadline', REQUEST_DEADLINE)
+
+    if not deadline:
         return await handler(request)
 
-    auth_header = request.headers.get('Authorization')
+    sessions, token = track_sessions()
 
-    if auth_header:
+    try:
+        async with asyncio.timeout(None) as timeout:
+            timer = asyncio.get_running_loop().call_later(deadline, _expire, sessions, timeout)
+            try:
+                return await handler(request)
+            finally:
+                timer.cancel()
+    except TimeoutError:
+        metrics.inc('deadline.exceeded')
+        return json_response(status=503, data={'error': 'Request timed out, try again later'},
+                             headers={'Retry-After': str(DEADLINE_RETRY_AFTER)})
+    finally:
+        untrack_sessions(token)
+
+
+async def authenticate(auth_header: str):
+    scheme, _, credentials = auth_header.partition(' ')
+
+    if scheme.lower() == 'bearer':
+        payload = verify_token(credentials.strip())
+
+        if payload and not is_revoked(payload):
+            return AuthUserDTO(id=payload['uid'], username=payload['sub'], role=payload['role'])
+
+    elif scheme.lower() == 'basic':
         username, password, encoding = BasicAuth.decode(auth_header)
 
-        password_db = await UserQs.get_user_password(username)
+        user = await UserQs.get_user_credentials(username)
+
+        if user is None:
+            return None
+
+        if await check_password(password, user.password):
+            rehash_if_needed(user.id, password, user.password)
+            return AuthUserDTO(id=user.id, username=user.username, role=user.role)
+
+    return None
+
+
+@middleware
+async def auth_middleware(request, handler):
+    if request.path in PUBLIC_PATHS:
+        return await handler(request)
+
+    auth_header = request.headers.get('Authorization')
+
+    if auth_header:
+        try:
+            with span('authenticate'):
+                user = await authenticate(auth_header)
+        except ValueError:
+            user = None
 
-        if bcrypt.checkpw(password.encode('utf8'), bytes(password_db, 'utf8')):
+        if user:
+            request['user'] = user
             return await handler(request)
 
     return json_response(status=401, data={"error": "You are not authorized"}, headers={
                 'WWW-Authenticate': 'Basic realm="Restricted Access"'
             })
+
+
+@middleware
+async def db_session_middleware(request, handler):
+    scope = RequestScope(write=request.method not in SAFE_METHODS)
+    token = bind_request_scope(scope)
+
+    try:
+        response = await handler(request)
+    except BaseException:
+        await scope.close(commit=False)
+        raise
+    finally:
+        unbind_request_scope(token)
+
+    if scope.rejected:
+        await scope.close(commit=False)
+        return json_response(status=503, data={'error': 'Server is busy, try again later'},
+                             headers={'Retry-After': '1'})
+
+    try:
+        with span('db.commit'):
+            await scope.close(commit=response.status < 500)
+    except Exception:
+        logger.exception('Commit failed')
+        return json_response(status=500, data={'error': 'Internal server error'})
+
+    return response
@@ -1,7 +1,7 @@
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index, JSON, table, column
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -30,7 +30,7 @@ class SmokingPlaceAddress(Base):
     __tablename__ = "smoking_place_address"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    city: Mapped[str]
+    city: Mapped[str] = mapped_column(index=True)
     street: Mapped[str] = mapped_column(unique=True)
 
     smoking_place: Mapped[List['SmokingPlace']] = relationship(back_populates='address')
@@ -41,7 +41,7 @@ class SmokingPlace(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True)
     number: Mapped[int]
-    sp_address: Mapped[int] = mapped_column(ForeignKey("smoking_place_address.id", ondelete='CASCADE'))
+    sp_address: Mapped[int] = mapped_column(ForeignKey("smoking_place_address.id", ondelete='CASCADE'), index=True)
 
     address: Mapped['SmokingPlaceAddress'] = relationship(back_populates="smoking_place")
     reservation_sp: Mapped[List['Reservation']] = relationship(back_populates='sp_ref')
@@ -51,10 +51,74 @@ class Reservation(Base):
     __tablename__ = "reservation"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete='CASCADE'))
-    smoking_place: Mapped[int] = mapped_column(ForeignKey("smoking_place.id", ondelete='CASCADE'))
+    user: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete='CASCADE'), index=True)
+    smoking_place: Mapped[int] = mapped_column(ForeignKey("smoking_place.id", ondelete='CASCADE'), index=True)
     start: Mapped[datetime]
     end: Mapped[datetime]
+    start_ts: Mapped[int] = mapped_column(server_default='0', index=True)
+    end_ts: Mapped[int] = mapped_column(server_default='0')
 
     user_ref: Mapped['User'] = relationship(back_populates='reservation_user')
     sp_ref: Mapped['SmokingPlace'] = relationship(back_populates='reservation_sp')
+
+    __table_args__ = (
+        Index('ix_reservation_smoking_place_end_ts', 'smoking_place', 'end_ts'),
+        Index('ix_reservation_user_end_ts', 'user', 'end_ts'),
+        Index('ix_reservation_end_ts_start_ts_smoking_place', 'end_ts', 'start_ts', 'smoking_place'),
+    )
+
+
+class PlaceOccupancy(Base):
+    __tablename__ = "place_occupancy"
+
+    smoking_place: Mapped[int] = mapped_column(ForeignKey("smoking_place.id", ondelete='CASCADE'), primary_key=True)
+    reservation: Mapped[Optional[int]] = mapped_column(ForeignKey("reservation.id", ondelete='SET NULL'))
+    end: Mapped[Optional[datetime]]
+    end_ts: Mapped[Optional[int]]
+
+
+class AuditEvent(Base):
+    __tablename__ = "audit_log"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    created: Mapped[datetime]
+    # no foreign key: the log outlives the users
+    actor: Mapped[Optional[int]] = mapped_column(index=True)
+    action: Mapped[str] = mapped_column(index=True)
+    target: Mapped[str] = mapped_column(index=True)
+    details: Mapped[Optional[dict]] = mapped_column(JSON)
+
+
+class TokenRevocation(Base):
+    __tablename__ = "token_revocation"
+    # ids are never reused, the workers poll the rows above the last one they have seen
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    # no foreign key: the tokens of a deleted user stay revoked
+    user: Mapped[int]
+    # time (ms) of the revocation, the tokens of the user issued until then are rejected
+    revoked_at: Mapped[int] = mapped_column(index=True)
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_key"
+
+    user: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete='CASCADE'), primary_key=True)
+    key: Mapped[str] = mapped_column(primary_key=True)
+    fingerprint: Mapped[str]
+    # no status while the first request with the key is in flight
+    status: Mapped[Optional[int]]
+    body: Mapped[Optional[bytes]]
+    content_type: Mapped[Optional[str]]
+    # epoch seconds of the claim, then of the stored response
+    created: Mapped[int] = mapped_column(index=True)
+
+
+# FTS5 indexes over addresses and users, created together with the triggers that
+# keep them in sync by a migration. They are not part of the metadata: the
+# column named after the table is the one MATCH is applied to.
+address_search = table('address_search', column('rowid'), column('rank'), column('address_search'))
+user_search = table('user_search', column('rowid'), column('rank'), column('user_search'))
+
+SEARCH_TABLES = ('address_search', 'user_search')
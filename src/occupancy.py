@@ -0,0 +1,175 @@
+import asyncio
+import heapq
+from contextvars import Context
+from datetime import datetime
+
+from src import metrics
+from src.config import OCCUPANCY_HORIZON, OCCUPANCY_REFRESH_INTERVAL
+from src.database.db_conn import shard_for_id
+from src.database.db_queries import PlaceOccupancyQs
+from src.exceptions import DatabaseError
+from src.time_utils import to_epoch, now_epoch
+
+
+def _wall_clock() -> float:
+    now = datetime.now()
+    return to_epoch(now) + now.microsecond / 1_000_000
+
+
+class OccupancyState:
+    """Current reservation of every smoking place, kept in memory and mirrored
+    to the place_occupancy table.
+
+    Reservation writes resync the places they touch in their own transaction.
+    Between writes a place only changes when a reservation starts or ends, so
+    the boundaries of the next OCCUPANCY_HORIZON seconds are kept in a heap with
+    a single timer armed for the earliest one. The periodic refresh slides the
+    horizon and picks up reservations written by other workers.
+    """
+
+    def __init__(self):
+        self.current = {}
+        self.version = 0
+        self.boundaries = []
+        self.pending = set()
+        self.horizon = 0
+        self.timer = None
+        self.timer_at = None
+        self.tasks = set()
+
+    def status(self, sp_id: int) -> str:
+        occupancy = self.current.get(int(sp_id))
+
+        if occupancy and occupancy.reservation is not None and occupancy.end_ts >= now_epoch():
+            return f'occupied until {occupancy.end}'
+
+        return 'free'
+
+    async def sync(self, sp_ids: list[int] | None = None, shard=None):
+        await PlaceOccupancyQs.sync(sp_ids, on_commit=self._apply, shard=shard)
+
+    def forget(self, sp_ids: list[int]):
+        """Drop deleted places, their rows went with them."""
+
+        self.version += 1
+
+        for sp_id in sp_ids:
+            self.current.pop(int(sp_id), None)
+
+    def schedule(self, sp_id: int, start: datetime, end: datetime):
+        self._add_boundary(to_epoch(start), int(sp_id))
+        self._add_boundary(to_epoch(end) + 1, int(sp_id))
+        self._arm()
+
+    async def refresh(self):
+        version = self.version
+        now = now_epoch()
+
+        occupancy = await PlaceOccupancyQs.get_occupancy()
+        boundaries = await PlaceOccupancyQs.get_boundaries(now, now + OCCUPANCY_HORIZON)
+
+        # a write committed meanwhile is newer than what was read here
+        if version == self.version:
+            self.current = {row.smoking_place: row for row in occupancy}
+
+        self.horizon = now + OCCUPANCY_HORIZON
+
+        for sp_id, start_ts, end_ts in boundaries:
+            self._add_boundary(start_ts, sp_id)
+            # a reservation still holds the place during its last second
+            self._add_boundary(end_ts + 1, sp_id)
+
+        self._arm()
+
+    def _apply(self, occupancy, sp_ids, shard):
+        self.version += 1
+
+        if sp_ids is None:
+            # every place of the shard was synced, deleted ones are gone
+            self.current = {sp_id: row for sp_id, row in self.current.items() if shard_for_id(sp_id) is not shard}
+
+        self.current.update((row.smoking_place, row) for row in occupancy)
+
+    def _add_boundary(self, ts: int, sp_id: int):
+        boundary = (ts, sp_id)
+
+        if ts <= now_epoch() or ts > self.horizon or boundary in self.pending:
+            return
+
+        heapq.heappush(self.boundaries, boundary)
+        self.pending.add(boundary)
+
+    def _arm(self):
+        if not self.boundaries:
+            return
+
+        at = self.boundaries[0][0]
+
+        if self.timer is not None:
+            if self.timer_at <= at:
+                return
+            self.timer.cancel()
+
+        loop = asyncio.get_running_loop()
+        self.timer_at = at
+        # boundaries are often scheduled from a request, whose context must not
+        # leak into the flip
+        self.timer = loop.call_at(loop.time() + max(at - _wall_clock(), 0), self._fire, context=Context())
+
+    def _fire(self):
+        self.timer = None
+        now = now_epoch()
+        due = set()
+
+        while self.boundaries and self.boundaries[0][0] <= now:
+            boundary = heapq.heappop(self.boundaries)
+            self.pending.discard(boundary)
+            due.add(boundary[1])
+
+        if due:
+            task = asyncio.create_task(self._flip(sorted(due)))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        self._arm()
+
+    async def _flip(self, sp_ids: list[int]):
+        try:
+            await self.sync(sp_ids)
+        except DatabaseError:
+            metrics.inc('occupancy.errors')
+        else:
+            metrics.inc('occupancy.flips', len(sp_ids))
+
+    async def _refresh_periodically(self):
+        while True:
+            await asyncio.sleep(OCCUPANCY_REFRESH_INTERVAL)
+
+            try:
+                await self.refresh()
+            except DatabaseError:
+                metrics.inc('occupancy.errors')
+
+    async def run(self, app):
+        try:
+            # boundaries passed while the service was down aren't in the mirror yet
+            await self.sync()
+            await self.refresh()
+        except DatabaseError:
+            metrics.inc('occupancy.errors')
+
+        task = asyncio.create_task(self._refresh_periodically())
+
+        yield
+
+        task.cancel()
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+place_occupancy = OccupancyState()
+
+metrics.register_gauge('occupancy.places', lambda: len(place_occupancy.current))
+metrics.register_gauge('occupancy.boundaries', lambda: len(place_occupancy.boundaries))
@@ -0,0 +1,100 @@
+import asyncio
+import contextvars
+import math
+import time
+
+import bcrypt
+
+from src import metrics
+from src.config import BCRYPT_ROUNDS, BCRYPT_TARGET_SECONDS, BCRYPT_MIN_ROUNDS, BCRYPT_MAX_ROUNDS
+from src.database.db_queries import UserQs
+from src.exceptions import DatabaseError
+from src.tracing import span
+
+# the default of bcrypt.gensalt(), until calibrate() runs
+rounds = BCRYPT_ROUNDS or 12
+
+_rehashing = {}
+
+
+def calibrate() -> int:
+    """Set the cost of new hashes to BCRYPT_ROUNDS or, when it is 0, to the
+    highest one whose check takes at most BCRYPT_TARGET_SECONDS on this machine.
+
+    Called once before the workers are forked, so they all agree on the cost
+    and don't keep rehashing each other's hashes.
+    """
+
+    global rounds
+
+    if BCRYPT_ROUNDS:
+        rounds = BCRYPT_ROUNDS
+        return rounds
+
+    hashed = bcrypt.hashpw(b'calibration', bcrypt.gensalt(BCRYPT_MIN_ROUNDS))
+    started = time.perf_counter()
+    bcrypt.checkpw(b'calibration', hashed)
+    elapsed = time.perf_counter() - started
+
+    # every extra round doubles the time
+    extra = math.floor(math.log2(BCRYPT_TARGET_SECONDS / elapsed)) if elapsed < BCRYPT_TARGET_SECONDS else 0
+    rounds = min(BCRYPT_MIN_ROUNDS + extra, BCRYPT_MAX_ROUNDS)
+
+    return rounds
+
+
+def cost(hashed: str) -> int:
+    # $2b$12$<salt and hash>
+    return int(hashed.split('$')[2])
+
+
+async def hash_password(password: str) -> str:
+    # bcrypt is slow on purpose and releases the GIL, so it must not block the loop
+    loop = asyncio.get_running_loop()
+
+    with span('bcrypt.hashpw', rounds=rounds):
+        hashed = await loop.run_in_executor(None, bcrypt.hashpw, password.encode('utf8'), bcrypt.gensalt(rounds))
+
+    return hashed.decode('utf8')
+
+
+async def check_password(password: str, hashed: str) -> bool:
+    loop = asyncio.get_running_loop()
+
+    with span('bcrypt.checkpw'):
+        valid = await loop.run_in_executor(None, bcrypt.checkpw, password.encode('utf8'), hashed.encode('utf8'))
+
+    metrics.inc(f'bcrypt.checked.cost_{cost(hashed)}')
+    return valid
+
+
+async def _rehash(user_id: int, password: str, hashed: str):
+    try:
+        if await UserQs.update_password(user_id, hashed, await hash_password(password)):
+            metrics.inc('bcrypt.rehashed')
+    except DatabaseError:
+        metrics.inc('bcrypt.rehash_errors')
+    finally:
+        del _rehashing[user_id]
+
+
+def rehash_if_needed(user_id: int, password: str, hashed: str):
+    """Replace a hash of another cost than `rounds` after a successful check,
+    in the background so that the login doesn't pay for a second hash."""
+
+    if cost(hashed) == rounds or user_id in _rehashing:
+        return
+
+    # a context of its own, the task outlives the unit of work and the trace of the request
+    _rehashing[user_id] = asyncio.create_task(_rehash(user_id, password, hashed), context=contextvars.Context())
+
+
+async def run_rehashing(app):
+    yield
+
+    # a rehash in flight is cheap to finish and would otherwise be redone on the next login
+    if _rehashing:
+        await asyncio.gather(*_rehashing.values(), return_exceptions=True)
+
+
+metrics.register_gauge('bcrypt.rounds', lambda: rounds)
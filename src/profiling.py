@@ -0,0 +1,113 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from src import metrics
+
+# frames of the profilers themselves are left out of what they report
+_SKIPPED_FILES = (tracemalloc.__file__, '<frozen importlib._bootstrap>', '<frozen importlib._bootstrap_external>')
+
+# one CPU profile at a time per worker
+cpu_profile_lock = asyncio.Lock()
+
+
+def _collapse(frame) -> str:
+    names = []
+
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
+
+
+def sample_stacks(seconds: float, interval: float, thread_id: int | None = None) -> Counter:
+    """Sample the stacks of the threads of this process (or only `thread_id`)
+    every `interval` seconds for `seconds` seconds.
+
+    Returns the number of samples per stack, collapsed into "outer;...;inner"
+    lines. Meant to run in a thread of its own: the threads being profiled pay
+    nothing but the GIL switches to this one.
+    """
+
+    samples = Counter()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    own = threading.get_ident()
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident != own and (thread_id is None or ident == thread_id):
+                samples[f'{names.get(ident, ident)};{_collapse(frame)}'] += 1
+
+        time.sleep(interval)
+
+    metrics.inc('profile.cpu_samples', samples.total())
+    return samples
+
+
+def format_collapsed(samples: Counter) -> bytes:
+    """Stacks in the collapsed format of flamegraph.pl, also read by speedscope."""
+
+    return ''.join(f'{stack} {count}\n' for stack, count in samples.most_common()).encode()
+
+
+class MemoryProfile:
+    """tracemalloc snapshots of the worker compared with a baseline.
+
+    tracemalloc slows down every allocation, so it only runs between `start`
+    and `stop`.
+    """
+
+    def __init__(self):
+        self.baseline = None
+
+    @property
+    def running(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    @staticmethod
+    def _snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, name) for name in _SKIPPED_FILES])
+
+    def start(self, frames: int):
+        tracemalloc.start(frames)
+        self.baseline = self._snapshot()
+
+    def stop(self):
+        tracemalloc.stop()
+        self.baseline = None
+
+    def compare(self, group_by: str, limit: int, reset: bool = False) -> dict:
+        """The allocations that grew the most since the baseline, which is
+        replaced with the new snapshot when `reset` is set."""
+
+        snapshot = self._snapshot()
+        stats = snapshot.compare_to(self.baseline, group_by)
+        current, peak = tracemalloc.get_traced_memory()
+
+        if reset:
+            self.baseline = snapshot
+
+        return {
+            'worker': metrics.worker_id,
+            'traced_bytes': current,
+            'peak_bytes': peak,
+            'tracemalloc_bytes': tracemalloc.get_tracemalloc_memory(),
+            'growth_bytes': sum(stat.size_diff for stat in stats),
+            'top': [{
+                'size_diff': stat.size_diff,
+                'count_diff': stat.count_diff,
+                'size': stat.size,
+                'count': stat.count,
+                'traceback': [f'{frame.filename}:{frame.lineno}' for frame in stat.traceback],
+            } for stat in stats[:limit]],
+        }
+
+
+memory_profile = MemoryProfile()
@@ -0,0 +1,56 @@
+import asyncio
+
+from src import metrics
+from src.config import TOKEN_TTL, TOKEN_REVOCATION_POLL_INTERVAL
+from src.database.db_queries import UserQs
+from src.exceptions import DatabaseError
+from src.tokens import denylist, revoke, forget_expired_revocations, revocation_time
+
+
+class RevocationPoller:
+    """Keeps the token denylist of this worker in step with token_revocation.
+
+    The revocations of the last TOKEN_TTL are loaded before the worker starts
+    serving, then the rows added by any worker are polled every `interval`
+    seconds, so authentication never reads the database. Row ids only grow, so
+    a revocation committed late still has a higher id than the ones polled.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.last_id = 0
+
+    async def poll(self):
+        revocations = await UserQs.get_token_revocations(self.last_id, revocation_time() - TOKEN_TTL * 1000)
+
+        for revocation in revocations:
+            revoke(revocation.user, revocation.revoked_at)
+            self.last_id = revocation.id
+
+        forget_expired_revocations()
+
+    async def _poll_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+
+            try:
+                await self.poll()
+            except DatabaseError:
+                metrics.inc('tokens.revocation_errors')
+
+    async def run(self, app):
+        try:
+            await self.poll()
+        except DatabaseError:
+            metrics.inc('tokens.revocation_errors')
+
+        task = asyncio.create_task(self._poll_periodically())
+
+        yield
+
+        task.cancel()
+
+
+revocation_poller = RevocationPoller(TOKEN_REVOCATION_POLL_INTERVAL)
+
+metrics.register_gauge('tokens.denylist', lambda: len(denylist))
@@ -1,12 +1,31 @@
+import asyncio
+import os
+import threading
+from datetime import datetime, time
+from functools import partial
+
 from aiohttp.web_request import Request
-from aiohttp.web_response import json_response
+from aiohttp.web_response import json_response, Response
 from aiohttp.web_routedef import RouteTableDef
 from pydantic import ValidationError
 
-from src.database.db_queries import SmokingPlaceQs, UserQs, SmokingPlaceAddressQs, ReservationQs
-from src.decorators import validate_admin_data, validate_json
-from src.exceptions import UniqueError
-from src.schemas import SmokingPlacePostDTO, SetUserRoleDTO, SmokingPlaceAddressPostDTO
+from src import metrics
+from src.analytics import utilization_report
+from src.audit import audit
+from src.compression import share_variants
+from src.config import ANALYTICS_MAX_DAYS, ANALYTICS_DEADLINE
+from src.database.db_queries import SmokingPlaceQs, UserQs, SmokingPlaceAddressQs, ReservationQs, AuditQs
+from src.decorators import validate_admin_data, validate_json, deadline
+from src.database.db_conn import after_request_commit
+from src.exceptions import UniqueError, ShardError
+from src.loop_monitor import loop_monitor
+from src.occupancy import place_occupancy
+from src.profiling import cpu_profile_lock, sample_stacks, format_collapsed, memory_profile
+from src.schemas import (SmokingPlacePostDTO, SetUserRoleDTO, SmokingPlaceAddressPostDTO, AnalyticsQueryDTO,
+                         UserQueryDTO, ReservationQueryDTO, SearchQueryDTO, AuditQueryDTO, CpuProfileQueryDTO,
+                         MemoryProfileStartDTO, MemoryProfileQueryDTO)
+from src.serializers import encode_listing, json_bytes_response
+from src.time_utils import to_epoch
 
 router = RouteTableDef()
 
@@ -19,15 +38,22 @@ async def get_smoking_places_addresses(request: Request):
     if not sp_addresses:
         return json_response(status=200, data={"message": "There are no addresses yet"})
 
-    response = {}
+    sp_amounts = [await SmokingPlaceQs.get_sp_amount(address.id) for address in sp_addresses]
 
-    for address in sp_addresses:
-        sp_amount = await SmokingPlaceQs.get_sp_amount(address.id)
+    return json_bytes_response(encode_listing(sp_addresses, extra={'sp_amount': sp_amounts}))
 
-        response[sp_addresses.index(address) + 1] = dict(address)
-        response[sp_addresses.index(address) + 1]['sp_amount'] = sp_amount
 
-    return json_response(status=200, data=response)
+@router.get('/admin/addresses/search')
+@validate_admin_data
+async def search_addresses(request: Request):
+    try:
+        query = SearchQueryDTO(**request.query)
+    except ValidationError as e:
+        return json_response(status=400, data={error["loc"][0]: error["msg"] for error in e.errors()})
+
+    addresses = await SmokingPlaceAddressQs.search_addresses(query.q, query.limit)
+
+    return json_bytes_response(encode_listing(addresses))
 
 
 @router.post('/admin/addresses/new-address')
@@ -46,6 +72,8 @@ async def add_smoking_place_address(request: Request):
     except UniqueError as e:
         return json_response(status=400, data={"error": f"{e.message}"})
 
+    audit(request, 'address.create', new_address.id, city=new_address.city, street=new_address.street)
+
     return json_response(status=201, data=dict(new_address))
 
 
@@ -75,15 +103,9 @@ async def get_smoking_places_on_address(request: Request):
     if not smoking_places:
         return json_response(status=200, data={"message": "There are no smoking places yet"})
 
-    response = {}
-
-    for smoking_place in smoking_places:
-        status = await ReservationQs.get_status(smoking_place.id)
+    statuses = [place_occupancy.status(smoking_place.id) for smoking_place in smoking_places]
 
-        response[smoking_places.index(smoking_place) + 1] = dict(smoking_place)
-        response[smoking_places.index(smoking_place) + 1]['status'] = status
-
-    return json_response(status=200, data=response)
+    return json_bytes_response(encode_listing(smoking_places, extra={'status': statuses}))
 
 
 @router.get(r'/admin/addresses/{address_id:\d+}/smoking-places/{sp_id:\d+}')
@@ -103,7 +125,7 @@ async def get_smoking_place_on_address(request: Request):
         return json_response(status=404, data={"error": f"Smoking place with id: {sp_id} not found "
                                                         f"on address with id {address_id}"})
 
-    status = await ReservationQs.get_status(smoking_place.id)
+    status = place_occupancy.status(smoking_place.id)
 
     response = dict(smoking_place)
     response['status'] = status
@@ -130,6 +152,8 @@ async def add_smoking_place(request: Request):
         return json_response(status=400, data={error["loc"][0]: error["msg"] for error in e.errors()})
 
     sp_id = await SmokingPlaceQs.add_smoking_place(smoking_place.number, address_id)
+    await place_occupancy.sync([sp_id])
+    audit(request, 'place.create', sp_id, number=smoking_place.number, address_id=int(address_id))
     new_sp = await SmokingPlaceQs.get_smoking_place(sp_id)
 
     return json_response(status=201, data=dict(new_sp))
@@ -151,14 +175,15 @@ async def update_address(request: Request):
     address_dict = dict(address)
     address_dict['address_id'] = address_id
 
-    address_id_exist = await SmokingPlaceAddressQs.check_id(address_id)
+    try:
+        updated_address, created = await SmokingPlaceAddressQs.upsert_address(**address_dict)
+    except (UniqueError, ShardError) as e:
+        return json_response(status=400, data={"error": f"{e.message}"})
+
+    audit(request, 'address.create' if created else 'address.update', updated_address.id,
+          city=updated_address.city, street=updated_address.street)
 
-    if address_id_exist:
-        updated_address = await SmokingPlaceAddressQs.update_address(**address_dict)
-        status = 200
-    else:
-        updated_address = await SmokingPlaceAddressQs.put_address(**address_dict)
-        status = 201
+    status = 201 if created else 200
 
     return json_response(status=status, data=dict(updated_address))
 
@@ -184,16 +209,17 @@ async def update_smoking_place(request: Request):
 
     sp_dict = dict(smoking_place)
     sp_dict['sp_id'] = sp_id
+    sp_dict['address_id'] = address_id
 
-    sp_id_exist = await SmokingPlaceQs.check_id(sp_id)
+    try:
+        updated_sp, created = await SmokingPlaceQs.upsert_smoking_place(**sp_dict)
+    except ShardError as e:
+        return json_response(status=400, data={"error": f"{e.message}"})
 
-    if sp_id_exist:
-        updated_sp = await SmokingPlaceQs.update_smoking_place(**sp_dict)
-        status = 200
-    else:
-        sp_dict['address_id'] = address_id
-        updated_sp = await SmokingPlaceQs.put_smoking_place(**sp_dict)
-        status = 201
+    await place_occupancy.sync([updated_sp.id])
+    audit(request, 'place.create' if created else 'place.update', updated_sp.id, number=updated_sp.number,
+          address_id=int(address_id))
+    status = 201 if created else 200
 
     updated_sp_dict = dict(updated_sp)
     updated_sp_dict['address_id'] = address_id
@@ -211,7 +237,9 @@ async def delete_address(request: Request):
     if not address_id_exist:
         return json_response(status=404, data={"error": f"Address with id: {address_id} not found"})
 
-    await SmokingPlaceAddressQs.delete_address(address_id)
+    sp_ids = await SmokingPlaceAddressQs.delete_address(address_id)
+    after_request_commit(partial(place_occupancy.forget, sp_ids))
+    audit(request, 'address.delete', address_id)
 
     return json_response(status=204)
 
@@ -227,6 +255,8 @@ async def delete_smoking_place(request: Request):
         return json_response(status=404, data={"error": f"Smoking place with id: {sp_id} not found"})
 
     await SmokingPlaceQs.delete_smoking_place(sp_id)
+    after_request_commit(partial(place_occupancy.forget, [sp_id]))
+    audit(request, 'place.delete', sp_id)
 
     return json_response(status=204)
 
@@ -234,14 +264,27 @@ async def delete_smoking_place(request: Request):
 @router.get("/admin/users")
 @validate_admin_data
 async def get_all_users(request: Request):
-    users = await UserQs.get_all_users()
+    try:
+        query = UserQueryDTO(**request.query)
+    except ValidationError as e:
+        return json_response(status=400, data={error["loc"][0]: error["msg"] for error in e.errors()})
 
-    response = {}
+    users = await UserQs.get_all_users(query.fields, query.username)
 
-    for user in users:
-        response[users.index(user) + 1] = dict(user)
+    return json_bytes_response(encode_listing(users))
 
-    return json_response(status=200, data=response)
+
+@router.get("/admin/users/search")
+@validate_admin_data
+async def search_users(request: Request):
+    try:
+        query = SearchQueryDTO(**request.query)
+    except ValidationError as e:
+        return json_response(status=400, data={error["loc"][0]: error["msg"] for error in e.errors()})
+
+    users = await UserQs.search_users(query.q, query.limit)
+
+    return json_bytes_response(encode_listing(users))
 
 
 @router.get(r"/admin/users/{user_id:\d+}")
@@ -282,6 +325,7 @@ async def update_user_role(request: Request):
                                                "error": "The value must be equal to 'user' or 'admin'"})
 
     user = await UserQs.update_user_role(user_id, user_role)
+    audit(request, 'user.role', user_id, role=user_role)
 
     return json_response(status=200, data=dict(user))
 
@@ -301,7 +345,11 @@ async def delete_user(request: Request):
     if role == 'admin':
         return json_response(status=403, data={"error": "You can't delete a user with the admin role"})
 
-    await UserQs.delete_user(user_id)
+    sp_ids = await UserQs.delete_user(user_id)
+
+    if sp_ids:
+        await place_occupancy.sync(sp_ids)
+    audit(request, 'user.delete', user_id)
 
     return json_response(status=204)
 
@@ -309,17 +357,17 @@ async def delete_user(request: Request):
 @router.get("/admin/reservations")
 @validate_admin_data
 async def get_all_reservations_admin(request: Request):
-    reservations = await ReservationQs.get_all_reservations()
+    try:
+        query = ReservationQueryDTO(**request.query)
+    except ValidationError as e:
+        return json_response(status=400, data={error["loc"][0]: error["msg"] for error in e.errors()})
+
+    reservations = await ReservationQs.get_all_reservations(query.fields, **query.model_dump(exclude={'fields'}))
 
     if not reservations:
         return json_response(status=200, data={"message": "There are no reservations yet"})
 
-    response = {}
-
-    for reservation in reservations:
-        response[reservations.index(reservation) + 1] = dict(reservation)
-
-    return json_response(status=200, data=response)
+    return json_bytes_response(encode_listing(reservations))
 
 
 @router.get(r"/admin/reservations/{res_id:\d+}")
@@ -347,6 +395,132 @@ async def delete_reservation_admin(request: Request):
     if not res_id_exist:
         return json_response(status=404, data={"error": f"Reservation with id: {res_id} not found"})
 
-    await ReservationQs.delete_reservation_admin(res_id)
+    sp_id = await ReservationQs.delete_reservation_admin(res_id)
+
+    if sp_id:
+        await place_occupancy.sync([sp_id])
+        audit(request, 'reservation.delete', res_id, sp_id=sp_id)
+
+    return json_response(status=204)
+
+
+@router.get("/admin/analytics/utilization")
+@deadline(ANALYTICS_DEADLINE)
+@validate_admin_data
+async def get_utilization(request: Request):
+    try:
+        query = AnalyticsQueryDTO(**request.query)
+    except ValidationError as e:
+        return json_response(status=400, data={error["loc"][0]: error["msg"] for error in e.errors()})
+
+    if query.end < query.start:
+        return json_response(status=400, data={"field": "to",
+                                               "error": "The end of the range must not be earlier than the start"})
+
+    days = (query.end - query.start).days + 1
+
+    if days > ANALYTICS_MAX_DAYS:
+        return json_response(status=400, data={"error": f"The range cannot exceed {ANALYTICS_MAX_DAYS} days"})
+
+    range_start = to_epoch(datetime.combine(query.start, time.min))
+    report, variants = await utilization_report(range_start, range_start + days * 86400, query.granularity)
+
+    return share_variants(json_bytes_response(report), variants)
+
+
+@router.get("/admin/audit")
+@validate_admin_data
+async def get_audit_log(request: Request):
+    try:
+        query = AuditQueryDTO(**request.query)
+    except ValidationError as e:
+        return json_response(status=400, data={error["loc"][0]: error["msg"] for error in e.errors()})
+
+    events = await AuditQs.get_events(**query.model_dump())
+
+    if not events:
+        return json_response(status=200, data={"message": "There are no audit events yet"})
+
+    return json_bytes_response(encode_listing(events))
+
+
+@router.get("/admin/metrics")
+@validate_admin_data
+async def get_worker_metrics(request: Request):
+    return json_response(status=200, data=metrics.snapshot())
+
+
+@router.get("/admin/loop")
+@validate_admin_data
+async def get_loop_lag(request: Request):
+    return json_response(status=200, data=loop_monitor.report())
+
+
+@router.get("/admin/profile/cpu")
+@deadline(0)
+@validate_admin_data
+async def get_cpu_profile(request: Request):
+    try:
+        query = CpuProfileQueryDTO(**request.query)
+    except ValidationError as e:
+        return json_response(status=400, data={error["loc"][0]: error["msg"] for error in e.errors()})
+
+    if cpu_profile_lock.locked():
+        return json_response(status=409, data={"error": "A CPU profile of this worker is already running"})
+
+    thread_id = threading.get_ident() if query.threads == 'loop' else None
+
+    async with cpu_profile_lock:
+        samples = await asyncio.get_running_loop().run_in_executor(None, sample_stacks, query.seconds,
+                                                                   query.interval / 1000, thread_id)
+
+    filename = f'cpu-worker{metrics.worker_id}-{os.getpid()}.collapsed'
+
+    return Response(status=200, body=format_collapsed(samples), content_type='text/plain',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@router.post("/admin/profile/memory")
+@validate_admin_data
+async def start_memory_profile(request: Request):
+    try:
+        query = MemoryProfileStartDTO(**request.query)
+    except ValidationError as e:
+        return json_response(status=400, data={error["loc"][0]: error["msg"] for error in e.errors()})
+
+    if memory_profile.running:
+        return json_response(status=409, data={"error": "Memory profiling of this worker is already running"})
+
+    memory_profile.start(query.frames)
+
+    return json_response(status=201, data={"worker": metrics.worker_id, "message": "Memory profiling started"})
+
+
+@router.get("/admin/profile/memory")
+@deadline(0)
+@validate_admin_data
+async def get_memory_profile(request: Request):
+    try:
+        query = MemoryProfileQueryDTO(**request.query)
+    except ValidationError as e:
+        return json_response(status=400, data={error["loc"][0]: error["msg"] for error in e.errors()})
+
+    if not memory_profile.running:
+        return json_response(status=409, data={"error": "Memory profiling of this worker is not running"})
+
+    # a snapshot of a big heap takes a while, so it is taken in a thread
+    report = await asyncio.get_running_loop().run_in_executor(None, memory_profile.compare, query.group_by,
+                                                              query.limit, query.reset)
+
+    return json_response(status=200, data=report)
+
+
+@router.delete("/admin/profile/memory")
+@validate_admin_data
+async def stop_memory_profile(request: Request):
+    if not memory_profile.running:
+        return json_response(status=409, data={"error": "Memory profiling of this worker is not running"})
+
+    memory_profile.stop()
 
     return json_response(status=204)
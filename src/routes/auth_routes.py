@@ -1,36 +1,60 @@
 from datetime import datetime, timedelta
 
-from aiohttp import BasicAuth
 from aiohttp.web_request import Request
 from aiohttp.web_response import json_response
 from aiohttp.web_routedef import RouteTableDef
 from pydantic import ValidationError
 
-from src.database.db_queries import SmokingPlaceQs, ReservationQs, UserQs
+from src.audit import audit
+from src.coalescing import coalesce_reads
+from src.config import TOKEN_TTL
+from src.database.db_conn import defer_writes
+from src.database.db_queries import SmokingPlaceQs, ReservationQs
 from src.decorators import validate_user_data, validate_json
-from src.exceptions import UniqueError
-from src.schemas import ReservationPostDTO, ReservationPutDTO
+from src.exceptions import UniqueError, ShardError
+from src.group_commit import reservation_batcher
+from src.idempotency import idempotent
+from src.occupancy import place_occupancy
+from src.schemas import (ReservationPostDTO, ReservationPutDTO, SmokingPlaceQueryDTO, ReservationQueryDTO,
+                         UserReservationQueryDTO)
+from src.serializers import encode_listing, json_bytes_response
+from src.tokens import issue_token
 
 router = RouteTableDef()
 
 
+@router.post('/login')
+async def login(request: Request):
+    user = request['user']
+    token = issue_token(user.id, user.username, user.role)
+
+    return json_response(status=200, data={'token': token, 'token_type': 'Bearer', 'expires_in': TOKEN_TTL})
+
+
 @router.get('/smoking-places')
+@coalesce_reads()
 @validate_user_data
 async def get_all_smoking_places(request: Request):
-    smoking_places = await SmokingPlaceQs.get_all_smoking_places()
+    try:
+        query = SmokingPlaceQueryDTO(**request.query)
+    except ValidationError as e:
+        return json_response(status=400, data={error["loc"][0]: error["msg"] for error in e.errors()})
+
+    fields = query.fields
+
+    # statuses are looked up by place id, so it comes with them
+    smoking_places = await SmokingPlaceQs.get_all_smoking_places(
+        [*fields, 'id'] if fields and 'status' in fields else fields, query.place, query.address, query.city)
 
     if not smoking_places:
         return json_response(status=200, data={"message": "There are no smoking places yet"})
 
-    response = {}
-
-    for smoking_place in smoking_places:
-        status = await ReservationQs.get_status(smoking_place.id)
+    if fields and 'status' not in fields:
+        return json_bytes_response(encode_listing(smoking_places))
 
-        response[smoking_places.index(smoking_place)+1] = dict(smoking_place)
-        response[smoking_places.index(smoking_place) + 1]['status'] = status
+    statuses = [place_occupancy.status(smoking_place.id) for smoking_place in smoking_places]
 
-    return json_response(status=200, data=response)
+    return json_bytes_response(encode_listing(smoking_places, extra={'status': statuses}))
 
 
 @router.get(r"/smoking-places/{sp_id:\d+}")
@@ -43,7 +67,7 @@ async def get_smoking_place(request: Request):
     if not smoking_place:
         return json_response(status=404, data={"error": f"Smoking place with id: {sp_id} not found"})
 
-    status = await ReservationQs.get_status(sp_id)
+    status = place_occupancy.status(sp_id)
 
     response = dict(smoking_place)
     response['status'] = status
@@ -52,11 +76,14 @@ async def get_smoking_place(request: Request):
 
 
 @router.post(r'/smoking-places/{sp_id:\d+}/reservation')
+@idempotent
 @validate_json
 @validate_user_data
 async def reserve_smoking_place(request: Request):
     sp_id = request.match_info['sp_id']
 
+    batched = reservation_batcher.enabled and defer_writes()
+
     sp_id_exist = await SmokingPlaceQs.check_id(sp_id)
 
     if not sp_id_exist:
@@ -80,10 +107,7 @@ async def reserve_smoking_place(request: Request):
     if reservation.end - reservation.start > timedelta(minutes=30):
         return json_response(status=400, data={"error": "The duration of the reservation cannot exceed 30 minutes"})
 
-    auth_header = request.headers.get('Authorization')
-    username, password, encoding = BasicAuth.decode(auth_header)
-
-    user_id = await UserQs.get_user_id(username)
+    user_id = request['user'].id
 
     user_data = {
         'user_id': user_id,
@@ -92,17 +116,32 @@ async def reserve_smoking_place(request: Request):
         'end': reservation.end
     }
 
-    res_time_exist = await ReservationQs.check_time(**user_data)
+    if batched:
+        try:
+            user_reservation = await reservation_batcher.submit(**user_data)
+        except UniqueError as e:
+            return json_response(status=400, data={"error": f"{e.message}"})
 
-    if res_time_exist:
-        return json_response(status=400, data={"error": "The reservation for the entered time already exists"})
+        if not user_reservation:
+            return json_response(status=400, data={"error": "The reservation for the entered time already exists"})
+    else:
+        res_time_exist = await ReservationQs.check_time(**user_data)
 
-    try:
-        reservation_id = await ReservationQs.add_reservation(**user_data)
-    except UniqueError as e:
-        return json_response(status=400, data={"error": f"{e.message}"})
+        if res_time_exist:
+            return json_response(status=400, data={"error": "The reservation for the entered time already exists"})
+
+        try:
+            reservation_id = await ReservationQs.add_reservation(**user_data)
+        except UniqueError as e:
+            return json_response(status=400, data={"error": f"{e.message}"})
 
-    user_reservation = await ReservationQs.get_user_reservation(user_id, reservation_id)
+        await place_occupancy.sync([sp_id])
+        place_occupancy.schedule(sp_id, reservation.start, reservation.end)
+
+        user_reservation = await ReservationQs.get_user_reservation(user_id, reservation_id)
+
+    audit(request, 'reservation.create', user_reservation.reservation_id, sp_id=int(sp_id),
+          start=reservation.start.isoformat(), end=reservation.end.isoformat())
 
     response = dict(user_reservation)
     response.pop("username")
@@ -111,41 +150,39 @@ async def reserve_smoking_place(request: Request):
 
 
 @router.get('/reservations')
+@coalesce_reads()
 @validate_user_data
 async def get_all_reservations(request: Request):
-    reservations = await ReservationQs.get_all_reservations()
+    try:
+        query = ReservationQueryDTO(**request.query)
+    except ValidationError as e:
+        return json_response(status=400, data={error["loc"][0]: error["msg"] for error in e.errors()})
+
+    reservations = await ReservationQs.get_all_reservations(query.fields, **query.model_dump(exclude={'fields'}))
 
     if not reservations:
         return json_response(status=200, data={"message": "There are no reservations yet"})
 
-    response = {}
-
-    for reservation in reservations:
-        response[reservations.index(reservation)+1] = dict(reservation)
-
-    return json_response(status=200, data=response)
+    return json_bytes_response(encode_listing(reservations))
 
 
 @router.get('/reservations/my-reservations')
 @validate_user_data
 async def get_user_reservations(request: Request):
-    auth_header = request.headers.get('Authorization')
-    username, password, encoding = BasicAuth.decode(auth_header)
-    user_id = await UserQs.get_user_id(username)
+    try:
+        query = UserReservationQueryDTO(**request.query)
+    except ValidationError as e:
+        return json_response(status=400, data={error["loc"][0]: error["msg"] for error in e.errors()})
 
-    user_reservations = await ReservationQs.get_user_reservations(user_id)
+    user_id = request['user'].id
+
+    user_reservations = await ReservationQs.get_user_reservations(user_id, query.fields,
+                                                                  **query.model_dump(exclude={'fields'}))
 
     if not user_reservations:
         return json_response(status=200, data={"message": "You don't have any reservations yet"})
 
-    response = {}
-
-    for user_reservation in user_reservations:
-        user_res_dict = dict(user_reservation)
-        user_res_dict.pop('username')
-        response[user_reservations.index(user_reservation) + 1] = user_res_dict
-
-    return json_response(status=200, data=response)
+    return json_bytes_response(encode_listing(user_reservations))
 
 
 @router.get(r'/reservations/my-reservations/{res_id:\d+}')
@@ -153,9 +190,7 @@ async def get_user_reservations(request: Request):
 async def get_user_reservation(request: Request):
     res_id = request.match_info['res_id']
 
-    auth_header = request.headers.get('Authorization')
-    username, password, encoding = BasicAuth.decode(auth_header)
-    user_id = await UserQs.get_user_id(username)
+    user_id = request['user'].id
 
     user_reservation = await ReservationQs.get_user_reservation(user_id, res_id)
 
@@ -169,6 +204,7 @@ async def get_user_reservation(request: Request):
 
 
 @router.put(r'/reservations/my-reservations/{res_id:\d+}')
+@idempotent
 @validate_json
 @validate_user_data
 async def update_user_reservation(request: Request):
@@ -193,10 +229,7 @@ async def update_user_reservation(request: Request):
         return json_response(status=400, data={"error": "The duration of the update reservation cannot exceed 30 "
                                                         "minutes"})
 
-    auth_header = request.headers.get('Authorization')
-    username, password, encoding = BasicAuth.decode(auth_header)
-
-    user_id = await UserQs.get_user_id(username)
+    user_id = request['user'].id
     sp_id = await SmokingPlaceQs.get_smoking_place_id(reservation.sp_number, reservation.city, reservation.street)
 
     if not sp_id:
@@ -214,26 +247,38 @@ async def update_user_reservation(request: Request):
     if res_time_exist:
         return json_response(status=400, data={"error": "The reservation for the entered time already exists"})
 
-    update_data = {
+    upsert_data = {
         'res_id': res_id,
+        'user_id': user_id,
         'sp_id': sp_id[0],
         'start': reservation.start,
         'end': reservation.end
     }
 
-    res_id_exist = await ReservationQs.check_id(res_id)
-
-    if res_id_exist:
-        await ReservationQs.update_user_reservation(**update_data)
-        status = 200
-    else:
-        await ReservationQs.put_reservation(**update_data)
-        status = 201
+    try:
+        user_reservation, created, previous_sp_id = await ReservationQs.upsert_reservation(**upsert_data)
+    except ShardError as e:
+        return json_response(status=400, data={"error": f"{e.message}"})
 
-    user_reservation = await ReservationQs.get_user_reservation(user_id, res_id)
+    if not user_reservation:
+        return json_response(status=404, data={"error": f"Reservation with id: {res_id} not found"})
 
-    response = dict(user_reservation)
-    response.pop("username")
+    # the reservation may have moved from another place of the city
+    await place_occupancy.sync(sorted({sp_id[0], previous_sp_id} - {None}))
+    place_occupancy.schedule(sp_id[0], reservation.start, reservation.end)
+    audit(request, 'reservation.create' if created else 'reservation.update', user_reservation.reservation_id,
+          sp_id=sp_id[0], start=reservation.start.isoformat(), end=reservation.end.isoformat())
+
+    status = 201 if created else 200
+
+    response = {
+        'reservation_id': user_reservation.reservation_id,
+        'sp_number': reservation.sp_number,
+        'city': reservation.city,
+        'street': reservation.street,
+        'start': user_reservation.start,
+        'end': user_reservation.end
+    }
 
     return json_response(status=status, data=response)
 
@@ -248,10 +293,12 @@ async def delete_user_reservation(request: Request):
     if not res_id_exist:
         return json_response(status=404, data={"error": f"Reservation with id: {res_id} not found"})
 
-    auth_header = request.headers.get('Authorization')
-    username, password, encoding = BasicAuth.decode(auth_header)
-    user_id = await UserQs.get_user_id(username)
+    user_id = request['user'].id
+
+    sp_id = await ReservationQs.delete_reservation(res_id, user_id)
 
-    await ReservationQs.delete_reservation(res_id, user_id)
+    if sp_id:
+        await place_occupancy.sync([sp_id])
+        audit(request, 'reservation.delete', res_id, sp_id=sp_id)
 
     return json_response(status=204)
@@ -1,4 +1,3 @@
-import bcrypt
 from aiohttp.web_request import Request
 from aiohttp.web_response import json_response
 from aiohttp.web_routedef import RouteTableDef
@@ -7,6 +6,7 @@ from pydantic import ValidationError
 from src.database.db_queries import UserQs
 from src.decorators import validate_user_data, validate_json
 from src.exceptions import UniqueError
+from src.passwords import hash_password
 from src.schemas import UserPostDTO
 
 router = RouteTableDef()
@@ -23,8 +23,7 @@ async def reg_user(request: Request):
     except ValidationError as e:
         return json_response(status=400, data={error["loc"][0]: error["msg"] for error in e.errors()})
 
-    password_bytes = bcrypt.hashpw(user.password.encode('utf8'), bcrypt.gensalt())
-    user.password = password_bytes.decode('utf8')
+    user.password = await hash_password(user.password)
 
     try:
         new_user = await UserQs.add_user(**dict(user))
@@ -0,0 +1,32 @@
+import os
+
+from aiohttp.web_request import Request
+from aiohttp.web_response import json_response
+from aiohttp.web_routedef import RouteTableDef
+
+from src import metrics
+from src.database.db_queries import ServiceQs
+from src.exceptions import DatabaseError
+from src.warmup import warmup
+
+router = RouteTableDef()
+
+
+@router.get('/health')
+async def health(request: Request):
+    response = {'worker': metrics.worker_id, 'pid': os.getpid()}
+
+    try:
+        await ServiceQs.ping()
+    except DatabaseError:
+        response['status'] = 'database unavailable'
+        return json_response(status=503, data=response)
+
+    response['status'] = 'ok'
+
+    return json_response(status=200, data=response)
+
+
+@router.get('/ready')
+async def ready(request: Request):
+    return json_response(status=200 if warmup.ready else 503, data=warmup.report())
@@ -1,16 +1,39 @@
-from datetime import datetime
+import re
+from datetime import datetime, date
+from typing import Literal
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator, model_validator
 
+from src.config import PROFILE_MAX_SECONDS
+from src.tracing import TRACING_ENABLED, sampled, span
 
-class UserPostDTO(BaseModel):
+
+class TracedModel(BaseModel):
+    """Base of the DTOs, validation shows up as a span of the traced requests.
+
+    The validator is only installed when tracing is enabled: a wrap validator
+    slows down every validation, sampled or not.
+    """
+
+    if TRACING_ENABLED:
+        @model_validator(mode='wrap')
+        @classmethod
+        def _traced(cls, data, handler):
+            if not sampled():
+                return handler(data)
+
+            with span(f'validate {cls.__name__}'):
+                return handler(data)
+
+
+class UserPostDTO(TracedModel):
     username: str
     password: str = Field(min_length=8)
     name: str
     email: str
 
 
-class UserDTO(BaseModel):
+class UserDTO(TracedModel):
     id: int
     username: str
     name: str
@@ -18,22 +41,32 @@ class UserDTO(BaseModel):
     role: str
 
 
-class SmokingPlaceAddressPostDTO(BaseModel):
+class AuthUserDTO(TracedModel):
+    id: int
+    username: str
+    role: str
+
+
+class UserCredentialsDTO(AuthUserDTO):
+    password: str
+
+
+class SmokingPlaceAddressPostDTO(TracedModel):
     city: str
     street: str
 
 
-class SmokingPlaceAddressDTO(BaseModel):
+class SmokingPlaceAddressDTO(TracedModel):
     id: int
     city: str
     street: str
 
 
-class SmokingPlacePostDTO(BaseModel):
+class SmokingPlacePostDTO(TracedModel):
     number: int
 
 
-class SmokingPlaceWithoutAddressDTO(BaseModel):
+class SmokingPlaceWithoutAddressDTO(TracedModel):
     id: int
     number: int
 
@@ -43,12 +76,12 @@ class SmokingPlaceDTO(SmokingPlaceWithoutAddressDTO):
     street: str
 
 
-class ReservationPostDTO(BaseModel):
+class ReservationPostDTO(TracedModel):
     start: datetime
     end: datetime
 
 
-class ReservationPutDTO(BaseModel):
+class ReservationPutDTO(TracedModel):
     sp_number: int
     city: str
     street: str
@@ -56,7 +89,7 @@ class ReservationPutDTO(BaseModel):
     end: datetime
 
 
-class ReservationDTO(BaseModel):
+class ReservationDTO(TracedModel):
     reservation_id: int
     username: str
     sp_number: int
@@ -66,5 +99,87 @@ class ReservationDTO(BaseModel):
     end: str
 
 
-class SetUserRoleDTO(BaseModel):
+class SetUserRoleDTO(TracedModel):
     role: str
+
+
+class AnalyticsQueryDTO(TracedModel):
+    start: date = Field(alias='from')
+    end: date = Field(alias='to')
+    granularity: Literal['hour', 'day', 'week'] = 'hour'
+
+
+class ListingQueryDTO(TracedModel):
+    fields: list[str] | None = None
+
+    @field_validator('fields', mode='before')
+    @classmethod
+    def split_fields(cls, value):
+        if isinstance(value, str):
+            return value.split(',') if value else None
+        return value
+
+
+class UserQueryDTO(ListingQueryDTO):
+    fields: list[Literal['id', 'username', 'name', 'email', 'role']] | None = None
+    username: str | None = None
+
+
+class SmokingPlaceQueryDTO(ListingQueryDTO):
+    fields: list[Literal['id', 'number', 'city', 'street', 'status']] | None = None
+    place: int | None = None
+    address: int | None = None
+    city: str | None = None
+
+
+class UserReservationQueryDTO(ListingQueryDTO):
+    fields: list[Literal['reservation_id', 'sp_number', 'city', 'street', 'start', 'end']] | None = None
+    place: int | None = None
+    address: int | None = None
+    city: str | None = None
+    start: datetime | None = Field(default=None, alias='from')
+    end: datetime | None = Field(default=None, alias='to')
+
+
+class ReservationQueryDTO(UserReservationQueryDTO):
+    fields: list[Literal['reservation_id', 'username', 'sp_number', 'city', 'street', 'start', 'end']] | None = None
+    username: str | None = None
+
+
+class SearchQueryDTO(TracedModel):
+    q: str = Field(max_length=200)
+    limit: int = Field(default=20, ge=1, le=100)
+
+    @field_validator('q')
+    @classmethod
+    def has_words(cls, value):
+        if not re.search(r'\w', value):
+            raise ValueError('The search query must contain letters or digits')
+        return value
+
+
+class AuditQueryDTO(TracedModel):
+    actor: int | None = None
+    action: str | None = None
+    target: str | None = None
+    start: datetime | None = Field(default=None, alias='from')
+    end: datetime | None = Field(default=None, alias='to')
+    before: int | None = None
+    limit: int = Field(default=100, ge=1, le=1000)
+
+
+class CpuProfileQueryDTO(TracedModel):
+    seconds: float = Field(default=10, gt=0, le=PROFILE_MAX_SECONDS)
+    # milliseconds between samples
+    interval: float = Field(default=5, ge=1, le=1000)
+    threads: Literal['loop', 'all'] = 'loop'
+
+
+class MemoryProfileStartDTO(TracedModel):
+    frames: int = Field(default=10, ge=1, le=100)
+
+
+class MemoryProfileQueryDTO(TracedModel):
+    group_by: Literal['lineno', 'filename', 'traceback'] = 'lineno'
+    limit: int = Field(default=20, ge=1, le=1000)
+    reset: bool = False
@@ -0,0 +1,19 @@
+import calendar
+from datetime import datetime, timedelta
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+# Reservation times are naive wall-clock datetimes. They are turned into epoch
+# seconds as if they were UTC, the same way SQLite's strftime('%s', ...) reads
+# the stored text, so the backfilled and the newly written values agree.
+def to_epoch(value: datetime) -> int:
+    return calendar.timegm(value.timetuple())
+
+
+def from_epoch(value: int) -> datetime:
+    return _EPOCH + timedelta(seconds=value)
+
+
+def now_epoch() -> int:
+    return to_epoch(datetime.now())
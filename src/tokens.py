@@ -0,0 +1,66 @@
+import base64
+import hashlib
+import hmac
+import json
+import math
+import time
+
+from src.config import SECRET_KEY, TOKEN_TTL
+
+# user id -> time (ms) of the last revocation of its tokens, only for the users
+# revoked within TOKEN_TTL: every token issued before that has expired anyway
+denylist = {}
+
+
+def _encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _sign(body: str) -> str:
+    return _encode(hmac.new(SECRET_KEY, body.encode('ascii'), hashlib.sha256).digest())
+
+
+def issue_token(user_id: int, username: str, role: str):
+    now = int(time.time() * 1000)
+    payload = {'uid': user_id, 'sub': username, 'role': role, 'iat': now, 'exp': now + TOKEN_TTL * 1000}
+    body = _encode(json.dumps(payload, separators=(',', ':')).encode('utf8'))
+
+    return f'{body}.{_sign(body)}'
+
+
+def verify_token(token: str):
+    body, _, signature = token.partition('.')
+
+    if not hmac.compare_digest(signature.encode('ascii', 'replace'), _sign(body).encode('ascii')):
+        return None
+
+    payload = json.loads(_decode(body))
+
+    if payload['exp'] <= time.time() * 1000:
+        return None
+
+    return payload
+
+
+def is_revoked(payload: dict) -> bool:
+    return payload['iat'] <= denylist.get(payload['uid'], -math.inf)
+
+
+def revoke(user_id: int, revoked_at: int):
+    user_id = int(user_id)
+    denylist[user_id] = max(denylist.get(user_id, revoked_at), revoked_at)
+
+
+def forget_expired_revocations():
+    expired = revocation_time() - TOKEN_TTL * 1000
+
+    for user_id in [user_id for user_id, revoked_at in denylist.items() if revoked_at < expired]:
+        del denylist[user_id]
+
+
+def revocation_time() -> int:
+    return int(time.time() * 1000)
@@ -0,0 +1,248 @@
+import asyncio
+import functools
+import inspect
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from src import metrics
+from src.config import (TRACE_SAMPLE_RATE, TRACE_TRUST_TRACEPARENT, TRACE_FILE, TRACE_FILE_MAX_BYTES, TRACE_MAX_SPANS,
+                        TRACE_QUEUE_SIZE)
+from src.logs import bind_query, unbind_query
+
+_current_span = ContextVar('current_span', default=None)
+
+# nothing is traced when neither the sample rate nor a caller can ask for it
+TRACING_ENABLED = bool(TRACE_SAMPLE_RATE or TRACE_TRUST_TRACEPARENT)
+
+TRACEPARENT = re.compile(r'00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})')
+
+# OpenTelemetry span kinds
+INTERNAL = 1
+SERVER = 2
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'kind', 'start', 'end', 'attributes', 'error')
+
+    def __init__(self, trace: list, name: str, parent_id: str | None, kind: int = INTERNAL,
+                 attributes: dict | None = None):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes or {}
+        self.error = None
+
+        trace.append(self)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class TraceList(list):
+    """The spans of one trace, in the order they were started."""
+
+    __slots__ = ('trace_id',)
+
+
+@contextmanager
+def _activate(current: Span):
+    token = _current_span.set(current)
+
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        current.end = time.time_ns()
+        _current_span.reset(token)
+
+
+def sampled() -> bool:
+    """Whether the current request is traced."""
+
+    return _current_span.get() is not None
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """A child of the current span, or nothing when the request isn't sampled."""
+
+    parent = _current_span.get()
+
+    if parent is None or len(parent.trace) >= TRACE_MAX_SPANS:
+        yield None
+        return
+
+    with _activate(Span(parent.trace, name, parent.span_id, attributes=attributes)) as current:
+        yield current
+
+
+@contextmanager
+def trace_request(name: str, traceparent: str | None = None, **attributes):
+    """The root span of a request, sampled with TRACE_SAMPLE_RATE. A sampled
+    request continues the trace of the caller's W3C traceparent header, whose
+    own sampled flag only decides with TRACE_TRUST_TRACEPARENT."""
+
+    match = TRACEPARENT.fullmatch(traceparent or '')
+    trace_id, parent_id, flags = match.groups() if match else (None, None, None)
+
+    if flags is not None and TRACE_TRUST_TRACEPARENT:
+        sampled = int(flags, 16) & 1
+    else:
+        sampled = TRACE_SAMPLE_RATE and random.random() < TRACE_SAMPLE_RATE
+
+    if not sampled:
+        yield None
+        return
+
+    trace = TraceList()
+    trace.trace_id = trace_id or os.urandom(16).hex()
+    metrics.inc('trace.sampled')
+
+    try:
+        with _activate(Span(trace, name, parent_id, kind=SERVER, attributes=attributes)) as root:
+            yield root
+    finally:
+        exporter.export(trace)
+
+
+def traced(name: str):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _traced_query(name: str, func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        # the records logged meanwhile, its failure for one, are tagged with the query
+        token = bind_query(name)
+        try:
+            with span(name):
+                return await func(*args, **kwargs)
+        finally:
+            unbind_query(token)
+    return wrapper
+
+
+def traced_queries(cls):
+    """Wrap every query of a Qs class in a span named after it, which also
+    tags the log records of the query."""
+
+    for name, value in list(vars(cls).items()):
+        if isinstance(value, staticmethod) and inspect.iscoroutinefunction(value.__func__):
+            setattr(cls, name, staticmethod(_traced_query(f'{cls.__name__}.{name}', value.__func__)))
+
+    return cls
+
+
+def _attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+def to_otlp(trace: TraceList) -> dict:
+    """The trace as an OTLP/JSON export request."""
+
+    # shared work may still be running when the request ends
+    end = trace[0].end
+    spans = []
+
+    for current in list(trace):
+        entry = {
+            'traceId': trace.trace_id,
+            'spanId': current.span_id,
+            'name': current.name,
+            'kind': current.kind,
+            'startTimeUnixNano': str(current.start),
+            'endTimeUnixNano': str(current.end or end),
+            'attributes': [_attribute(key, value) for key, value in current.attributes.items() if value is not None],
+            'status': {'code': 2, 'message': current.error} if current.error else {'code': 1},
+        }
+        if current.parent_id:
+            entry['parentSpanId'] = current.parent_id
+        spans.append(entry)
+
+    return {'resourceSpans': [{
+        'resource': {'attributes': [_attribute('service.name', 'smoking-corner'),
+                                    _attribute('process.pid', os.getpid()),
+                                    _attribute('service.instance.id', metrics.worker_id)]},
+        'scopeSpans': [{'scope': {'name': __name__}, 'spans': spans}],
+    }]}
+
+
+class FileExporter:
+    """Appends the finished traces to `path`, one OTLP/JSON line each, from a
+    thread of this worker. Traces are dropped (trace.dropped) when the thread
+    falls behind, and (trace.dropped_file_full) when the file has reached
+    `max_bytes`. Each line is a single O_APPEND write, so workers can share
+    the file; the cap is checked against the size they wrote together."""
+
+    def __init__(self, path: str, size: int, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.queue = queue.Queue(size)
+        self.thread = None
+
+    def export(self, trace: TraceList):
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            metrics.inc('trace.dropped')
+
+    def _write(self):
+        fd = None
+
+        try:
+            while (trace := self.queue.get()) is not None:
+                line = json.dumps(to_otlp(trace), separators=(',', ':')).encode() + b'\n'
+
+                # opened with the first trace, no empty file is left behind while nothing is sampled
+                if fd is None:
+                    fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+                if self.max_bytes and os.fstat(fd).st_size + len(line) > self.max_bytes:
+                    metrics.inc('trace.dropped_file_full')
+                    continue
+
+                os.write(fd, line)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    async def run(self, app):
+        if not TRACING_ENABLED:
+            yield
+            return
+
+        self.thread = threading.Thread(target=self._write, name='trace-exporter', daemon=True)
+        self.thread.start()
+
+        yield
+
+        self.queue.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, self.thread.join)
+
+
+exporter = FileExporter(TRACE_FILE, TRACE_QUEUE_SIZE, TRACE_FILE_MAX_BYTES)
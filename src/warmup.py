@@ -0,0 +1,132 @@
+import logging
+import statistics
+import time
+from contextlib import AsyncExitStack
+
+from src import metrics
+from src.config import READ_POOL_SIZE, WARMUP_REPORT_REQUESTS
+from src.database.db_conn import shards, engines
+from src.database.db_queries import UserQs, SmokingPlaceQs, ReservationQs, SmokingPlaceAddressQs, ServiceQs
+from src.exceptions import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+# the queries behind the busiest routes; run once, their statements are compiled
+# into the cache of the read engines and the pages they read are loaded
+HOT_QUERIES = (
+    ('UserQs.get_user_credentials', UserQs.get_user_credentials, ('',)),
+    ('SmokingPlaceQs.get_all_smoking_places', SmokingPlaceQs.get_all_smoking_places, ()),
+    ('SmokingPlaceQs.get_smoking_place', SmokingPlaceQs.get_smoking_place, (0,)),
+    ('ReservationQs.get_all_reservations', ReservationQs.get_all_reservations, ()),
+    ('ReservationQs.get_user_reservations', ReservationQs.get_user_reservations, (0,)),
+    ('ReservationQs.get_user_reservation', ReservationQs.get_user_reservation, (0, 0)),
+    ('SmokingPlaceAddressQs.get_all_addresses', SmokingPlaceAddressQs.get_all_addresses, ()),
+    ('UserQs.get_all_users', UserQs.get_all_users, ()),
+    ('ServiceQs.ping', ServiceQs.ping, ()),
+)
+
+
+async def _open_pool(engine, size: int):
+    # held all at once, so the pool keeps `size` connections instead of reusing the first one
+    async with AsyncExitStack() as stack:
+        for _ in range(size):
+            await stack.enter_async_context(engine.connect())
+
+
+class Warmup:
+    """Gets a worker ready before it accepts connections: opens the pools of
+    every shard and runs the hot queries once. aiohttp only starts listening
+    once the startup hooks are done, so no request is served cold.
+
+    Also keeps the time to first byte of the first `report_requests` responses
+    of the worker, to check how cold they still are.
+    """
+
+    def __init__(self, report_requests: int):
+        self.report_requests = report_requests
+        self.status = 'starting'
+        self.steps = {}
+        self.errors = []
+        self.started = time.monotonic()
+        self.ready_at = None
+        self.first_bytes = []
+
+    async def _step(self, name: str, coro):
+        started = time.perf_counter()
+
+        try:
+            await coro
+        except DatabaseError:
+            # a cold worker is still better than none
+            metrics.inc('warmup.errors')
+            self.errors.append(name)
+
+        self.steps[name] = round((time.perf_counter() - started) * 1000, 3)
+
+    async def run(self, app):
+        self.status = 'warming up'
+        self.started = time.monotonic()
+        self.steps, self.errors, self.ready_at, self.first_bytes = {}, [], None, []
+
+        for shard in shards:
+            await self._step(f'pool.{shard.index}', self._open_pools(shard))
+
+        for name, query, args in HOT_QUERIES:
+            await self._step(name, query(*args))
+
+        yield
+
+        for engine in engines:
+            await engine.dispose()
+
+    @staticmethod
+    async def _open_pools(shard):
+        try:
+            await _open_pool(shard.read_engine, READ_POOL_SIZE)
+            await _open_pool(shard.write_engine, 1)
+        except Exception:
+            logger.exception('Opening the connection pool failed')
+            raise DatabaseError()
+
+    async def mark_ready(self, app):
+        # an on_startup hook, so it runs after every cleanup_ctx has started
+        self.status = 'ready'
+        self.ready_at = time.monotonic()
+        metrics.inc('warmup.seconds', self.ready_at - self.started)
+
+    async def mark_shutting_down(self, app):
+        self.status = 'shutting down'
+
+    async def record_first_byte(self, request, response):
+        # on_response_prepare: the headers are about to be sent
+        if len(self.first_bytes) < self.report_requests and 'received' in request:
+            self.first_bytes.append((time.monotonic(), time.perf_counter() - request['received']))
+
+    @property
+    def ready(self) -> bool:
+        return self.status == 'ready'
+
+    def report(self) -> dict:
+        report = {
+            'worker': metrics.worker_id,
+            'status': self.status,
+            'warmup_ms': round((self.ready_at - self.started) * 1000, 3) if self.ready_at else None,
+            'steps_ms': self.steps,
+            'errors': self.errors,
+        }
+
+        if self.first_bytes and self.ready_at:
+            times = sorted(seconds * 1000 for _, seconds in self.first_bytes)
+            report['first_responses'] = {
+                'count': len(times),
+                'first_after_ready_ms': round((self.first_bytes[0][0] - self.ready_at) * 1000, 3),
+                'first_ms': round(self.first_bytes[0][1] * 1000, 3),
+                'p50_ms': round(statistics.median(times), 3),
+                'p99_ms': round(times[min(len(times) - 1, int(len(times) * 0.99))], 3),
+                'max_ms': round(times[-1], 3),
+            }
+
+        return report
+
+
+warmup = Warmup(WARMUP_REPORT_REQUESTS)
@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+import time
+
+from aiohttp import web
+
+from src import metrics
+from src.config import (WORKER_HEARTBEAT_INTERVAL, WORKER_TIMEOUT, WORKER_SHUTDOWN_TIMEOUT, WORKER_RESTART_DELAY,
+                        WORKER_MAX_RESTART_DELAY, WORKER_CRASH_WINDOW, WORKER_MAX_CRASHES)
+from src.database.db_conn import engines
+
+logger = logging.getLogger(__name__)
+
+
+class Worker:
+    def __init__(self, index: int, pid: int, heartbeat_fd: int):
+        self.index = index
+        self.pid = pid
+        self.heartbeat_fd = heartbeat_fd
+        self.last_seen = time.monotonic()
+        self.retiring = False
+
+
+class WorkerPool:
+    """Pre-fork launcher: every worker is a separate aiohttp process bound to the
+    same port with SO_REUSEPORT, so the kernel balances connections between them.
+
+    SIGHUP restarts workers one by one, SIGTERM/SIGINT stop the pool, a worker
+    that dies or stops sending heartbeats from its event loop is replaced, later
+    with every crash, and the pool stops when they keep crashing (a worker that
+    can't start at all, for instance).
+    """
+
+    def __init__(self, app: web.Application, host: str, port: int, workers: int):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.size = workers
+        self.workers = {}
+        self.stopping = False
+        self.reloading = False
+        self.failed = False
+        self.crashes = []
+        self.restarts = {}
+
+    def spawn(self, index: int):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            os.close(read_fd)
+            self._run_worker(index, write_fd)
+
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        self.workers[pid] = Worker(index, pid, read_fd)
+
+    def _run_worker(self, index: int, heartbeat_fd: int):
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(sig, signal.SIG_DFL)
+
+        exit_code = 0
+
+        try:
+            for engine in engines:
+                engine.sync_engine.dispose(close=False)
+            metrics.reset(index)
+
+            async def heartbeat(app):
+                task = asyncio.create_task(self._heartbeat(heartbeat_fd))
+                yield
+                task.cancel()
+
+            # first, so the heartbeats also cover the warmup and the cleanup of the other contexts
+            self.app.cleanup_ctx.insert(0, heartbeat)
+            web.run_app(self.app, host=self.host, port=self.port, reuse_port=True,
+                        shutdown_timeout=WORKER_SHUTDOWN_TIMEOUT,
+                        print=lambda message: print(f'[worker {index} pid {os.getpid()}] {message}'))
+        except BaseException:
+            logger.exception('Worker failed')
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    @staticmethod
+    async def _heartbeat(fd: int):
+        os.set_blocking(fd, False)
+
+        while True:
+            try:
+                os.write(fd, b'.')
+            except BlockingIOError:
+                pass
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _on_reload(self, signum, frame):
+        self.reloading = True
+
+    def _read_heartbeats(self):
+        now = time.monotonic()
+
+        for worker in self.workers.values():
+            try:
+                if os.read(worker.heartbeat_fd, 4096):
+                    worker.last_seen = now
+            except BlockingIOError:
+                pass
+
+            if now - worker.last_seen > WORKER_TIMEOUT:
+                print(f'Worker {worker.index} (pid {worker.pid}) is not responding, killing it')
+                self._signal(worker.pid, signal.SIGKILL)
+
+    def _reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+
+            if pid == 0:
+                return
+
+            worker = self.workers.pop(pid, None)
+
+            if worker is None:
+                continue
+
+            os.close(worker.heartbeat_fd)
+
+            if not self.stopping and not worker.retiring:
+                self._crashed(worker, status)
+
+    def _crashed(self, worker: Worker, status: int):
+        now = time.monotonic()
+        self.crashes = [at for at in self.crashes if now - at < WORKER_CRASH_WINDOW] + [now]
+
+        if len(self.crashes) >= WORKER_MAX_CRASHES:
+            print(f'Worker {worker.index} (pid {worker.pid}) exited with status {status}, {len(self.crashes)} '
+                  f'crashes within {WORKER_CRASH_WINDOW:g} s, stopping')
+            self.stopping = self.failed = True
+            return
+
+        delay = min(WORKER_RESTART_DELAY * 2 ** (len(self.crashes) - 1), WORKER_MAX_RESTART_DELAY)
+        print(f'Worker {worker.index} (pid {worker.pid}) exited with status {status}, restarting in {delay:g} s')
+        self.restarts[worker.index] = now + delay
+
+    def _restart_crashed(self):
+        now = time.monotonic()
+
+        for index, at in list(self.restarts.items()):
+            if at <= now:
+                del self.restarts[index]
+                self.spawn(index)
+
+    def _restart(self):
+        self.reloading = False
+
+        for worker in list(self.workers.values()):
+            if self.stopping:
+                return
+
+            worker.retiring = True
+            self.spawn(worker.index)
+            self._signal(worker.pid, signal.SIGTERM)
+
+            deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+            while worker.pid in self.workers and time.monotonic() < deadline:
+                self._reap()
+                time.sleep(0.1)
+
+    def _shutdown(self):
+        for pid in list(self.workers):
+            self._signal(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+        while self.workers and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+
+        for pid in list(self.workers):
+            self._signal(pid, signal.SIGKILL)
+        self._reap()
+
+    @staticmethod
+    def _signal(pid: int, sig: int):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        print(f'======== Running {self.size} workers on http://{self.host}:{self.port} ========')
+
+        for index in range(self.size):
+            self.spawn(index)
+
+        while not self.stopping:
+            if self.reloading:
+                self._restart()
+
+            self._reap()
+            self._restart_crashed()
+            self._read_heartbeats()
+            time.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+        self._shutdown()
+
+        if self.failed:
+            raise SystemExit(1)
+
+
+def run_workers(app: web.Application, host: str, port: int, workers: int):
+    if workers <= 1 or not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        web.run_app(app, host=host, port=port)
+        return
+
+    WorkerPool(app, host, port, workers).run()
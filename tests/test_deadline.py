@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+
+from sqlalchemy import create_engine
+
+from src.models import Base
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# a route with a deadline of 0.2 s running a statement of many seconds; prints the status and the time taken
+SERVER = '''
+import asyncio, time
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from sqlalchemy import text
+from src.database.db_conn import session_scope
+from src.decorators import deadline
+from src.middlewares import deadline_middleware
+
+COUNT = 'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM (SELECT x FROM c LIMIT 10000000000)'
+
+@deadline(0.2)
+async def slow(request):
+    async with session_scope() as session:
+        await session.execute(text(COUNT))
+    return web.json_response({})
+
+async def main():
+    app = web.Application(middlewares=[deadline_middleware])
+    app.router.add_get('/slow', slow)
+    async with TestClient(TestServer(app)) as client:
+        started = time.perf_counter()
+        response = await client.get('/slow')
+        print(response.status, time.perf_counter() - started)
+
+asyncio.run(main())
+'''
+
+
+def test_deadline_interrupts_running_statement(tmp_path):
+    path = tmp_path / 'deadline.db'
+    engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(engine)
+    engine.dispose()
+
+    env = {**os.environ, 'PYTHONPATH': ROOT, 'DB_URL': f'sqlite+aiosqlite:///{path}'}
+    # the statement alone would run for minutes
+    output = subprocess.run([sys.executable, '-c', SERVER], env=env, check=True, text=True, capture_output=True,
+                            timeout=30).stdout.split()
+
+    assert output[0] == '503'
+    assert float(output[1]) < 2
@@ -0,0 +1,96 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import bcrypt
+import pytest
+from sqlalchemy import create_engine, insert
+
+from src.models import Base, User, SmokingPlaceAddress, SmokingPlace, IdempotencyKey
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# reserves smoking place 1 as user1 for each request of argv[1], a JSON list of [key, start in minutes];
+# prints a JSON list of [status, replayed, body]
+CLIENT = '''
+import asyncio, json, sys
+from datetime import datetime, timedelta
+from aiohttp import BasicAuth
+from aiohttp.test_utils import TestClient, TestServer
+from src.main import create_app
+
+async def main():
+    now = datetime.now().replace(microsecond=0)
+    results = []
+    async with TestClient(TestServer(create_app())) as client:
+        response = await client.post('/login', auth=BasicAuth('user1', 'password'))
+        headers = {'Authorization': 'Bearer ' + (await response.json())['token']}
+        for key, minutes in json.loads(sys.argv[1]):
+            start = now + timedelta(minutes=minutes)
+            response = await client.post('/smoking-places/1/reservation', headers={**headers, 'Idempotency-Key': key},
+                                         json={'start': start.isoformat(), 'end': (start + timedelta(minutes=10)).isoformat()})
+            results.append([response.status, response.headers.get('Idempotency-Replayed') == 'true',
+                            await response.json()])
+    print(json.dumps(results))
+
+asyncio.run(main())
+'''
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = tmp_path / 'idempotency.db'
+    engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(engine)
+
+    with engine.begin() as connection:
+        connection.execute(insert(User), [{'id': 1, 'username': 'user1', 'name': 'User', 'email': 'user1@mail.ru',
+                                           'password': bcrypt.hashpw(b'password', bcrypt.gensalt(4)).decode(),
+                                           'role': 'user'}])
+        connection.execute(insert(SmokingPlaceAddress), [{'id': 1, 'city': 'Moscow', 'street': 'Tverskaya 1'}])
+        connection.execute(insert(SmokingPlace), [{'id': 1, 'number': 1, 'sp_address': 1}])
+
+    yield engine
+    engine.dispose()
+
+
+def reserve(engine, *requests) -> list:
+    env = {**os.environ, 'PYTHONPATH': ROOT, 'DB_URL': f'sqlite+aiosqlite:///{engine.url.database}',
+           'SECRET_KEY': 'test', 'BCRYPT_ROUNDS': '4', 'BCRYPT_MIN_ROUNDS': '4'}
+    output = subprocess.run([sys.executable, '-c', CLIENT, json.dumps(requests)], env=env, check=True, text=True,
+                            capture_output=True, timeout=60).stdout
+
+    return json.loads(output)
+
+
+def test_repeated_request_is_replayed(db):
+    (first_status, first_replayed, first), (status, replayed, body) = reserve(db, ['a', 60], ['a', 60])
+
+    assert (first_status, first_replayed) == (201, False)
+    assert (status, replayed, body) == (201, True, first)
+
+    # a new key is a new request
+    [(status, replayed, body)] = reserve(db, ['b', 120])
+
+    assert (status, replayed) == (201, False)
+    assert body != first
+
+
+def test_key_reused_for_another_request_is_refused(db):
+    (status, _, _), (reused_status, _, _) = reserve(db, ['a', 60], ['a', 120])
+
+    assert status == 201
+    assert reused_status == 422
+
+
+def test_request_in_progress_is_refused(db):
+    # a claim committed without its response, as seen by another process mid-request
+    with db.begin() as connection:
+        connection.execute(insert(IdempotencyKey), [{'user': 1, 'key': 'a', 'created': int(time.time()),
+                                                     'fingerprint': 'POST /smoking-places/1/reservation'}])
+
+    [(status, replayed, _)] = reserve(db, ['a', 60])
+
+    assert (status, replayed) == (409, False)
@@ -0,0 +1,132 @@
+import os
+import subprocess
+import sys
+import time
+
+import bcrypt
+import pytest
+from sqlalchemy import create_engine, insert
+
+from src.models import Base, User
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# reads commands from stdin: "issue" prints a new token of user 1, "check <token>" prints valid or revoked
+VERIFIER = '''
+import asyncio, sys
+from src.middlewares import authenticate
+from src.revocations import revocation_poller
+from src.tokens import issue_token
+
+async def main():
+    loop = asyncio.get_running_loop()
+    polling = revocation_poller.run(None)
+    await anext(polling)
+    while line := (await loop.run_in_executor(None, sys.stdin.readline)).split():
+        if line[0] == 'issue':
+            print(issue_token(1, 'user1', 'user'), flush=True)
+        else:
+            user = await authenticate('Bearer ' + line[1])
+            print('valid' if user else 'revoked', flush=True)
+
+asyncio.run(main())
+'''
+
+REVOKER = '''
+import asyncio, sys
+from src.database.db_queries import UserQs
+
+asyncio.run(UserQs.update_user_role(1, 'admin') if sys.argv[1] == 'role' else UserQs.delete_user(1))
+'''
+
+# logs in as user1 and admin, then prints the status of each step: user1's request with its token, the role
+# change by the admin, the same request with the old token and with a new one, the deletion by the admin and the
+# request with the last token
+CLIENT = '''
+import asyncio
+from aiohttp import BasicAuth
+from aiohttp.test_utils import TestClient, TestServer
+from src.main import create_app
+
+async def main():
+    statuses = []
+    async with TestClient(TestServer(create_app())) as client:
+        async def login(username):
+            response = await client.post('/login', auth=BasicAuth(username, 'password'))
+            return {'Authorization': 'Bearer ' + (await response.json())['token']}
+
+        async def call(method, path, headers, **kwargs):
+            response = await client.request(method, path, headers=headers, **kwargs)
+            statuses.append(response.status)
+
+        admin, user = await login('admin'), await login('user1')
+        await call('GET', '/reservations/my-reservations', user)
+        await call('PATCH', '/admin/users/1', admin, json={'role': 'user'})
+        await call('GET', '/reservations/my-reservations', user)
+        await asyncio.sleep(0.01)
+        user = await login('user1')
+        await call('GET', '/reservations/my-reservations', user)
+        await call('DELETE', '/admin/users/1', admin)
+        await call('GET', '/reservations/my-reservations', user)
+    print(*statuses)
+
+asyncio.run(main())
+'''
+
+POLL_INTERVAL = 0.2
+
+
+@pytest.fixture
+def env(tmp_path):
+    path = tmp_path / 'tokens.db'
+    engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(engine)
+
+    with engine.begin() as connection:
+        password = bcrypt.hashpw(b'password', bcrypt.gensalt(4)).decode()
+        connection.execute(insert(User), [{'id': 1, 'username': 'user1', 'password': password, 'name': 'User',
+                                           'email': 'user1@mail.ru', 'role': 'user'},
+                                          {'id': 2, 'username': 'admin', 'password': password, 'name': 'Admin',
+                                           'email': 'admin@mail.ru', 'role': 'admin'}])
+    engine.dispose()
+
+    return {**os.environ, 'PYTHONPATH': ROOT, 'DB_URL': f'sqlite+aiosqlite:///{path}', 'SECRET_KEY': 'test',
+            'TOKEN_REVOCATION_POLL_INTERVAL': str(POLL_INTERVAL), 'BCRYPT_ROUNDS': '4', 'BCRYPT_MIN_ROUNDS': '4'}
+
+
+def test_revocation_reaches_other_processes(env):
+    verifier = subprocess.Popen([sys.executable, '-c', VERIFIER], env=env, text=True,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def ask(command: str) -> str:
+        verifier.stdin.write(command + '\n')
+        verifier.stdin.flush()
+        return verifier.stdout.readline().strip()
+
+    def revoke(how: str):
+        subprocess.run([sys.executable, '-c', REVOKER, how], env=env, check=True)
+        time.sleep(POLL_INTERVAL * 1.5)
+
+    try:
+        token = ask('issue')
+        assert ask(f'check {token}') == 'valid'
+
+        revoke('role')
+        assert ask(f'check {token}') == 'revoked'
+
+        time.sleep(0.01)
+        token = ask('issue')
+        assert ask(f'check {token}') == 'valid'
+
+        revoke('delete')
+        assert ask(f'check {token}') == 'revoked'
+    finally:
+        verifier.stdin.close()
+        verifier.wait(10)
+
+
+def test_revoked_token_is_rejected(env):
+    output = subprocess.run([sys.executable, '-c', CLIENT], env=env, check=True, text=True, capture_output=True,
+                            timeout=60).stdout
+
+    assert output.split() == ['200', '200', '401', '200', '204', '401']